@@ -14,8 +14,6 @@ from rasa_sdk.events import (
     UserUtteranceReverted
 )
 
-from elasticsearch import RequestError
-
 import logging
 logger = logging.getLogger(__name__)
 
@@ -123,22 +121,11 @@ class ActionDefaultFallback(Action):
 
         logger.info('action_default_fallback - saving chat history due to `UserUtteranceReverted` action - START')
         
-        chat_history = helper._parse_tracker_events(tracker.events)
-        
-        export = {
-            'chat_id'       : tracker.sender_id             ,
-            'timestamp'     : chat_history[0]['timestamp']  ,
-            'chat_history'  : chat_history
-        }
-
-        try:
-            await save_chat_logs(export)
-        except RequestError as e:
-            logger.error(f'action_default_fallback - error while indexing - failed to save conversation with chat_id - {export["chat_id"]}')
-        except AssertionError as e:
-            logger.error(f'action_default_fallback - error on ES side - failed to save conversation with chat_id - {export["chat_id"]}')     
+        export = helper._export_chat(tracker)
+        if export is not None and await save_chat_logs(export):
+            helper._commit_export(tracker, export['timestamp'])
         
-        logger.info('action_default_fallback - saved chat history - END')
+        logger.info('action_default_fallback - queued saving chat history - END')
         
 
         dispatcher.utter_message(text = helper.utterances['fallback'], buttons = buttons)
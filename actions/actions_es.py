@@ -1,3 +1,6 @@
+import os
+import uuid
+
 from typing import Dict, Text, Any, List
 
 from rasa_sdk import Action, Tracker
@@ -9,16 +12,38 @@ from rasa_sdk.events import (
     EventType
 )
 
-from elasticsearch import RequestError
-
 from actions import helper
 
-from actions.es import config
-from actions.es.es import submit, save_chat_logs
+from actions.es import config, metrics
+from actions.es.es import submit, submit_followup, save_chat_logs
+from actions.es.embed import EmbedServiceBusy
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Load the model and the data in the background, the actions not needing them are served meanwhile
+if config.warm_up_on_start: config.start_warm_up()
+# Save the queued chat logs before the server stops - atexit runs after the event loop is closed
+try:
+    from sanic import Sanic
+
+    async def _before_server_stop(app, loop):
+        await config.shutdown()
+
+    Sanic.get_app().register_listener(_before_server_stop, 'before_server_stop')
+except Exception as e:
+    logger.warning(f'Failed registering the shutdown of the chat log writer, the queue is only journaled on exit - {e}')
+
+# Latency histograms of the actions and of the search pipeline stages - the sanic workers would all bind
+# the same port, so with more of them only the preforked server sums up the metrics over its workers
+if config.metrics_enabled and config.metrics_port:
+    if int(os.getenv('ACTION_SERVER_SANIC_WORKERS', 1)) > 1:
+        logger.warning(
+            'Not serving the metrics with ACTION_SERVER_SANIC_WORKERS > 1 (only one worker would be exported), '
+            'run the preforked server (python -m actions.es.serve) to serve them summed over the workers')
+    else:
+        metrics.start_server(config.metrics_port, host = config.metrics_host)
+
 
 class ActionAskForProblemDescription(Action):
     '''Custom action for slot validation - problem_description.'''
@@ -26,6 +51,7 @@ class ActionAskForProblemDescription(Action):
     def name(self) -> Text:
         return 'action_ask_problem_description'
     
+    @metrics.timed_action
     def run(
         self,
         dispatcher  : CollectingDispatcher,
@@ -47,6 +73,7 @@ class ValidateProblemDescriptionSlot(Action):
     def name(self) -> Text:
         return 'action_validate_problem_description'
     
+    @metrics.timed_action
     def run(
         self,
         dispatcher  : CollectingDispatcher  ,
@@ -75,6 +102,7 @@ class ValidateESQueryForm(FormValidationAction):
     def name(self) -> Text:
         return 'validate_es_query_form'
 
+    @metrics.timed_action
     async def extract_problem_details(
         self, 
         dispatcher  : CollectingDispatcher  , 
@@ -108,6 +136,7 @@ class ActionSubmitESQueryForm(Action):
     def name(self) -> Text:
         return 'action_submit_es_query_form'
     
+    @metrics.timed_action
     async def run(
         self,
         dispatcher  : CollectingDispatcher,
@@ -130,7 +159,8 @@ class ActionSubmitESQueryForm(Action):
 
         results     = False
         events      = []
-        es_data     = {'query': query, 'slots': slots}
+        # the follow-up refines the results of this search (see `submit_followup`)
+        es_data     = {'query': query, 'slots': slots, 'session': f'{tracker.sender_id}:{uuid.uuid4().hex}'}
         buttons     = [
             helper.buttons['start_over'     ],
             helper.buttons['request_expert' ]
@@ -144,11 +174,19 @@ class ActionSubmitESQueryForm(Action):
                 logger.info(f'action_submit_es_query_form - slot query - {q}')
 
         
-        if not config.es_imitate:            
+        if not config.es_imitate:
+            try:
+                res, debug_query = await submit(query, slots = slots_query, session = es_data['session'])
+            except EmbedServiceBusy as e:
+                logger.warning(f'action_submit_es_query_form - run - embedding service busy - {e}')
+                events = helper._reset_slots(tracker)
+                dispatcher.utter_message(text = helper.utterances['busy'], buttons = buttons)
+                logger.info(f'action_submit_es_query_form - run - END')
+                return events
+
             if config.debug:            
                 
                 dispatcher.utter_message(text = helper.utterances['debug_slots'] + slots_utterance)
-                res, debug_query = await submit(query, slots = slots_query)
                 dispatcher.utter_message(text = helper.utterances['debug_query'].format(debug_query))
                 
                 top_n = config.es_top_n
@@ -165,8 +203,6 @@ class ActionSubmitESQueryForm(Action):
                     results = True
 
             else:
-                res, _ = await submit(query, slots = slots_query)
-                
                 top_n = config.es_top_n
                 if len(res['data']) < config.es_top_n:
                     top_n = len(res['data'])
@@ -207,6 +243,7 @@ class ActionAskForProblemDescriptionAdd(Action):
     def name(self) -> Text:
         return 'action_ask_problem_description_add'
     
+    @metrics.timed_action
     def run(
         self,
         dispatcher  : CollectingDispatcher,
@@ -246,6 +283,7 @@ class ValidateESResultForm(FormValidationAction):
     def name(self) -> Text:
         return 'validate_es_result_form'
 
+    @metrics.timed_action
     async def extract_problem_details(
         self, 
         dispatcher  : CollectingDispatcher  , 
@@ -272,6 +310,7 @@ class ValidateESResultForm(FormValidationAction):
         
         return {'problem_details': slots}
     
+    @metrics.timed_action
     def validate_problem_description_add(
         self,
         value       : Text,
@@ -298,6 +337,7 @@ class ActionSubmitESResultForm(Action):
     def name(self) -> Text:
         return 'action_submit_es_result_form'
     
+    @metrics.timed_action
     async def run(
         self,
         dispatcher  : CollectingDispatcher,
@@ -333,12 +373,29 @@ class ActionSubmitESResultForm(Action):
             events              = []
 
             _, prev_slots                   = helper._process_slots(es_data['slots'])
+            n_prev_slots                    = len(prev_slots) if prev_slots is not None else 0
             slots_utterance, slots_query    = helper._process_slots(slots, prev_slots = prev_slots)
-            query                           = '. '.join([prev_query, query])
+            new_slots_query                 = slots_query[n_prev_slots:] if slots_query is not None else None
+
+            try:
+                res, debug_query = await submit_followup(
+                    prev_query, query,
+                    slots       = slots_query           ,
+                    new_slots   = new_slots_query       ,
+                    session     = es_data.get('session'))
+            except EmbedServiceBusy as e:
+                logger.warning(f'action_submit_es_result_form - run - embedding service busy - {e}')
+                buttons = [
+                    helper.buttons['start_over'     ],
+                    helper.buttons['request_expert' ]
+                ]
+                dispatcher.utter_message(text = helper.utterances['busy'], buttons = buttons)
+                events = helper._reset_slots(tracker)
+                logger.info(f'action_submit_es_result_form - run - END')
+                return events
             
             if config.debug:            
                 dispatcher.utter_message(text = helper.utterances['debug_slots'] + slots_utterance)
-                res, debug_query = await submit(query, slots = slots_query)
                 dispatcher.utter_message(text = helper.utterances['debug_query'].format(debug_query))
                 
                 top_n = config.es_top_n
@@ -354,8 +411,6 @@ class ActionSubmitESResultForm(Action):
                     dispatcher.utter_message(text = message , json_message = res)
 
             else:
-                res, _ = await submit(query, slots = slots_query)
-                
                 top_n = config.es_top_n
                 if len(res['data']) < config.es_top_n:
                     top_n = len(res['data'])
@@ -382,6 +437,7 @@ class ActionSaveConversation(Action):
     def name(self) -> Text:
         return 'action_save_conversation'
     
+    @metrics.timed_action
     async def run(
         self,
         dispatcher  : CollectingDispatcher,
@@ -391,20 +447,10 @@ class ActionSaveConversation(Action):
         
         logger.info('action_save_conversation - START')
         
-        chat_history = helper._parse_tracker_events(tracker.events)
-        export = {
-            'chat_id'       : tracker.sender_id             ,
-            'timestamp'     : chat_history[0]['timestamp']  ,
-            'chat_history'  : chat_history
-        }
-
-        try:
-            await save_chat_logs(export)
-        except RequestError as e:
-            logger.error(f'action_save_conversation - error while indexing - failed to save conversation with chat_id - {export["chat_id"]}')
-        except AssertionError as e:
-            logger.error(f'action_save_conversation - error on ES side - failed to save conversation with chat_id - {export["chat_id"]}')        
+        export = helper._export_chat(tracker)
+        if export is not None and await save_chat_logs(export):
+            helper._commit_export(tracker, export['timestamp'])
         
-        logger.info(f'action_save_conversation - success saving conversation with chat_id - {export["chat_id"]}')
+        logger.info(f'action_save_conversation - queued saving conversation with chat_id - {tracker.sender_id}')
         logger.info('action_save_conversation - END')
         return []
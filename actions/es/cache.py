@@ -0,0 +1,207 @@
+import os
+import time
+import pickle
+import asyncio
+import sqlite3
+import logging
+
+from typing import Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteCache:
+    '''Cache backed by a local SQLite file, shared by all the worker processes on the host.
+
+    Entries are evicted in insertion order once the cache holds more than
+    `maxsize` entries (checked every `prune_every` insertions).
+
+    The SQLite calls wait up to 5 seconds for a lock held by another process,
+    so on the event loop use `get_async` and `set_background`, which run them
+    in a single background thread of the process (in order, on one connection).
+    '''
+
+    def __init__(
+        self,
+        path        : str           ,
+        maxsize     : int   = 100000,
+        ttl         : float = None  ,
+        prune_every : int   = 100
+        ) -> None:
+
+        self.path           = path
+        self.maxsize        = maxsize
+        self.ttl            = ttl
+        self.prune_every    = prune_every
+
+        self._conn          = None
+        self._pid           = None
+        self._inserts       = 0
+        self._executor      = None
+        self._executor_pid  = None
+
+    def _connect(self) -> sqlite3.Connection:
+        '''Open the connection on first use in every process (connections are not fork-safe).'''
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout = 5.0, isolation_level = None, check_same_thread = False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB, expires REAL, inserted REAL)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def _background(self) -> ThreadPoolExecutor:
+        '''Background thread of the process (threads do not survive a fork).'''
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor      = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'sqlite-cache')
+            self._executor_pid  = os.getpid()
+        return self._executor
+
+    def get(self, key: str) -> Any:
+        '''Get the value or None if missing or expired.'''
+        try:
+            row = self._connect().execute(
+                'SELECT value, expires FROM cache WHERE key = ?', (key, )).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f'Cache backend - failed reading from {self.path} - {e}')
+            return None
+
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < time.time():
+            return None
+
+        return pickle.loads(row[0])
+
+    async def get_async(self, key: str) -> Any:
+        '''Get the value or None if missing or expired, in the background thread.'''
+        return await asyncio.get_event_loop().run_in_executor(self._background(), self.get, key)
+
+    def set(self, key: str, value: Any) -> None:
+        '''Store the value.'''
+        self._write(key, pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL), time.time())
+
+    def set_background(self, key: str, value: Any) -> None:
+        '''Store the value in the background thread (without waiting, the value is pickled right away).'''
+        self._background().submit(self._write, key, pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL), time.time())
+
+    def _write(self, key: str, value: bytes, now: float) -> None:
+        expires = now + self.ttl if self.ttl else None
+        try:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires, inserted) VALUES (?, ?, ?, ?)',
+                (key, value, expires, now))
+
+            self._inserts += 1
+            if self._inserts % self.prune_every == 0:
+                conn.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?', (now, ))
+                conn.execute(
+                    'DELETE FROM cache WHERE key IN ('
+                    'SELECT key FROM cache ORDER BY inserted DESC LIMIT -1 OFFSET ?)', (self.maxsize, ))
+        except sqlite3.Error as e:
+            logger.warning(f'Cache backend - failed writing to {self.path} - {e}')
+
+    def clear(self) -> None:
+        '''Remove all the entries.'''
+        self._connect().execute('DELETE FROM cache')
+
+
+class LRUCache:
+    '''In-memory LRU cache with optional TTL and optional shared backend.
+
+    On a miss in memory the `backend` (i.e. `SqliteCache`) is looked up and a
+    hit there is copied into memory. The `hits` and `misses` counters are
+    for the cache as a whole.
+
+    Memory is the hot path - the values are written to the backend in its
+    background thread, and `get_async` looks the backend up there, so the
+    event loop never waits for it.
+    '''
+
+    def __init__(
+        self,
+        maxsize : int           = 10000 ,
+        ttl     : float         = None  ,
+        backend : SqliteCache   = None
+        ) -> None:
+
+        self.maxsize    = maxsize
+        self.ttl        = ttl
+        self.backend    = backend
+
+        self.hits       = 0
+        self.misses     = 0
+
+        self._data      = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Any:
+        '''Get the value or None if missing or expired.'''
+        value = self._memory_get(key)
+        if value is not None:
+            return value
+        return self._backend_hit(key, self.backend.get(key) if self.backend is not None else None)
+
+    async def get_async(self, key: str) -> Any:
+        '''Get the value or None if missing or expired, without blocking the event loop on the backend.'''
+        value = self._memory_get(key)
+        if value is not None:
+            return value
+        return self._backend_hit(key, await self.backend.get_async(key) if self.backend is not None else None)
+
+    def _memory_get(self, key: str) -> Any:
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires is None or expires >= time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        return None
+
+    def _backend_hit(self, key: str, value: Any) -> Any:
+        if value is None:
+            self.misses += 1
+            return None
+        self._set(key, value)
+        self.hits += 1
+        return value
+
+    def _set(self, key: str, value: Any) -> None:
+        expires = time.time() + self.ttl if self.ttl else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last = False)
+
+    def set(self, key: str, value: Any) -> None:
+        '''Store the value (in memory and in the backend).'''
+        self._set(key, value)
+        if self.backend is not None:
+            self.backend.set_background(key, value)
+
+    def clear(self) -> None:
+        '''Remove all the entries from memory (the backend is kept).'''
+        self._data.clear()
+
+    def stats(self) -> dict:
+        '''Get hit and miss counters.
+
+        Returns:
+            dict: Number of entries, hits, misses and hit rate.
+        '''
+        total = self.hits + self.misses
+        return {
+            'size'      : len(self._data)                       ,
+            'hits'      : self.hits                             ,
+            'misses'    : self.misses                           ,
+            'hit_rate'  : self.hits / total if total else 0.0   ,
+        }
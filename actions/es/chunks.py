@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+
+from typing import Iterable, Iterator, List
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from actions.es.ingest import doc_fields, CHUNK_SIZE, ROLLING_SIZE, chunk_documents, document_id
+
+logger = logging.getLogger(__name__)
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError('The chunk store needs pyarrow - pip install pyarrow')
+
+
+def _model_folder(path: str, model: str) -> str:
+    return os.path.join(path, 'vectors', model.replace('/', '__'))
+
+
+def _replace(path: str, write) -> None:
+    '''Write the file through a temporary file, so readers never see it half written.'''
+    write(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+class ChunkStore:
+    '''Sentence-window chunks of the corpus, independent of the embedding model.
+
+    Layout of the store:
+        manifest.json       - generation, sentence windows, counts
+        documents.parquet   - `_id` and the fields of `doc_fields` of every document (links as JSON)
+        chunks.parquet      - `doc` (row of the document), `name`, `start`, `end` and `text` of every chunk,
+                              chunks grouped by document
+        vectors/<model>/    - vector set of the model - `vectors.npy` (float32, one row per chunk)
+                              and `manifest.json` (model, dims, generation of the chunks)
+
+    The generation is a hash of the chunks, so rebuilding the store from
+    unchanged sources keeps the vector sets valid.
+    '''
+
+    def __init__(self, path: str) -> None:
+        _require_pyarrow()
+
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        self.path           = path
+        self.generation     = manifest['generation']
+        self.chunk_size     = manifest['chunk_size']
+        self.rolling_size   = manifest['rolling_size']
+
+        self.documents      = pq.read_table(os.path.join(path, 'documents.parquet'))
+        self.chunks         = pq.read_table(os.path.join(path, 'chunks.parquet'))
+
+    def __len__(self) -> int:
+        return self.chunks.num_rows
+
+    def models(self) -> List[str]:
+        '''Get the models with a vector set matching the current chunks.'''
+        folder = os.path.join(self.path, 'vectors')
+        models = []
+        for m in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+            manifest = os.path.join(folder, m, 'manifest.json')
+            if os.path.isfile(manifest):
+                with open(manifest) as f:
+                    manifest = json.load(f)
+                if manifest['generation'] == self.generation:
+                    models.append(manifest['model'])
+        return models
+
+    def vectors(self, model: str) -> np.ndarray:
+        '''Get the vector set of the model (memory-mapped).
+
+        Raises:
+            ValueError: If the vector set is missing or was encoded from other chunks.
+        '''
+        folder = _model_folder(self.path, model)
+        if not os.path.isfile(os.path.join(folder, 'manifest.json')):
+            raise ValueError(f'No vectors of {model} in the chunk store {self.path}')
+        with open(os.path.join(folder, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['generation'] != self.generation:
+            raise ValueError(f'Vectors of {model} are outdated, re-run the embed stage')
+
+        return np.load(os.path.join(folder, 'vectors.npy'), mmap_mode = 'r')
+
+    def iter_documents(self, model: str) -> Iterator[dict]:
+        '''Iterate over the documents in the format ingested into ES (with the `vectors` of the model).'''
+        vectors = self.vectors(model)
+        docs    = self.documents.to_pydict()
+        chunks  = self.chunks.select(['doc', 'name', 'start', 'end']).to_pydict()
+
+        c = 0
+        for i in range(self.documents.num_rows):
+            doc = {f: docs[f][i] for f in doc_fields}
+            doc['links'     ] = json.loads(doc['links'])
+            doc['_id'       ] = docs['_id'][i]
+            doc['vectors'   ] = []
+            while c < len(chunks['doc']) and chunks['doc'][c] == i:
+                doc['vectors'].append({
+                    'vector': vectors[c].tolist()   ,
+                    'name'  : chunks['name' ][c]    ,
+                    'start' : chunks['start'][c]    ,
+                    'end'   : chunks['end'  ][c]    ,
+                })
+                c += 1
+            yield doc
+
+
+def write_chunk_store(
+    path        : str               ,
+    docs        : Iterable[dict]    ,
+    nlp                             ,
+    batch_size  : int = 64          ,
+    n_process   : int = 1
+    ) -> str:
+    '''Split the documents into sentence windows and write them into the chunk store.
+
+    Args:
+        path        (str)           : Folder of the chunk store.
+        docs        (Iterable[dict]): Documents (see `read_documents`).
+        nlp                         : spaCy pipeline with sentence boundaries.
+        batch_size  (int)           : Batch size of `nlp.pipe`. Defaults to 64.
+        n_process   (int)           : Number of processes of `nlp.pipe`. Defaults to 1.
+
+    Returns:
+        str: Generation of the chunks.
+    '''
+    _require_pyarrow()
+
+    unique = {}
+    for d in docs:
+        d['_id'] = document_id(d)
+        unique.setdefault(d['_id'], d)
+    docs = list(unique.values())
+
+    chunks  = chunk_documents(docs, nlp, batch_size = batch_size, n_process = n_process)
+    columns = {'doc': [], 'name': [], 'start': [], 'end': [], 'text': []}
+    digest  = hashlib.sha1(json.dumps([CHUNK_SIZE, ROLLING_SIZE]).encode('utf-8'))
+    for i, (d, cs) in enumerate(zip(docs, chunks)):
+        digest.update(d['_id'].encode('utf-8'))
+        for c in cs:
+            columns['doc'  ].append(i         )
+            columns['name' ].append(c['name'] )
+            columns['start'].append(c['start'])
+            columns['end'  ].append(c['end']  )
+            columns['text' ].append(c['text'] )
+            digest.update(json.dumps([c['name'], c['start'], c['end'], c['text']]).encode('utf-8'))
+    generation = digest.hexdigest()
+
+    documents = {f: [d[f] for d in docs] for f in doc_fields}
+    documents['links'] = [json.dumps(d['links']) for d in docs]
+    documents['_id'  ] = [d['_id'] for d in docs]
+
+    os.makedirs(path, exist_ok = True)
+    _replace(os.path.join(path, 'documents.parquet'), lambda p: pq.write_table(pa.table(documents), p))
+    _replace(os.path.join(path, 'chunks.parquet'), lambda p: pq.write_table(pa.table({
+        'doc'   : pa.array(columns['doc'  ], type = pa.int32()),
+        'name'  : pa.array(columns['name' ], type = pa.string()),
+        'start' : pa.array(columns['start'], type = pa.int32()),
+        'end'   : pa.array(columns['end'  ], type = pa.int32()),
+        'text'  : pa.array(columns['text' ], type = pa.string()),
+    }), p))
+
+    def _manifest(p):
+        with open(p, 'w') as f:
+            json.dump({
+                'generation'    : generation            ,
+                'chunk_size'    : CHUNK_SIZE            ,
+                'rolling_size'  : ROLLING_SIZE          ,
+                'docs'          : len(docs)             ,
+                'chunks'        : len(columns['doc'])   ,
+            }, f)
+    _replace(os.path.join(path, 'manifest.json'), _manifest)
+
+    logger.info(f'Written chunk store to {path} - {len(docs)} documents, {len(columns["doc"])} chunks ({generation})')
+    return generation
+
+
+def _init_embed_worker(
+    model_name      : str,
+    cache_folder    : str,
+    threads         : int
+    ) -> None:
+    '''Load the model in the embed stage worker, splitting the cores between the workers.'''
+    import torch
+    from actions.es import embed
+
+    torch.set_num_threads(threads)
+    # the forked worker may inherit the model of the actions config, load the requested one
+    embed._model = None
+    embed._init_worker(model_name, cache_folder)
+
+
+def _encode_shard(texts: List[str]) -> np.ndarray:
+    from actions.es.embed import _encode_worker
+    return np.asarray(_encode_worker(texts), dtype = np.float32)
+
+
+def embed_chunk_store(
+    path            : str           ,
+    model           : str           ,
+    cache_folder    : str           ,
+    workers         : int = None    ,
+    shard_size      : int = 2048    ,
+    force           : bool = False
+    ) -> str:
+    '''Encode the chunks of the chunk store with the model (the embed stage).
+
+    The chunks are split into shards encoded in parallel by `workers`
+    processes, each with its own copy of the model and an equal share of the
+    cores. The texts get the synonym replacement of the ingestion.
+
+    Args:
+        path            (str)   : Folder of the chunk store.
+        model           (str)   : Name of the SentenceTransformer model.
+        cache_folder    (str)   : Folder with cached models.
+        workers         (int)   : Number of worker processes. Defaults to the number of cores.
+        shard_size      (int)   : Chunks encoded per call of a worker. Defaults to 2048.
+        force           (bool)  : Re-encode if an up to date vector set exists. Defaults to False.
+
+    Returns:
+        str: Folder of the vector set.
+    '''
+    from actions.es.es import _synonym_replace
+
+    store   = ChunkStore(path)
+    folder  = _model_folder(path, model)
+    if not force and model in store.models():
+        logger.info(f'Vectors of {model} are up to date')
+        return folder
+
+    workers = workers or os.cpu_count()
+    texts   = [_synonym_replace(t) for t in store.chunks.column('text').to_pylist()]
+    shards  = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+    os.makedirs(folder, exist_ok = True)
+
+    start   = time.monotonic()
+    vectors = None
+    with ProcessPoolExecutor(
+        max_workers = workers                                                   ,
+        initializer = _init_embed_worker                                        ,
+        initargs    = (model, cache_folder, max(1, os.cpu_count() // workers))  ) as pool:
+        offset = 0
+        for shard in pool.map(_encode_shard, shards):
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(
+                    os.path.join(folder, 'vectors.npy.tmp'), mode = 'w+', dtype = np.float32, shape = (len(texts), shard.shape[1]))
+            vectors[offset:offset + len(shard)] = shard
+            offset += len(shard)
+            logger.info(f'Encoded {offset} of {len(texts)} chunks with {model}')
+
+    if vectors is None:
+        raise ValueError(f'No chunks in the chunk store {path}')
+    dims = vectors.shape[1]
+    vectors.flush()
+    del vectors
+    os.replace(os.path.join(folder, 'vectors.npy.tmp'), os.path.join(folder, 'vectors.npy'))
+
+    def _manifest(p):
+        with open(p, 'w') as f:
+            json.dump({
+                'model'         : model             ,
+                'dims'          : int(dims)         ,
+                'generation'    : store.generation  ,
+                'chunks'        : len(texts)        ,
+            }, f)
+    _replace(os.path.join(folder, 'manifest.json'), _manifest)
+
+    elapsed = time.monotonic() - start
+    logger.info(f'Encoded {len(texts)} chunks with {model} in {elapsed:.1f} s ({len(texts) / elapsed:.0f} chunks/s, {workers} workers)')
+    return folder
+
+
+def main():
+    parser      = argparse.ArgumentParser(description = 'Model-agnostic chunk store of the corpus and per-model vector sets.')
+    parser.add_argument('path', help = 'folder of the chunk store')
+    commands    = parser.add_subparsers(dest = 'command', required = True)
+
+    build = commands.add_parser('build', help = 'split the source data into chunks')
+    build.add_argument('--data-dir'         , default = os.path.join(os.path.dirname(__file__), 'data'), help = 'folder with the source data')
+    build.add_argument('--sources'          , default = None,               help = 'comma separated sources (all by default)')
+    build.add_argument('--pipe-batch-size'  , default = 64  , type = int,   help = 'batch size of the sentence splitting')
+    build.add_argument('--n-process'        , default = 1   , type = int,   help = 'processes of the sentence splitting')
+
+    embed = commands.add_parser('embed', help = 'encode the chunks with a model')
+    embed.add_argument('--model'            , required = True,              help = 'SentenceTransformer model (i.e. all-MiniLM-L6-v2)')
+    embed.add_argument('--workers'          , default = None, type = int,   help = 'worker processes (number of cores by default)')
+    embed.add_argument('--shard-size'       , default = 2048, type = int,   help = 'chunks per call of a worker')
+    embed.add_argument('--force'            , action = 'store_true',        help = 're-encode up to date vectors')
+
+    export = commands.add_parser('export', help = 'write the vector store from the vectors of a model')
+    export.add_argument('--model'           , required = True,              help = 'SentenceTransformer model')
+    export.add_argument('--vector-store'    , required = True,              help = 'folder of the vector store')
+    export.add_argument('--dtype'           , default = 'float32',          help = 'float32, float16 or int8')
+    export.add_argument('--dims'            , default = 0   , type = int,   help = 'reduce the vectors to the dimensions (0 keeps all)')
+    export.add_argument('--projection'      , default = 'pca',              help = 'method of the reduction - pca or truncate')
+
+    commands.add_parser('models', help = 'list the models with up to date vectors')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    if args.command == 'build':
+        from spacy.lang.en import English
+        from actions.es.ingest import read_documents
+
+        nlp = English()
+        nlp.add_pipe('sentencizer')
+        sources = args.sources.split(',') if args.sources else None
+        write_chunk_store(args.path, read_documents(args.data_dir, sources), nlp, batch_size = args.pipe_batch_size, n_process = args.n_process)
+
+    elif args.command == 'embed':
+        from actions.es import config
+        embed_chunk_store(args.path, args.model, config.embed_cache_dir, workers = args.workers, shard_size = args.shard_size, force = args.force)
+
+    elif args.command == 'export':
+        from actions.es.vectors import write_vector_store
+        write_vector_store(
+            args.vector_store, ChunkStore(args.path).iter_documents(args.model),
+            model = args.model, dtype = args.dtype, dims = args.dims, method = args.projection)
+
+    else:
+        for m in ChunkStore(args.path).models():
+            print(m)
+
+
+if __name__ == '__main__':
+    # python -m actions.es.chunks <path> build|embed|export|models --help
+    main()
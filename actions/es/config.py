@@ -1,11 +1,18 @@
 import os
 import sys
-import logging
+import time
 import pickle
+import asyncio
+import logging
+import threading
 
-from spacy.lang.en import English
+import numpy as np
 
-from elasticsearch import AsyncElasticsearch
+from actions.es.embed import EmbedService, load_model, quantize_model, check_parity
+from actions.es.cache import LRUCache, SqliteCache
+from actions.es.vectors import VectorStore
+from actions.es.projection import Projection
+from actions.es.retriever import ESScriptRetriever, ESKnnRetriever, LocalRetriever, server_version, knn_min_version
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -55,6 +62,7 @@ embed_url = 'all-distilroberta-v1' # 768
 # embed_url = 'all-mpnet-base-v1' # 768
 
 es_combined_index   = 'combined'
+es_chunk_index      = 'combined_chunks'
 es_logging_index    = 'logs'
 es_field_limit      = 32766
 debug               = stage == 'dev'
@@ -64,32 +72,134 @@ es_cut_off      = 0.4
 es_top_n        = 10
 es_ask_weight   = 0.8
 
-logger.info('----------------------------------------------')
-logger.info('Loading synonym procedure')
-tokenizer = English().tokenizer
-synonym_dict = {}
-try:
-    with open(os.path.join(os.path.dirname(__file__), 'scripts/synonym_list/transformed/synonym_pest.pickle'), 'rb') as handle:
-        synonym_dict = pickle.load(handle)
-    logger.info('Successfully loaded synonym list')
-except IOError:
-    logger.info('Failed loading synonym list')
-logger.info('----------------------------------------------')
-
-logger.info('----------------------------------------------')
-logger.info('Loading hardcoded queries')
-hardcoded_queries       = []
+# Slots refinement - if set, the query and every slot query are encoded in one batch, searched
+# concurrently and the results fused, with the slot queries sharing the weight `es_slots_weight`
+# (the query gets the rest), otherwise the slot queries are appended to the query and searched as one
+es_slots_parallel   = os.getenv('ES_SLOTS_PARALLEL', 'false').lower() == 'true'
+es_slots_weight     = float(os.getenv('ES_SLOTS_WEIGHT' , 0.3   ))
+
+# Follow-up refinement - the query vector and the candidates of the first turn are kept per conversation
+# (for `es_session_ttl` seconds), the follow-up encodes only the added details, blends the vectors with
+# `es_followup_weight` for the added details and rescores only the candidates. A full search with the blended
+# vector is done if the best candidate scores below `es_followup_confidence`, the question is searched from
+# scratch if the state of the first turn is gone. 0 size disables it.
+es_session_cache_size   = int(os.getenv('ES_SESSION_CACHE_SIZE'     , 10000 ))
+es_session_ttl          = float(os.getenv('ES_SESSION_TTL'          , 3600  ))
+es_followup_weight      = float(os.getenv('ES_FOLLOWUP_WEIGHT'      , 0.5   ))
+es_followup_confidence  = float(os.getenv('ES_FOLLOWUP_CONFIDENCE'  , 0.5   ))
+
+# Source-partitioned retrieval - if set, every partition is searched separately (in the same round trip)
+# with its share of `es_search_size` candidates and its weight applied to the scores at query time,
+# otherwise the askExtension hits are reweighted by `es_ask_weight` after a single mixed search.
+# The weight is either a number or the name of the config parameter holding it.
+es_partitioned  = os.getenv('ES_PARTITIONED', 'false').lower() == 'true'
+es_partitions   = [
+    {'name': 'askExtension' , 'sources': ['askExtension']   , 'exclude': None               , 'share': 0.3, 'weight': 'es_ask_weight'},
+    {'name': 'ucipm'        , 'sources': None               , 'exclude': ['askExtension']   , 'share': 0.7, 'weight': 1.0            },
+]
+
+# Retrieval mode - 'script' (brute-force script_score over nested vectors of the combined index),
+# 'knn' (approximate HNSW kNN over the flattened chunk index, requires ES 8.4+, 'script' is used on older servers)
+# or 'local' (exact in-process search over the memory-mapped vector store, no ES round trip)
+es_retrieval            = os.getenv('ES_RETRIEVAL'      , 'script'                  )
+es_knn_num_candidates   = 500
+es_knn_chunks_per_doc   = 3
+vector_store_path       = os.getenv('VECTOR_STORE_PATH' , '/var/tmp/vector_store'   )
+# Storage type of the vectors written into the vector store at ingestion ('float32', 'float16' or 'int8')
+vector_store_dtype      = os.getenv('VECTOR_STORE_DTYPE', 'float32'                 )
+# Reduced vectors - dimensions and projection ('pca' or 'truncate') of the vectors written into the vector
+# store (0 keeps all the dimensions), the store keeps its projection for the queries
+vector_store_dims       = int(os.getenv('VECTOR_STORE_DIMS' , 0                     ))
+vector_store_projection = os.getenv('VECTOR_STORE_PROJECTION', 'pca'                )
+# Projection of the vectors of the ES indices, written by the ingestion with `--dims` (empty if not reduced)
+es_projection_path      = os.getenv('ES_PROJECTION_PATH', ''                        )
+
+# Inference backend of the embedding model - 'torch' (fp32, as the ingested vectors), 'torch-int8'
+# (dynamically quantised linear layers), 'onnx' or 'onnx-int8' (ONNX Runtime, exported into the model
+# cache on first use). A backend whose cosine with the fp32 vectors of the hardcoded queries falls
+# below `embed_parity_threshold` is not compatible with the ingested data and torch is used instead.
+embed_backend           = os.getenv('EMBED_BACKEND'             , 'torch')
+embed_parity_threshold  = float(os.getenv('EMBED_PARITY_THRESHOLD', 0.98 ))
+
+# Embedding inference pool ('thread' or 'process')
+embed_executor      = os.getenv('EMBED_EXECUTOR'    , 'thread'  )
+embed_workers       = int(os.getenv('EMBED_WORKERS'     , 2     ))
+embed_queue_size    = int(os.getenv('EMBED_QUEUE_SIZE'  , 16    ))
+embed_timeout       = float(os.getenv('EMBED_TIMEOUT'   , 10.0  ))
+# Micro-batching of concurrent queries (batch size 1 disables it, window in ms)
+embed_batch_size    = int(os.getenv('EMBED_BATCH_SIZE'  , 16    ))
+embed_batch_window  = float(os.getenv('EMBED_BATCH_WINDOW', 5.0 ))
+# Cache of query embeddings (size 0 disables it, the size bounds both the memory of every process and the
+# shared local backend, TTL 0 means no expiry, path enables the shared local backend)
+embed_cache_size    = int(os.getenv('EMBED_CACHE_SIZE'  , 10000 ))
+embed_cache_ttl     = float(os.getenv('EMBED_CACHE_TTL' , 0     ))
+embed_cache_path    = os.getenv('EMBED_CACHE_PATH'      , ''    )
+# Cache of search results (size 0 disables it, bounds the backend too), invalidated when the combined index generation changes
+es_result_cache_size    = int(os.getenv('ES_RESULT_CACHE_SIZE'  , 1000  ))
+es_result_cache_ttl     = float(os.getenv('ES_RESULT_CACHE_TTL' , 3600  ))
+es_result_cache_path    = os.getenv('ES_RESULT_CACHE_PATH'      , ''    )
+es_generation_ttl       = 30
+
+# Chat logs - saved by a background writer in `_bulk` batches of up to `chat_log_batch_size` conversations at
+# least every `chat_log_flush_interval` seconds, retried `chat_log_max_retries` times with exponential backoff
+# from `chat_log_backoff` seconds. The conversations that could not be saved (or did not fit into the queue of
+# `chat_log_queue_size`) are appended to the journal (per process, `chat_log_journal_path`.<pid>) and saved
+# once ES is available again.
+chat_log_queue_size     = int(os.getenv('CHAT_LOG_QUEUE_SIZE'       , 1000  ))
+chat_log_batch_size     = int(os.getenv('CHAT_LOG_BATCH_SIZE'       , 100   ))
+chat_log_flush_interval = float(os.getenv('CHAT_LOG_FLUSH_INTERVAL' , 2.0   ))
+chat_log_max_retries    = int(os.getenv('CHAT_LOG_MAX_RETRIES'      , 3     ))
+chat_log_backoff        = float(os.getenv('CHAT_LOG_BACKOFF'        , 0.5   ))
+chat_log_journal_path   = os.getenv('CHAT_LOG_JOURNAL_PATH'         , '/var/tmp/chat_logs.journal')
+# Incremental chat logs - number of tracker events already exported per conversation (kept for
+# `chat_log_offsets_ttl` seconds), so only the new events are parsed and appended to the stored chat
+chat_log_offsets_size   = int(os.getenv('CHAT_LOG_OFFSETS_SIZE'     , 10000 ))
+chat_log_offsets_ttl    = float(os.getenv('CHAT_LOG_OFFSETS_TTL'    , 86400 ))
+chat_log_offsets        = LRUCache(maxsize = chat_log_offsets_size, ttl = chat_log_offsets_ttl or None)
+
+# ES client - connection pool size (per host), default timeout of the requests (s),
+# timeout of the search requests (s) and retries of failed requests
+es_pool_maxsize         = int(os.getenv('ES_POOL_MAXSIZE'       , 10    ))
+es_timeout              = float(os.getenv('ES_TIMEOUT'          , 10.0  ))
+es_search_timeout       = float(os.getenv('ES_SEARCH_TIMEOUT'   , 5.0   ))
+es_max_retries          = int(os.getenv('ES_MAX_RETRIES'        , 3     ))
+es_retry_on_timeout     = os.getenv('ES_RETRY_ON_TIMEOUT', 'false').lower() == 'true'
+
+# Hardcoded queries
 es_cut_off_hardcoded    = es_cut_off + 0.2
 es_hardcoded_threshold  = 0.85
-try:
-    with open(os.path.join(os.path.dirname(__file__), 'scripts/hardcoded/transformed/hardcoded.pickle'), 'rb') as handle:
-        hardcoded_queries = pickle.load(handle)
-    logger.info('Successfully loaded hardcoded queries')
-except IOError:
-    logger.info('Failed loading hardcoded queries')
-logger.info(f'- cut off parameter for hardcoded queries     = {es_cut_off_hardcoded:.2f}'   )
-logger.info(f'- cut off parameter for similarity threshold  = {es_hardcoded_threshold:.2f}' )
-logger.info('----------------------------------------------')
+es_hardcoded_top_k      = 1
+# Use the vector of the search query for the hardcoded queries lookup as well (one encode per question)
+es_hardcoded_shared_vector = os.getenv('ES_HARDCODED_SHARED_VECTOR', 'false').lower() == 'true'
+
+# Lazy initialisation - the synonyms, the hardcoded queries, the ES client with the retriever and the
+# embedding model are loaded on first access of their attributes (see `__getattr__`), or all of them in
+# the background by `start_warm_up` (started with the actions server if `warm_up_on_start`), so the
+# lightweight actions are served while the model loads. `ready` is set, and `ready_file` created for the
+# readiness probe of the container, once everything is loaded and a dummy encode has run.
+warm_up_on_start    = os.getenv('WARM_UP_ON_START'  , 'true'                ).lower() == 'true'
+ready_file          = os.getenv('READY_FILE'        , '/tmp/actions_ready'  )
+ready               = threading.Event()
+
+# Preforked serving (python -m actions.es.serve) - number of action server workers forked after the model and
+# the data are loaded (sharing them copy-on-write), their ports behind the router on `serve_port`, and the
+# torch threads of each worker (0 - cores divided among the workers)
+serve_workers       = int(os.getenv('SERVE_WORKERS'     , 1     ))
+serve_port          = int(os.getenv('SERVE_PORT'        , 5055  ))
+serve_worker_port   = int(os.getenv('SERVE_WORKER_PORT' , 5100  ))
+serve_threads       = int(os.getenv('SERVE_THREADS'     , 0     ))
+
+# Latency metrics - histograms (with `metrics_buckets` in seconds) of the stages of the search pipeline and of
+# the actions, served in the Prometheus text format on `metrics_host`:`metrics_port` (0 - no endpoint, the router
+# of the preforked server serves the sum of its workers on `/metrics`, multiple sanic workers serve none). If `metrics_otel` is set, the stages are
+# also traced as OpenTelemetry spans under the span of the action, with the `sender_id` of the conversation
+# (needs opentelemetry-api, exported over OTLP if opentelemetry-sdk with the exporter is installed and no
+# tracer provider is set up already, configured by the OTEL_* environment variables)
+metrics_enabled     = os.getenv('METRICS_ENABLED'   , 'true'    ).lower() == 'true'
+metrics_host        = os.getenv('METRICS_HOST'      , '0.0.0.0' )
+metrics_port        = int(os.getenv('METRICS_PORT'  , 9100      ))
+metrics_otel        = os.getenv('METRICS_OTEL'      , 'false'   ).lower() == 'true'
+metrics_buckets     = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
 
 if debug:
 
@@ -101,13 +211,19 @@ if debug:
     logger.info(f'- es_cut_off      = {es_cut_off}')
     logger.info(f'- es_top_n        = {es_top_n}')
     logger.info(f'- es_ask_weight   = {es_ask_weight}')
+    logger.info(f'- es_retrieval    = {es_retrieval}')
+    logger.info(f'- es_slots_parallel = {es_slots_parallel}')
+    logger.info(f'- es_slots_weight   = {es_slots_weight}')
+    logger.info(f'- es_session_cache_size  = {es_session_cache_size}')
+    logger.info(f'- es_followup_weight     = {es_followup_weight}')
+    logger.info(f'- es_followup_confidence = {es_followup_confidence}')
+    logger.info(f'- es_partitioned    = {es_partitioned}')
+    logger.info(f'- metrics_port      = {metrics_port}')
+    logger.info(f'- metrics_otel      = {metrics_otel}')
     logger.info('----------------------------------------------')
 
 if not es_imitate:
 
-    # import tensorflow_hub as tf_hub
-    from sentence_transformers import SentenceTransformer
-
     logger.info('----------------------------------------------')
     logger.info('Elasticsearch configuration:')
     logger.info(f'- host                = {es_host          }')
@@ -116,28 +232,375 @@ if not es_imitate:
         logger.info(f'- password            = {es_password  }')
     logger.info(f'- embed_url           = {embed_url        }')
     logger.info(f'- embed_cache_dir     = {embed_cache_dir  }')
+    logger.info(f'- embed_backend       = {embed_backend    }')
+    logger.info(f'- embed_executor      = {embed_executor   }')
+    logger.info(f'- embed_workers       = {embed_workers    }')
+    logger.info(f'- embed_queue_size    = {embed_queue_size }')
+    logger.info(f'- embed_timeout       = {embed_timeout    }')
+    logger.info(f'- embed_batch_size    = {embed_batch_size }')
+    logger.info(f'- embed_batch_window  = {embed_batch_window}')
+    logger.info(f'- embed_cache_size    = {embed_cache_size }')
+    logger.info(f'- embed_cache_ttl     = {embed_cache_ttl  }')
+    logger.info(f'- embed_cache_path    = {embed_cache_path }')
+    logger.info(f'- result_cache_size   = {es_result_cache_size}')
+    logger.info(f'- result_cache_ttl    = {es_result_cache_ttl }')
+    logger.info(f'- result_cache_path   = {es_result_cache_path}')
+    logger.info(f'- pool_maxsize        = {es_pool_maxsize  }')
+    logger.info(f'- timeout             = {es_timeout       }')
+    logger.info(f'- search_timeout      = {es_search_timeout}')
+    logger.info(f'- max_retries         = {es_max_retries   }')
+    logger.info(f'- retry_on_timeout    = {es_retry_on_timeout}')
+    logger.info(f'- warm_up_on_start    = {warm_up_on_start }')
+    logger.info(f'- chat_log_batch_size = {chat_log_batch_size}')
+    logger.info(f'- chat_log_flush_interval = {chat_log_flush_interval}')
+    logger.info(f'- chat_log_journal_path   = {chat_log_journal_path}')
     logger.info('----------------------------------------------')
 
     logger.info('----------------------------------------------')
     logger.info('Elasticsearch indexes:')
     logger.info(f'- combined index      = {es_combined_index}'  )
+    logger.info(f'- chunk index         = {es_chunk_index}'     )
+    logger.info(f'- vector store        = {vector_store_path}'  )
+    logger.info(f'- projection          = {es_projection_path}' )
     logger.info(f'- logging index       = {es_logging_index}'   )
     logger.info('----------------------------------------------')
+else:
+    logger.info('----------------------------------------------')
+    logger.info('Imitating Elasticseach queries for dev purposes')
+    logger.info('----------------------------------------------')
+
+
+def _load_synonyms() -> None:
+    global tokenizer, synonym_dict
+
+    from spacy.lang.en import English
+
+    logger.info('----------------------------------------------')
+    logger.info('Loading synonym procedure')
+    tokenizer = English().tokenizer
+    synonyms = {}
+    try:
+        with open(os.path.join(os.path.dirname(__file__), 'scripts/synonym_list/transformed/synonym_pest.pickle'), 'rb') as handle:
+            synonyms = pickle.load(handle)
+        logger.info('Successfully loaded synonym list')
+    except IOError:
+        logger.info('Failed loading synonym list')
+    synonym_dict = synonyms
+    logger.info('----------------------------------------------')
+
+
+def _load_hardcoded() -> None:
+    global hardcoded_queries, hardcoded_matrix
+
+    logger.info('----------------------------------------------')
+    logger.info('Loading hardcoded queries')
+    queries = []
+    try:
+        with open(os.path.join(os.path.dirname(__file__), 'scripts/hardcoded/transformed/hardcoded.pickle'), 'rb') as handle:
+            queries = pickle.load(handle)
+        logger.info('Successfully loaded hardcoded queries')
+    except IOError:
+        logger.info('Failed loading hardcoded queries')
+
+    # Hardcoded query vectors as a contiguous L2-normalised matrix (one row per query)
+    matrix = np.zeros((0, 0), dtype = np.float32)
+    if len(queries) > 0:
+        matrix = np.ascontiguousarray([h['vector'] for h in queries], dtype = np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis = 1, keepdims = True), 1e-12)
+    hardcoded_matrix    = matrix
+    hardcoded_queries   = queries
+    logger.info(f'- number of hardcoded queries                 = {len(queries)}'               )
+    logger.info(f'- cut off parameter for hardcoded queries     = {es_cut_off_hardcoded:.2f}'   )
+    logger.info(f'- cut off parameter for similarity threshold  = {es_hardcoded_threshold:.2f}' )
+    logger.info(f'- shared vector for hardcoded queries lookup  = {es_hardcoded_shared_vector}' )
+    logger.info(f'- number of hardcoded queries to match        = {es_hardcoded_top_k}'         )
+    logger.info('----------------------------------------------')
+
+
+def supports_knn() -> bool:
+    '''Check if the ES server supports the approximate kNN search (assumed if the server is not reachable).'''
+    from elasticsearch import Elasticsearch, TransportError
+
+    client = Elasticsearch([es_host], http_auth=(es_username, es_password), timeout = es_timeout)
+    try:
+        version = server_version(client)
+    except TransportError as e:
+        logger.warning(f'Failed getting the version of ES, assuming it supports kNN search - {e}')
+        return True
+    finally:
+        client.close()
+
+    if version < knn_min_version:
+        logger.warning(
+            f'ES {".".join(map(str, version))} does not support kNN search '
+            f'(needs {".".join(map(str, knn_min_version))}+)')
+        return False
+    return True
+
+
+def _load_es() -> None:
+    global es_client, es_projection, retriever
+
+    from elasticsearch import AsyncElasticsearch
 
     logger.info('Initializing the Elasticsearch client')
-    es_client = AsyncElasticsearch(
-        [es_host], http_auth=(es_username, es_password))
+    client = AsyncElasticsearch(
+        [es_host], http_auth=(es_username, es_password),
+        maxsize             = es_pool_maxsize       ,
+        timeout             = es_timeout            ,
+        max_retries         = es_max_retries        ,
+        retry_on_timeout    = es_retry_on_timeout   )
     logger.info('Done initiliazing ElasticSearch client')
 
-    logger.info(f'Start loading embedding module - {embed_url}')
+    projection = None
+    if es_projection_path:
+        try:
+            projection = Projection.load(es_projection_path)
+            logger.info(f'Loaded projection of the ES vectors - {projection.method} to {projection.dims} dims ({projection.id})')
+            if projection.centred:
+                logger.warning('The projection of the ES vectors is centred, its cosine scores do not match the cut-offs - refit it and re-ingest')
+        except IOError:
+            logger.error(f'Failed loading projection of the ES vectors - {es_projection_path}')
+
+    search = None
+    if es_retrieval == 'local':
+        logger.info(f'Opening vector store - {vector_store_path}')
+        try:
+            store = VectorStore.open(vector_store_path)
+            if store.model != embed_url:
+                logger.warning(f'Vector store was embedded with {store.model}, but the embedding module is {embed_url}')
+            if store.projection is not None and store.projection.centred:
+                logger.warning('The projection of the vector store is centred, its cosine scores do not match the cut-offs - write it again')
+            search = LocalRetriever(store, path = vector_store_path, generation_ttl = es_generation_ttl)
+            logger.info(f'Done opening vector store - {len(store)} documents, {store.vectors.shape[0]} chunks ({store.vectors.dtype}, {store.vectors.shape[1]} dims)')
+        except IOError:
+            logger.error(f'Failed opening vector store - {vector_store_path}, falling back to ES script retrieval')
+    elif es_retrieval == 'knn' and not supports_knn():
+        logger.error('Falling back to ES script retrieval')
+    elif es_retrieval == 'knn':
+        search = ESKnnRetriever(
+            client          = client                ,
+            index           = es_combined_index     ,
+            chunk_index     = es_chunk_index        ,
+            num_candidates  = es_knn_num_candidates ,
+            chunks_per_doc  = es_knn_chunks_per_doc ,
+            generation_ttl  = es_generation_ttl     ,
+            request_timeout = es_search_timeout     ,
+            projection      = projection            )
+    if search is None:
+        search = ESScriptRetriever(
+            client          = client                ,
+            index           = es_combined_index     ,
+            generation_ttl  = es_generation_ttl     ,
+            request_timeout = es_search_timeout     ,
+            projection      = projection            )
+
+    es_projection   = projection
+    retriever       = search
+    es_client       = client
+
+
+def _load_chat_logs() -> None:
+    global chat_log_writer
+
+    from actions.es.logs import ChatLogWriter
+
+    chat_log_writer = ChatLogWriter(
+        client          = _get('es_client')         ,
+        index           = es_logging_index          ,
+        queue_size      = chat_log_queue_size       ,
+        batch_size      = chat_log_batch_size       ,
+        flush_interval  = chat_log_flush_interval   ,
+        max_retries     = chat_log_max_retries      ,
+        backoff         = chat_log_backoff          ,
+        journal_path    = chat_log_journal_path     ,
+        request_timeout = es_timeout                )
+
+
+def _load_embed() -> None:
+    global embed, embed_backend, embed_cache, es_result_cache, es_session_cache, embed_service
+
+    backend = embed_backend
+    logger.info(f'Start loading embedding module - {embed_url} ({backend})')
+    # import tensorflow_hub as tf_hub
     # embed = tf_hub.load(embed_url)
-    embed = SentenceTransformer(
-        model_name_or_path  = embed_url         ,
-        cache_folder        = embed_cache_dir   ,
-        device              = 'cpu'             )
-    logger.info(f'Done loading embedding module - {embed_url}')
-    # -------------------------------------------------------------
-else:
-    logger.info('----------------------------------------------')
-    logger.info('Imitating Elasticseach queries for dev purposes')
-    logger.info('----------------------------------------------')
+    queries     = _get('hardcoded_queries')
+    reference   = None
+    try:
+        if backend == 'torch-int8' and len(queries) > 0:
+            # keep the fp32 model until the parity is checked, so falling back to it does not load it again
+            reference   = load_model(embed_url, embed_cache_dir)
+            model       = quantize_model(reference)
+        else:
+            model = load_model(
+                model_name      = embed_url         ,
+                cache_folder    = embed_cache_dir   ,
+                backend         = backend           )
+    except ImportError as e:
+        if backend == 'torch':
+            raise
+        logger.error(f'Failed loading the {backend} backend, falling back to torch - {e}')
+        backend = 'torch'
+        model   = load_model(embed_url, embed_cache_dir)
+    if backend != 'torch' and len(queries) > 0:
+        parity = check_parity(model, [h['question_stop_words'] for h in queries], _get('hardcoded_matrix'))
+        logger.info(f'Parity of {backend} with the fp32 vectors - mean cosine {parity.mean():.4f}, min {parity.min():.4f}')
+        if parity.min() < embed_parity_threshold:
+            logger.error(
+                f'Vectors of {backend} are not compatible with the ingested data (min cosine below {embed_parity_threshold}), '
+                f'falling back to torch')
+            backend = 'torch'
+            model   = reference if reference is not None else load_model(embed_url, embed_cache_dir)
+    reference = None
+    logger.info(f'Done loading embedding module - {embed_url} ({backend})')
+
+    embed_cache_backend = None
+    if embed_cache_path:
+        embed_cache_backend = SqliteCache(path = embed_cache_path, maxsize = embed_cache_size, ttl = embed_cache_ttl or None)
+
+    vector_cache = None
+    if embed_cache_size > 0:
+        vector_cache = LRUCache(
+            maxsize = embed_cache_size          ,
+            ttl     = embed_cache_ttl or None   ,
+            backend = embed_cache_backend       )
+
+    result_cache = None
+    if es_result_cache_size > 0:
+        es_result_cache_backend = None
+        if es_result_cache_path:
+            es_result_cache_backend = SqliteCache(path = es_result_cache_path, maxsize = es_result_cache_size, ttl = es_result_cache_ttl or None)
+        result_cache = LRUCache(
+            maxsize = es_result_cache_size          ,
+            ttl     = es_result_cache_ttl or None   ,
+            backend = es_result_cache_backend       )
+
+    # query vectors and candidates of the conversations, for the follow-up refinement (in memory, the
+    # requests of a conversation are served by the same process)
+    session_cache = None
+    if es_session_cache_size > 0:
+        session_cache = LRUCache(
+            maxsize = es_session_cache_size     ,
+            ttl     = es_session_ttl or None    )
+
+    service = EmbedService(
+        model           = model             ,
+        model_name      = embed_url         ,
+        cache_folder    = embed_cache_dir   ,
+        executor        = embed_executor    ,
+        workers         = embed_workers     ,
+        queue_size      = embed_queue_size  ,
+        timeout         = embed_timeout     ,
+        batch_size      = embed_batch_size  ,
+        batch_window    = embed_batch_window,
+        cache           = vector_cache      ,
+        backend         = backend           )
+
+    embed_backend       = backend
+    embed_cache         = vector_cache
+    es_result_cache     = result_cache
+    es_session_cache    = session_cache
+    embed               = model
+    embed_service       = service
+
+
+# Loaders of the lazy attributes, the ES client and the model are not loaded when imitating ES
+_loaders = {
+    'tokenizer'         : _load_synonyms    ,
+    'synonym_dict'      : _load_synonyms    ,
+    'hardcoded_queries' : _load_hardcoded   ,
+    'hardcoded_matrix'  : _load_hardcoded   ,
+}
+if not es_imitate:
+    _loaders.update({
+        'es_client'         : _load_es      ,
+        'es_projection'     : _load_es      ,
+        'retriever'         : _load_es      ,
+        'chat_log_writer'   : _load_chat_logs,
+        'embed'             : _load_embed   ,
+        'embed_cache'       : _load_embed   ,
+        'es_result_cache'   : _load_embed   ,
+        'es_session_cache'  : _load_embed   ,
+        'embed_service'     : _load_embed   ,
+    })
+# one lock per loader, so i.e. the ES client is not waiting for the model
+_locks          = {loader: threading.RLock() for loader in set(_loaders.values())}
+_warm_up_lock   = threading.Lock()
+_warm_up_thread = None
+
+
+def __getattr__(name: str):
+    '''Load the lazy attribute on first access (blocks until it is loaded).'''
+    loader = _loaders.get(name)
+    if loader is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    with _locks[loader]:
+        if name not in globals():
+            loader()
+    return globals()[name]
+
+
+def _get(name: str):
+    '''Get the lazy attribute from within the module (where `__getattr__` is not involved).'''
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+def load() -> None:
+    '''Load all the lazy attributes (without running the model).'''
+    for name in ['synonym_dict', 'hardcoded_queries'] + ([] if es_imitate else ['retriever', 'embed_service']):
+        _get(name)
+
+
+def warm_up() -> None:
+    '''Load all the lazy attributes and run a dummy encode, then signal the readiness.'''
+    start = time.monotonic()
+    load()
+    if not es_imitate:
+        _get('embed_service').encode_sync(['warm up'])
+
+    ready.set()
+    if ready_file:
+        with open(ready_file, 'w') as f:
+            f.write(str(os.getpid()))
+    logger.info(f'Warmed up in {time.monotonic() - start:.1f} s - ready')
+
+
+def _warm_up_background() -> None:
+    try:
+        warm_up()
+    except Exception:
+        logger.exception('Failed warming up')
+
+
+def start_warm_up() -> None:
+    '''Start `warm_up` in a background thread (once per process).'''
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is not None:
+            return
+        if ready_file and os.path.isfile(ready_file):
+            os.remove(ready_file)
+        _warm_up_thread = threading.Thread(target = _warm_up_background, name = 'warm-up', daemon = True)
+        _warm_up_thread.start()
+
+
+async def shutdown() -> None:
+    '''Save the queued chat logs while the event loop still runs (see `ChatLogWriter.stop`).'''
+    if 'chat_log_writer' in globals():
+        await chat_log_writer.stop()
+
+
+async def wait_ready(timeout: float) -> bool:
+    '''Wait without blocking the event loop until warmed up (starting the warm up if needed).
+
+    Args:
+        timeout (float): Seconds to wait.
+
+    Returns:
+        bool: If warmed up.
+    '''
+    if ready.is_set():
+        return True
+    start_warm_up()
+    return await asyncio.get_event_loop().run_in_executor(None, ready.wait, timeout)
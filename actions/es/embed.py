@@ -0,0 +1,551 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import resource
+
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from actions.es.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Model used by the worker processes of the process pool. When the pool is
+# forked after the model is loaded in the parent, the workers inherit it.
+_model = None
+
+# Inference backends of the embedding model
+embed_backends = ['torch', 'torch-int8', 'onnx', 'onnx-int8']
+
+
+class EmbedServiceBusy(Exception):
+    '''Raised when the inference queue is full or the encode timed out.'''
+
+
+class OnnxModel:
+    '''SentenceTransformer model run with ONNX Runtime, with the same `encode` interface.
+
+    The transformer is exported to ONNX (and optionally quantised to int8)
+    into the model cache on first use, together with the tokenizer and the
+    pooling settings, so later loads need neither torch nor the weights.
+    '''
+
+    def __init__(
+        self,
+        model_name      : str           ,
+        cache_folder    : str           ,
+        quantize        : bool = False
+        ) -> None:
+
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError('The onnx embedding backends need onnxruntime and onnx (see actions/requirements-update.txt)')
+        from transformers import AutoTokenizer
+
+        folder = os.path.join(cache_folder, 'onnx', model_name.replace('/', '__'))
+        if not os.path.isfile(os.path.join(folder, 'pooling.json')):
+            _export_onnx(model_name, cache_folder, folder)
+
+        path = os.path.join(folder, 'model.onnx')
+        if quantize:
+            path = os.path.join(folder, 'model-int8.onnx')
+            if not os.path.isfile(path):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                quantize_dynamic(os.path.join(folder, 'model.onnx'), path + '.tmp', weight_type = QuantType.QInt8)
+                os.replace(path + '.tmp', path)
+
+        with open(os.path.join(folder, 'pooling.json')) as f:
+            pooling = json.load(f)
+
+        self.tokenizer      = AutoTokenizer.from_pretrained(folder)
+        self.pooling        = pooling['pooling']
+        self.normalize      = pooling['normalize']
+        self.dims           = pooling['dims']
+        self.max_seq_length = pooling['max_seq_length']
+        self.session        = ort.InferenceSession(path, providers = ['CPUExecutionProvider'])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dims
+
+    def encode(
+        self,
+        texts               : List[str] ,
+        batch_size          : int = 32  ,
+        show_progress_bar   : bool = False
+        ) -> np.ndarray:
+        '''Encode the texts (same pooling and normalisation as the SentenceTransformer model).'''
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            features = self.tokenizer(
+                list(texts[i:i + batch_size]), padding = True, truncation = True,
+                max_length = self.max_seq_length, return_tensors = 'np')
+            mask    = features['attention_mask'].astype(np.int64)
+            tokens  = self.session.run(None, {'input_ids': features['input_ids'].astype(np.int64), 'attention_mask': mask})[0]
+
+            mask = mask[..., None].astype(np.float32)
+            if self.pooling == 'cls':
+                v = tokens[:, 0]
+            elif self.pooling == 'max':
+                v = np.where(mask > 0, tokens, -1e9).max(axis = 1)
+            else:
+                v = (tokens * mask).sum(axis = 1) / np.maximum(mask.sum(axis = 1), 1e-9)
+            if self.normalize:
+                v = v / np.maximum(np.linalg.norm(v, axis = 1, keepdims = True), 1e-12)
+            vectors.append(v.astype(np.float32))
+
+        return np.concatenate(vectors) if vectors else np.zeros((0, self.dims), dtype = np.float32)
+
+
+def _export_onnx(
+    model_name      : str,
+    cache_folder    : str,
+    folder          : str
+    ) -> None:
+    '''Export the transformer of the SentenceTransformer model to ONNX, with its tokenizer and pooling settings.'''
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize
+
+    logger.info(f'Exporting {model_name} to ONNX - {folder}')
+    model = SentenceTransformer(model_name_or_path = model_name, cache_folder = cache_folder, device = 'cpu')
+
+    class _Transformer(torch.nn.Module):
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            return self.transformer(input_ids = input_ids, attention_mask = attention_mask)[0]
+
+    os.makedirs(folder, exist_ok = True)
+    features = model.tokenizer(['export of the model'], return_tensors = 'pt')
+    torch.onnx.export(
+        _Transformer(model[0].auto_model).eval()                    ,
+        (features['input_ids'], features['attention_mask'])         ,
+        os.path.join(folder, 'model.onnx.tmp')                      ,
+        input_names     = ['input_ids', 'attention_mask']           ,
+        output_names    = ['token_embeddings']                      ,
+        dynamic_axes    = {
+            'input_ids'         : {0: 'batch', 1: 'sequence'},
+            'attention_mask'    : {0: 'batch', 1: 'sequence'},
+            'token_embeddings'  : {0: 'batch', 1: 'sequence'}}      ,
+        opset_version   = 13                                        )
+    os.replace(os.path.join(folder, 'model.onnx.tmp'), os.path.join(folder, 'model.onnx'))
+    model.tokenizer.save_pretrained(folder)
+
+    pooling = model[1].get_pooling_mode_str()
+    with open(os.path.join(folder, 'pooling.json'), 'w') as f:
+        json.dump({
+            'pooling'           : 'mean' if pooling.startswith('mean') else pooling ,
+            'normalize'         : any(isinstance(m, Normalize) for m in model)      ,
+            'dims'              : model.get_sentence_embedding_dimension()          ,
+            'max_seq_length'    : model.max_seq_length                              ,
+        }, f)
+
+
+def load_model(
+    model_name      : str           ,
+    cache_folder    : str           ,
+    backend         : str = 'torch'
+    ):
+    '''Load the embedding model with the inference backend.
+
+    Backends:
+        torch       - SentenceTransformer in fp32 (the vectors of the ingested data)
+        torch-int8  - SentenceTransformer with dynamically int8-quantised linear layers
+        onnx        - ONNX Runtime (fp32)
+        onnx-int8   - ONNX Runtime with dynamically int8-quantised weights
+
+    The backends other than `torch` approximate the fp32 vectors, check them
+    with `check_parity` before querying the ingested data with them.
+
+    Args:
+        model_name      (str): Name of the SentenceTransformer model.
+        cache_folder    (str): Folder with cached models.
+        backend         (str): Inference backend. Defaults to 'torch'.
+
+    Returns:
+        Model with the `encode` method of SentenceTransformer.
+    '''
+    if backend not in embed_backends:
+        raise ValueError(f'Unknown embedding backend - {backend}')
+
+    if backend.startswith('onnx'):
+        return OnnxModel(model_name, cache_folder, quantize = backend == 'onnx-int8')
+
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(
+        model_name_or_path  = model_name    ,
+        cache_folder        = cache_folder  ,
+        device              = 'cpu'         )
+    if backend == 'torch-int8':
+        model = quantize_model(model, inplace = True)
+
+    return model
+
+
+def quantize_model(model, inplace: bool = False):
+    '''Quantise the linear layers of the SentenceTransformer model to int8 dynamically (the `torch-int8` backend).
+
+    Args:
+        model           : SentenceTransformer model (fp32).
+        inplace (bool)  : Quantise the model itself instead of a copy. Defaults to False.
+
+    Returns:
+        Quantised model.
+    '''
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype = torch.qint8, inplace = inplace)
+
+
+def check_parity(
+    model                   ,
+    texts       : List[str] ,
+    reference   : np.ndarray
+    ) -> np.ndarray:
+    '''Cosine similarity of the vectors of the model with the reference vectors of the texts.
+
+    Args:
+        model                   : Embedding model (see `load_model`).
+        texts       (List[str]) : Texts.
+        reference   (np.ndarray): Reference vectors of the texts (i.e. of the fp32 model), one row per text.
+
+    Returns:
+        np.ndarray: Cosine similarity for every text.
+    '''
+    vectors     = np.asarray(model.encode(list(texts), show_progress_bar = False), dtype = np.float32)
+    reference   = np.asarray(reference, dtype = np.float32)
+    vectors     = vectors   / np.maximum(np.linalg.norm(vectors  , axis = 1, keepdims = True), 1e-12)
+    reference   = reference / np.maximum(np.linalg.norm(reference, axis = 1, keepdims = True), 1e-12)
+    return (vectors * reference).sum(axis = 1)
+
+
+def benchmark_backend(
+    model_name      : str       ,
+    cache_folder    : str       ,
+    backend         : str       ,
+    texts           : List[str] ,
+    batch_size      : int = 16
+    ) -> Tuple[np.ndarray, dict]:
+    '''Measure the load time, latency, throughput and peak memory of the backend (run it in a fresh process).
+
+    Args:
+        model_name      (str)       : Name of the SentenceTransformer model.
+        cache_folder    (str)       : Folder with cached models.
+        backend         (str)       : Inference backend.
+        texts           (List[str]) : Texts to encode.
+        batch_size      (int)       : Batch size of the throughput measurement. Defaults to 16.
+
+    Returns:
+        Tuple[np.ndarray, dict]: Vectors of the texts and the measurements.
+    '''
+    start   = time.perf_counter()
+    model   = load_model(model_name, cache_folder, backend)
+    load    = time.perf_counter() - start
+
+    model.encode(texts[:1], show_progress_bar = False)
+    latencies = []
+    for t in texts:
+        start = time.perf_counter()
+        model.encode([t], show_progress_bar = False)
+        latencies.append(time.perf_counter() - start)
+
+    start   = time.perf_counter()
+    vectors = np.asarray(model.encode(texts, batch_size = batch_size, show_progress_bar = False), dtype = np.float32)
+    batched = time.perf_counter() - start
+
+    return vectors, {
+        'backend'       : backend                                                       ,
+        'load_s'        : load                                                          ,
+        'latency_ms'    : np.percentile(np.array(latencies) * 1000, [50, 95]).tolist()  ,
+        'throughput'    : len(texts) / batched                                          ,
+        'max_rss_mb'    : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024     ,
+    }
+
+
+def _init_worker(
+    model_name      : str,
+    cache_folder    : str,
+    backend         : str = 'torch'
+    ) -> None:
+    '''Load the embedding model in the process pool worker (if not inherited).
+
+    Args:
+        model_name      (str): Name of the SentenceTransformer model.
+        cache_folder    (str): Folder with cached models.
+        backend         (str): Inference backend (see `load_model`). Defaults to 'torch'.
+    '''
+    global _model
+    if _model is None:
+        _model = load_model(model_name, cache_folder, backend)
+
+
+def _encode_worker(texts: List[str]) -> np.ndarray:
+    '''Encode the texts with the model of the process pool worker.'''
+    return _model.encode(texts, show_progress_bar = False)
+
+
+class EmbedService:
+    '''Embedding service running the model inference off the event loop.
+
+    The inference is executed in a thread or process pool. The number of
+    requests that are either running or waiting for a worker is bounded by
+    `workers * batch_size + queue_size`, requests above that bound are
+    rejected straight away instead of queueing behind everyone else, and
+    every request is limited by `timeout` seconds.
+
+    If `batch_size` is greater than one, the texts of concurrent requests
+    are collected for up to `batch_window` milliseconds (or until the batch
+    is full) and encoded together in a single call of the model.
+
+    If `cache` is given, the vectors are cached by model name, backend and
+    text (with whitespace normalised), and only the texts missing in the
+    cache are encoded.
+    '''
+
+    def __init__(
+        self,
+        model                       ,
+        model_name      : str       ,
+        cache_folder    : str       ,
+        executor        : str = 'thread',
+        workers         : int = 2   ,
+        queue_size      : int = 16  ,
+        timeout         : float = 10.0,
+        batch_size      : int = 1   ,
+        batch_window    : float = 5.0,
+        cache           : LRUCache = None,
+        backend         : str = 'torch'
+        ) -> None:
+
+        if executor not in ['thread', 'process']:
+            raise ValueError(f'Unknown executor type for embedding service - {executor}')
+
+        self.model          = model
+        self.model_name     = model_name
+        self.cache_folder   = cache_folder
+        self.executor       = executor
+        self.workers        = workers
+        self.queue_size     = queue_size
+        self.timeout        = timeout
+        self.batch_size     = max(1, batch_size)
+        self.batch_window   = batch_window / 1000
+        self.cache          = cache
+        self.backend        = backend
+
+        self._pool          = None
+        self._slots         = None
+        self._queue         = None
+        self._free_workers  = None
+        self._collector     = None
+
+        # batch fill metrics, `batch_fill[n]` is the number of batches of size n
+        self.batches        = 0
+        self.batched_texts  = 0
+        self.batch_fill     = [0] * (self.batch_size + 1)
+
+        if self.executor == 'process':
+            global _model
+            _model = model
+
+    def _get_pool(self):
+        '''Create the worker pool on first use (after any fork of the server).'''
+        if self._pool is None:
+            if self.executor == 'process':
+                self._pool = ProcessPoolExecutor(
+                    max_workers = self.workers      ,
+                    initializer = _init_worker      ,
+                    initargs    = (self.model_name, self.cache_folder, self.backend))
+            else:
+                self._pool = ThreadPoolExecutor(
+                    max_workers         = self.workers  ,
+                    thread_name_prefix  = 'embed'       )
+        return self._pool
+
+    def _start(self) -> None:
+        '''Create the asyncio primitives in the loop of the running server.'''
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers * self.batch_size + self.queue_size)
+        if self.batch_size > 1 and self._collector is None:
+            self._queue         = asyncio.Queue()
+            self._free_workers  = asyncio.Semaphore(self.workers)
+            self._collector     = asyncio.ensure_future(self._collect())
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, show_progress_bar = False)
+
+    def _run_in_pool(self, texts: List[str]) -> asyncio.Future:
+        loop    = asyncio.get_event_loop()
+        fn      = _encode_worker if self.executor == 'process' else self._encode
+        return loop.run_in_executor(self._get_pool(), fn, list(texts))
+
+    async def _collect(self) -> None:
+        '''Gather the queued texts into batches and dispatch them to the pool.'''
+        loop = asyncio.get_event_loop()
+        while True:
+            batch       = [await self._queue.get()]
+            deadline    = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout = timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._free_workers.acquire()
+
+            # top up with whatever arrived while waiting for a free worker
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # skip the requests that already timed out
+            batch = [(t, f) for t, f in batch if not f.done()]
+            if len(batch) == 0:
+                self._free_workers.release()
+                continue
+
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        '''Encode a collected batch and hand every caller its own vector.'''
+        try:
+            vectors = await self._run_in_pool([t for t, _ in batch])
+        except Exception as e:
+            for _, f in batch:
+                if not f.done(): f.set_exception(e)
+        else:
+            for (_, f), v in zip(batch, vectors):
+                if not f.done(): f.set_result(v)
+        finally:
+            self._free_workers.release()
+
+        self.batches                    += 1
+        self.batched_texts              += len(batch)
+        self.batch_fill[len(batch)]     += 1
+        if self.batches % 500 == 0:
+            logger.info(f'Embedding batches - {self.batches}, mean batch fill - {self.batch_stats()["mean_fill"]:.2f}')
+
+    async def _encode_batched(self, texts: List[str]) -> np.ndarray:
+        loop    = asyncio.get_event_loop()
+        futures = []
+        for t in texts:
+            f = loop.create_future()
+            self._queue.put_nowait((t, f))
+            futures.append(f)
+
+        return np.stack(await asyncio.gather(*futures))
+
+    def batch_stats(self) -> dict:
+        '''Get batch fill metrics.
+
+        Returns:
+            dict: Number of batches and texts, mean fill (0..1) and batch size histogram.
+        '''
+        mean_fill = 0.0
+        if self.batches > 0:
+            mean_fill = self.batched_texts / (self.batches * self.batch_size)
+
+        return {
+            'batches'   : self.batches          ,
+            'texts'     : self.batched_texts    ,
+            'mean_fill' : mean_fill             ,
+            'histogram' : list(self.batch_fill) ,
+        }
+
+    def encode_sync(self, texts: List[str]) -> np.ndarray:
+        '''Encode the texts in the calling thread (for scripts and notebooks).
+
+        Args:
+            texts (List[str]): Texts to encode.
+
+        Returns:
+            np.ndarray: Matrix of embeddings, one row per text.
+        '''
+        return self._encode(list(texts))
+
+    def _cache_key(self, text: str) -> str:
+        model = self.model_name if self.backend == 'torch' else f'{self.model_name}:{self.backend}'
+        return model + '|' + ' '.join(text.split())
+
+    async def _encode_async(self, texts: List[str]) -> np.ndarray:
+        self._start()
+
+        if self._slots.locked():
+            raise EmbedServiceBusy(f'Embedding queue is full ({self.workers * self.batch_size + self.queue_size} requests)')
+
+        await self._slots.acquire()
+        if self.batch_size > 1:
+            # cancelled on timeout, the collector skips the cancelled texts and bounds the batches in the pool
+            future = asyncio.ensure_future(self._encode_batched(texts))
+            future.add_done_callback(self._release)
+        else:
+            # the job keeps running in the pool after a timeout, so the slot is held until it is done,
+            # otherwise the timed out jobs would pile up in the (unbounded) queue of the pool
+            future = self._run_in_pool(texts)
+            future.add_done_callback(self._release)
+            future = asyncio.shield(future)
+        try:
+            return await asyncio.wait_for(future, timeout = self.timeout)
+        except asyncio.TimeoutError:
+            raise EmbedServiceBusy(f'Embedding timed out after {self.timeout} seconds')
+
+    def _release(self, future: asyncio.Future) -> None:
+        '''Release the slot of the finished request (retrieving the error of a request nobody waits for anymore).'''
+        self._slots.release()
+        if not future.cancelled():
+            future.exception()
+
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        '''Encode the texts in the worker pool (looking up the cache first).
+
+        Args:
+            texts (List[str]): Texts to encode.
+
+        Raises:
+            EmbedServiceBusy: If the queue is full or encoding timed out.
+
+        Returns:
+            np.ndarray: Matrix of embeddings, one row per text.
+        '''
+        if self.cache is None:
+            return await self._encode_async(texts)
+
+        keys    = [self._cache_key(t) for t in texts]
+        vectors = [await self.cache.get_async(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+
+        if len(missing) > 0:
+            encoded = await self._encode_async([texts[i] for i in missing])
+            for i, v in zip(missing, encoded):
+                vectors[i] = v
+                self.cache.set(keys[i], v)
+
+        return np.stack(vectors)
+
+    def shutdown(self) -> None:
+        '''Stop the batch collector and shut down the worker pool.'''
+        if self._collector is not None:
+            self._collector.cancel()
+            self._collector = None
+        if self._pool is not None:
+            self._pool.shutdown(wait = False)
+            self._pool = None
+
+
+if __name__ == '__main__':
+    # python -m actions.es.embed <model> <cache folder> <backend> <texts.json> <output.npz>
+    # (benchmark of the backend in a fresh process, see scripts/benchmark)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    model_name, cache_folder, backend, texts_path, output = sys.argv[1:6]
+    with open(texts_path) as f:
+        texts = json.load(f)
+    vectors, stats = benchmark_backend(model_name, cache_folder, backend, texts)
+    np.savez(output, vectors = vectors, stats = json.dumps(stats))
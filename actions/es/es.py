@@ -1,138 +1,353 @@
+import copy
+import math
+import logging
+
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 from typing import List, Tuple
-from elasticsearch import RequestError
 
-from actions.es import config
+from actions.es import config, metrics
+from actions.es.embed import EmbedServiceBusy
+from actions.es.retriever import SearchRequest
+
+logger = logging.getLogger(__name__)
+
+
+def _synonym_replace(text: str) -> str:
+    '''Replace the pest names in text by their common synonym.
+
+    Args:
+        text (str): Text to process.
+
+    Returns:
+        str: Text with synonyms replaced.
+    '''
+    tokens = config.tokenizer(text)
+    text_modified = ""
+    for token in tokens:
+        t = token.text.lower()
+            
+        if t in config.synonym_dict:
+            text_modified += config.synonym_dict[t]
+            text_modified += token.whitespace_
+        else:
+            text_modified += token.text_with_ws
+
+    return text_modified
+
 
-async def _cos_sim_query(query_vector: np.ndarray) -> dict:
-    '''Exectute vector search in ES based on cosine similarity.
+def _normalise_query(
+    query       : str               ,
+    slots       : List[str] = None
+    ) -> Tuple[str, str, List[str]]:
+    '''Produce both query variants in a single tokenizer pass over the query.
+
+    Args:
+        query       (str)       : Query statement.
+        slots       (List[str]) : Additional entity queries. Defaults to None.
+
+    Returns:
+        Tuple[str, str, List[str]]: Query without stopwords (for hardcoded queries lookup),
+                                    query with synonyms replaced (for ES search) and
+                                    slot queries with synonyms replaced.
+    '''
+    tokens = config.tokenizer(query)
+    text_hardcoded  = ""
+    text_search     = ""
+    for token in tokens:
+        if not token.is_stop:
+            text_hardcoded += token.text_with_ws
+
+        t = token.text.lower()
+        if t in config.synonym_dict:
+            text_search += config.synonym_dict[t]
+            text_search += token.whitespace_
+        else:
+            text_search += token.text_with_ws
+
+    texts_slots = [_synonym_replace(s) for s in slots] if slots else []
+
+    return text_hardcoded, text_search, texts_slots
+
+
+def _compose_search_queries(
+    text_search : str       ,
+    texts_slots : List[str]
+    ) -> List[str]:
+    '''Compose the queries to search for - the query with the slot queries appended, or
+    the query and every slot query separately if `es_slots_parallel` is set.'''
+    if config.es_slots_parallel:
+        return [text_search] + texts_slots
+    return ['. '.join([text_search] + texts_slots)]
+
+
+def _fuse_hits(
+    results : List[list],
+    size    : int
+    ) -> list:
+    '''Fuse the hits of the query and the slot queries by weighted score.
+
+    The query gets the weight `1 - es_slots_weight` and the slot queries share
+    `es_slots_weight` equally. A document missing in the hits of a query is
+    scored with the lowest score of those hits (the best it could have had).
+
+    Args:
+        results (List[list]): Hits of the query followed by hits of the slot queries.
+        size    (int)       : Number of documents to return.
+
+    Returns:
+        list: Fused hits, sorted by score.
+    '''
+    weights = [1 - config.es_slots_weight] + [config.es_slots_weight / (len(results) - 1)] * (len(results) - 1)
+    floors  = [hits[-1]['_score'] if len(hits) else 0.0 for hits in results]
+
+    scores  = {}
+    best    = {}
+    for i, hits in enumerate(results):
+        for h in hits:
+            scores.setdefault(h['_id'], [None] * len(results))[i] = h['_score']
+            if h['_id'] not in best or h['_score'] > best[h['_id']]['_score']:
+                best[h['_id']] = h
+
+    fused = []
+    for _id, s in scores.items():
+        hit = dict(best[_id])
+        hit['_score'] = sum(w * (x if x is not None else f) for w, x, f in zip(weights, s, floors))
+        fused.append(hit)
+
+    return sorted(fused, key = lambda h: h['_score'], reverse = True)[:size]
+
+
+def _match_hardcoded_queries(
+    query_vector    : np.ndarray,
+    top_k           : int = 1
+    ) -> List[Tuple[float, dict]]:
+    '''Find the hardcoded queries closest to the query by cosine similarity.
 
     Args:
         query_vector    (np.ndarray): Query vector.
+        top_k           (int)       : Number of closest hardcoded queries. Defaults to 1.
 
     Returns:
-        dict: Return hits.
+        List[Tuple[float, dict]]: Scores and hardcoded queries, sorted by score.
     '''
-    vector_name     = 'vectors.vector'
-    source_nested   = {'includes': ['vectors.name', 'vectors.start', 'vectors.end']}
-
-    cos     = f'cosineSimilarity(params.query_vector, "{vector_name}") + 1.0'
-    script  = {"source": cos, "params": {"query_vector": query_vector}}
-
-    source_query = {'includes': ['source', 'url', 'title', 'description', 'identification', 'development', 'damage', 'management', 'links']}
-
-    path = vector_name.split('.')[0]
-    query = {
-        "bool": {
-            "must": {"nested": {
-                        "score_mode": "max" ,
-                        "path"      : path  ,
-                        "inner_hits": {"size": 3, "name": "nested", "_source": source_nested},
-                        "query"     : {"function_score": {"script_score": {"script": script}}}}
-            },
-        }
-    }
+    matrix = config.hardcoded_matrix
+    if matrix.shape[0] == 0:
+        return []
 
-    response = await config.es_client.search(
-        index   = config.es_combined_index  ,
-        query   = query                     ,
-        size    = config.es_search_size     ,
-        _source = source_query
-    )
+    query_vector    = np.asarray(query_vector, dtype = np.float32)
+    scores          = matrix @ (query_vector / max(np.linalg.norm(query_vector), 1e-12))
 
-    hits = []
+    if top_k == 1:
+        top = [int(np.argmax(scores))]
+    else:
+        top_k   = min(top_k, scores.shape[0])
+        top     = np.argpartition(-scores, top_k - 1)[:top_k]
+        top     = top[np.argsort(-scores[top], kind = 'stable')]
 
-    for h1 in response['hits']['hits']:
-        top_scores = []
+    return [(float(scores[i]), config.hardcoded_queries[i]) for i in top]
 
-        for h2 in h1['inner_hits']['nested']['hits']['hits']:
-            top_scores.append({'score': h2['_score'] - 1, 'source': h2['_source']})
-        
-        h1['_source']['top_scores'  ] = top_scores
-        h1['_source']['_id'         ] = h1['_id'    ]
-        h1['_source']['_score'      ] = h1['_score' ] - 1
-        
-        hits.append(h1['_source'])
+
+def _check_for_hardcoded_queries(query_vector: np.ndarray) -> list:
+    '''Find the closest hardcoded queries above the similarity threshold.
+
+    Args:
+        query_vector    (np.ndarray): Query vector.
+
+    Returns:
+        list: Hits of the matching hardcoded queries (best match first), empty if none matched.
+    '''
+    hits = []
+    urls = set()
+    for score, h_query in _match_hardcoded_queries(query_vector, top_k = config.es_hardcoded_top_k):
+        if score < config.es_hardcoded_threshold:
+            break
+        for h in h_query['hits']:
+            if h['url'] not in urls:
+                urls.add(h['url'])
+                # copy, since the results are reweighted in place later on
+                hits.append(dict(h))
 
     return hits
 
 
+def _partition_weight(partition: dict) -> float:
+    '''Get the weight of the source partition (a number or the name of the config parameter).'''
+    weight = partition['weight']
+    return getattr(config, weight) if isinstance(weight, str) else weight
+
+
+def _source_weight(source: str) -> float:
+    '''Get the weight of the source partition the source belongs to (1 if none).'''
+    for p in config.es_partitions:
+        if (p['sources'] is None or source in p['sources']) and source not in (p['exclude'] or []):
+            return _partition_weight(p)
+    return 1.0
+
+
+def _search_requests(query_vector: np.ndarray) -> List[SearchRequest]:
+    '''Compose the searches of the query - one per source partition if `es_partitioned` is set.'''
+    if not config.es_partitioned:
+        return [SearchRequest(query_vector, config.es_search_size)]
+
+    return [SearchRequest(
+        vector  = query_vector                                          ,
+        size    = max(1, math.ceil(config.es_search_size * p['share'])) ,
+        sources = p['sources']                                          ,
+        exclude = p['exclude']                                          ,
+    ) for p in config.es_partitions]
+
+
+def _merge_partitions(results: List[list]) -> list:
+    '''Weight the hits of every source partition (see `_search_requests`) and merge them by score.'''
+    if not config.es_partitioned:
+        return results[0]
+
+    hits = []
+    for p, partition_hits in zip(config.es_partitions, results):
+        weight = _partition_weight(p)
+        for h in partition_hits:
+            h['_score'] *= weight
+        hits.extend(partition_hits)
+
+    return sorted(hits, key = lambda h: h['_score'], reverse = True)
+
+
+def _result_cache_key(
+    text_hardcoded  : str       ,
+    texts_search    : List[str] ,
+    generation      : str
+    ) -> str:
+    '''Compose the result cache key from the transformed query, the ranking parameters and data generation.'''
+    return '|'.join([
+        generation                                  ,
+        config.es_retrieval                         ,
+        str(config.es_search_size               )   ,
+        str(config.es_cut_off                   )   ,
+        str(config.es_ask_weight                )   ,
+        str(config.es_top_n                     )   ,
+        str(config.es_slots_weight              )   ,
+        str(bool(config.es_partitioned          ))  ,
+        str(bool(config.es_hardcoded_shared_vector)),
+        text_hardcoded                              ,
+    ] + texts_search)
+
+
 async def _handle_es_query(
-    query       : str               ,
-    slots       : List[str] = None
-    ) -> Tuple[list, str]:
+    text_hardcoded  : str       ,
+    texts_search    : List[str]
+    ) -> Tuple[list, np.ndarray, np.ndarray]:
     '''Perform search in ES base.
 
+    All the query variants are encoded in a single batch and the search
+    queries are searched at once (in one `_msearch` round trip with ES),
+    per source partition if `es_partitioned` is set (see `_search_requests`),
+    fusing the results if there are more than one (see `_fuse_hits`).
+
+    If the `es_hardcoded_shared_vector` is set, then the hardcoded query
+    variant is not encoded and the vector of the first search query is used
+    for the hardcoded queries lookup instead.
+
+    If the searched vectors are reduced, the search query vectors are
+    projected with the projection of the retriever.
+
     Args:
-        query       (str)       : Query statement.
-        slots       (List[str]) : Additional entity queries. Defaults to None.
+        text_hardcoded  (str)       : Query for the hardcoded queries lookup.
+        texts_search    (List[str]) : Queries for the ES search (see `_compose_search_queries`).
 
     Returns:
-        Tuple[list, str]: Results from ES query and final transformed query that was embedded.
-                            If slots were provided, then results with slots refinement.
+        Tuple[list, np.ndarray, np.ndarray]: Results from ES query, the (not projected) vector of the first search query
+                                                and the vector of the hardcoded queries lookup.
     '''
 
-    def _synonym_replace(text):
-        tokens = config.tokenizer(text)
-        text_modified = ""
-        for token in tokens:
-            t = token.text.lower()
-                
-            if t in config.synonym_dict:
-                text_modified += config.synonym_dict[t]
-                text_modified += token.whitespace_
-            else:
-                text_modified += token.text_with_ws
+    # TF HUB model
+    # query_vector = config.embed([text_search]).numpy()[0]
 
-        return text_modified
-    
-    def _check_for_hardcoded_queries(text):
-        
-        tokens = config.tokenizer(text)
-        text_modified = ""
+    # Sentence Encoder model
+    with metrics.span('encode'):
+        if config.es_hardcoded_shared_vector:
+            query_vectors       = await config.embed_service.encode(texts_search)
+            hardcoded_vector    = query_vectors[0]
+        else:
+            vectors             = await config.embed_service.encode([text_hardcoded] + texts_search)
+            hardcoded_vector    = vectors[0]
+            query_vectors       = vectors[1:]
+
+    return await _search_vectors(query_vectors, hardcoded_vector), query_vectors[0], hardcoded_vector
+
+async def _search_vectors(
+    query_vectors       : np.ndarray,
+    hardcoded_vector    : np.ndarray
+    ) -> list:
+    '''Search the query vectors and put the matching hardcoded queries first (see `_handle_es_query`).
 
-        for token in tokens:
-            if not token.is_stop:
-                text_modified += token.text_with_ws
-            
-        query_vector = config.embed.encode([text_modified], show_progress_bar = False)[0]
-        best_score  = 0
-        best_result = None
-        for h_query in config.hardcoded_queries:
-            h_query_vector = h_query['vector']
-            score = cosine_similarity([query_vector, h_query_vector])[0, 1]
-            if score > best_score:
-                best_score  = score
-                best_result = h_query
-
-        if best_score < config.es_hardcoded_threshold:
-            return None
-
-        return best_result        
-    
-    check_hardcoded = _check_for_hardcoded_queries(query)
-    
-    query = _synonym_replace(query)
+    Args:
+        query_vectors       (np.ndarray): Vectors of the search queries, one per row.
+        hardcoded_vector    (np.ndarray): Vector for the hardcoded queries lookup.
+
+    Returns:
+        list: Results from ES query.
+    '''
+    with metrics.span('hardcoded'):
+        check_hardcoded = _check_for_hardcoded_queries(hardcoded_vector)
 
-    if slots:
-        query = '. '.join([query] + [_synonym_replace(s) for s in slots])
+    # reduced vectors - the hardcoded queries are matched with the full ones
+    if config.retriever.projection is not None:
+        query_vectors = config.retriever.projection.apply(query_vectors)
 
-    # TF HUB model
-    # query_vector = config.embed([query]).numpy()[0]
+    requests = [_search_requests(v) for v in query_vectors]
+    with metrics.span('search'):
+        results = await config.retriever.search_many([r for rs in requests for r in rs])
 
-    # Sentence Encoder model
-    query_vector = config.embed.encode([query], show_progress_bar = False)[0]
-    
-    hits = await _cos_sim_query(query_vector = query_vector)
+    per_query = []
+    for rs in requests:
+        per_query.append(_merge_partitions(results[:len(rs)]))
+        results = results[len(rs):]
+
+    if len(per_query) == 1:
+        hits = per_query[0]
+    else:
+        hits = _fuse_hits(per_query, size = config.es_search_size)
 
     if check_hardcoded:
-        urls = set([h['url'] for h in check_hardcoded['hits']])
+        if config.es_partitioned:
+            for h in check_hardcoded:
+                h['_score'] *= _source_weight(h['source'])
+        urls = set([h['url'] for h in check_hardcoded])
         hits = [h for h in hits if h['url'] not in urls and h['_score'] > config.es_cut_off_hardcoded]
-        hits = check_hardcoded['hits'] + hits
+        hits = check_hardcoded + hits
+
+    return hits
+
+def _normalise(vector: np.ndarray) -> np.ndarray:
+    '''Normalise the vector to the unit length (float32).'''
+    vector = np.asarray(vector, dtype = np.float32)
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+async def _rescore_candidates(
+    query_vector    : np.ndarray,
+    ids             : List[str]
+    ) -> list:
+    '''Score only the candidates of the previous turn against the query.
+
+    Args:
+        query_vector    (np.ndarray): Query vector.
+        ids             (List[str]) : Ids of the candidate documents.
+
+    Returns:
+        list: Results from ES query (weighted by source partition if `es_partitioned` is set).
+    '''
+    if config.retriever.projection is not None:
+        query_vector = config.retriever.projection.apply(query_vector)
+
+    with metrics.span('rescore'):
+        hits = await config.retriever.search(query_vector, len(ids), ids = ids)
+
+    if config.es_partitioned:
+        for h in hits:
+            h['_score'] *= _source_weight(h['source'])
 
-    return hits, query
+    return hits
 
 def _handle_es_result(
     hits    : list,
@@ -148,9 +363,11 @@ def _handle_es_result(
         list: filtered and processed ES query results
     '''
 
-    for h in hits: 
-        if h['source'] == 'askExtension': 
-            h['_score'] *= config.es_ask_weight
+    # with source-partitioned retrieval the weights are already applied at query time
+    if not config.es_partitioned:
+        for h in hits: 
+            if h['source'] == 'askExtension': 
+                h['_score'] *= config.es_ask_weight
     
     hits = [h for h in hits if len(h['url']) > 0]
     
@@ -345,48 +562,175 @@ def _get_text(hits: list) -> dict:
     
     return res
 
+@metrics.timed('submit')
 async def submit(
     question    : str               ,
-    slots       : List[str] = None
+    slots       : List[str] = None  ,
+    session     : str       = None
     ) -> Tuple[dict, str]:
     
     '''Perform ES query, transform results, print them, and return results.
 
+    If the `session` is given, the query vector and the candidates are kept
+    under it for the follow-up refinement (see `submit_followup`).
+
     Args:
         question    (str)       : Question that is asked.
         slots       (List[str]) : Pest damage description. Defaults to None.
+        session     (str)       : Key to keep the state of the search under. Defaults to None.
     
     Returns:
-        Tuple[dict, str]: Results from ES query and final transformed query that was embedded.
+        Tuple[dict, str]: Results from ES query and final transformed query that was embedded
+                            (queries searched in parallel are separated by ` | `).
                             If slots were provided, then results with slots refinement.
+
+    Raises:
+        EmbedServiceBusy: If the embedding service could not encode the query in time,
+                            or the model is still loading.
     '''
 
-    hits, debug_query = await _handle_es_query(question, slots = slots)
+    with metrics.span('wait_ready'):
+        if not await config.wait_ready(config.embed_timeout):
+            raise EmbedServiceBusy(f'Still warming up after waiting {config.embed_timeout} seconds')
+
+    with metrics.span('normalise'):
+        text_hardcoded, text_search, texts_slots = _normalise_query(question, slots = slots)
+        texts_search = _compose_search_queries(text_search, texts_slots)
+
+    debug_query     = ' | '.join(texts_search)
+    keep_state      = session is not None and config.es_session_cache is not None
+
+    key = None
+    if config.es_result_cache is not None:
+        with metrics.span('result_cache'):
+            generation  = await config.retriever.generation()
+            key         = _result_cache_key(text_hardcoded, texts_search, generation)
+            res         = await config.es_result_cache.get_async(key)
+            state       = await config.es_result_cache.get_async(key + '|state') if keep_state else None
+        if res is not None and (state is not None or not keep_state):
+            if keep_state:
+                config.es_session_cache.set(session, state)
+            return copy.deepcopy(res), debug_query
+
+    hits, vector, hardcoded_vector = await _handle_es_query(text_hardcoded, texts_search)
+
+    state = None
+    if keep_state:
+        state   = {
+            'query'     : texts_search[0]                                           ,
+            'vector'    : _normalise(vector)                                        ,
+            'hardcoded' : _normalise(hardcoded_vector)                              ,
+            'ids'       : list(dict.fromkeys(h['_id'] for h in hits if '_id' in h)) ,
+        }
+        config.es_session_cache.set(session, state)
     
-    hits = _handle_es_result(hits)    
+    with metrics.span('handle_result'):
+        hits = _handle_es_result(hits)
+
+    # the search returns only the fields needed for ranking, fetch the bodies of the final results
+    with metrics.span('fetch'):
+        hits = await config.retriever.fetch(hits[:config.es_top_n])
+
+    with metrics.span('format'):
+        res = _get_text(hits)
+
+    if key is not None:
+        config.es_result_cache.set(key, copy.deepcopy(res))
+        if state is not None:
+            config.es_result_cache.set(key + '|state', state)
     
-    res = _get_text(hits)
+    return res, debug_query
+
+@metrics.timed('submit_followup')
+async def submit_followup(
+    question    : str               ,
+    details     : str               ,
+    slots       : List[str] = None  ,
+    new_slots   : List[str] = None  ,
+    session     : str       = None
+    ) -> Tuple[dict, str]:
     
+    '''Refine the results of the question with the details added in the follow-up turn.
+
+    Only the details (and the slot queries added with them) are encoded, their
+    vector is blended with the query vector of the question kept by `submit`
+    (with the weight `es_followup_weight`), and only the candidates of the
+    question are rescored. If the best candidate scores below
+    `es_followup_confidence`, the blended vector is searched in the whole
+    corpus instead, with the hardcoded queries looked up by the vector of the
+    hardcoded query variant of the question blended the same way. If the state of the question is gone (or the slot queries
+    are searched in parallel), the question with the details is searched from scratch.
+
+    Args:
+        question    (str)       : Question of the previous turn.
+        details     (str)       : Details added to the question.
+        slots       (List[str]) : Slot queries of both turns. Defaults to None.
+        new_slots   (List[str]) : Slot queries added with the details. Defaults to None.
+        session     (str)       : Key the state of the question was kept under by `submit`. Defaults to None.
+
+    Returns:
+        Tuple[dict, str]: Results from ES query and final transformed query that was embedded
+                            (the blended queries are separated by ` + `).
+
+    Raises:
+        EmbedServiceBusy: If the embedding service could not encode the query in time,
+                            or the model is still loading.
+    '''
+
+    state = None
+    if session is not None and config.es_session_cache is not None and not config.es_slots_parallel:
+        state = config.es_session_cache.get(session)
+    if state is None:
+        logger.info('submit_followup - no state of the previous turn, searching from scratch')
+        return await submit('. '.join([question, details]), slots = slots, session = session)
+
+    with metrics.span('normalise'):
+        _, text_search, texts_slots = _normalise_query(details, slots = new_slots)
+    text_details    = '. '.join([text_search] + texts_slots)
+    debug_query     = ' + '.join([state['query'], text_details])
+
+    with metrics.span('encode'):
+        details_vector = (await config.embed_service.encode([text_details]))[0]
+    details_vector  = _normalise(details_vector)
+    vector          = _normalise((1 - config.es_followup_weight) * state['vector'] + config.es_followup_weight * details_vector)
+
+    hits = await _rescore_candidates(vector, state['ids'])
+    with metrics.span('handle_result'):
+        hits = _handle_es_result(hits)
+    if len(hits) == 0 or hits[0]['_score'] < config.es_followup_confidence:
+        logger.info(f'submit_followup - candidates of the previous turn below {config.es_followup_confidence}, searching the whole corpus')
+        # states cached before the hardcoded vector was kept have only the search one
+        hardcoded_vector = state.get('hardcoded', state['vector'])
+        hardcoded_vector = _normalise((1 - config.es_followup_weight) * hardcoded_vector + config.es_followup_weight * details_vector)
+        hits = await _search_vectors(vector[None], hardcoded_vector)
+        with metrics.span('handle_result'):
+            hits = _handle_es_result(hits)
+
+    # the search returns only the fields needed for ranking, fetch the bodies of the final results
+    with metrics.span('fetch'):
+        hits = await config.retriever.fetch(hits[:config.es_top_n])
+
+    with metrics.span('format'):
+        res = _get_text(hits)
+
     return res, debug_query
 
 async def save_chat_logs(
     chat_export: dict
-    ) -> None:
+    ) -> bool:
     '''Save the chat into the index logs in ES.
 
+    The chat is only queued, it is saved by the background writer in batches
+    (see `actions.es.logs.ChatLogWriter`), so no ES round trip is waited for.
+
     Args:
-        chat_export (dict): The chat export object containing chat history for particular session.
+        chat_export (dict): The chat export object containing chat history for particular session
+                            (only the new entries of it if marked with `append`, see `helper._export_chat`).
+
+    Returns:
+        bool: If the chat was accepted by the writer (queued, or journaled to be saved later).
     '''
-    try:
-        response = await config.es_client.index(
-            index       = config.es_logging_index   ,
-            document    = chat_export               ,
-            id          = chat_export['chat_id']    ,
-        )
-    except RequestError as e:
-        raise(e)
-    
-    try:
-        assert response['result'] in ['created', 'updated']
-    except AssertionError as e:
-        raise e
\ No newline at end of file
+    if config.es_imitate:
+        return False
+
+    return config.chat_log_writer.write(chat_export)
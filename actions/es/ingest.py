@@ -0,0 +1,859 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import hashlib
+import logging
+import argparse
+import itertools
+
+from typing import Iterable, Iterator, List
+from string import punctuation as pn
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from actions.es.projection import Projection
+
+logger = logging.getLogger(__name__)
+
+# Fields of the ingested documents and the fields split into sentence windows
+doc_fields      = ['source', 'url', 'title', 'description', 'identification', 'development', 'damage', 'management', 'links']
+vector_fields   = ['title', 'description', 'identification', 'development', 'damage', 'management']
+
+# Sentence windows of the fields (window of ROLLING_SIZE sentences every CHUNK_SIZE sentences)
+CHUNK_SIZE      = 1
+ROLLING_SIZE    = 3
+
+# AskExtension tickets filter
+STATE_FILTER    = ['California']
+MIN_WORD_COUNT  = 3
+
+ASKEXTENSION_QUESTION_URL = 'https://ask2.extension.org/kb/faq.php?id='
+
+# Source files of UC IPM (relative to the data folder). Fields map the document fields to the keys of
+# the source items (the first key present is taken, missing fields are empty). Links are built from
+# the lists of the items - `text` is the key of the link title, `src` and `link` are the keys of the
+# urls (None for empty, '@url' for the url of the item).
+ucipm_sources = [
+    {'file': 'uc-ipm/updated-Dec2021/pestDiseaseItems_new.json', 'source': 'pestsDiseases',
+     'fields': {'title': 'name', 'description': 'description', 'identification': 'identification', 'development': 'life_cycle', 'damage': ['damagePestNote', 'damage'], 'management': 'solutions'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'}]},
+    {'file': 'uc-ipm/updated-Dec2021/turfPests.json', 'source': 'pestsTurf',
+     'fields': {'title': 'name', 'description': 'text'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'}]},
+    {'file': 'uc-ipm/updated-Dec2021/exoticPests.json', 'source': 'pestsExotic',
+     'fields': {'title': 'name', 'description': 'description', 'identification': 'identification', 'development': 'life_cycle', 'damage': 'damage', 'management': 'management'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'},
+                {'key': 'related_links', 'type': 'page', 'text': 'text', 'src': 'link', 'link': None}]},
+    {'file': 'uc-ipm/updated-Dec2021/fruitVeggieEnvironItems_new.json', 'source': 'damagesEnvironment',
+     'fields': {'title': 'name', 'description': 'description', 'identification': 'identification', 'development': 'disorder_development', 'damage': 'damage', 'management': 'solutions'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'}]},
+    {'file': 'uc-ipm/updated-Dec2021/weedItems.json', 'source': 'damagesWeed',
+     'fields': {'title': 'name', 'description': 'description'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'link', 'link': None}]},
+    {'file': 'uc-ipm/updated-Dec2021/fruitItems_new.json', 'source': 'infoFruits',
+     'fields': {'title': 'name'},
+     'links' : [{'key': 'cultural_tips', 'type': 'tip', 'text': 'tip', 'src': 'link', 'link': None},
+                {'key': 'pests_and_disorders', 'type': 'problem', 'text': 'problem', 'src': 'link', 'link': None}]},
+    {'file': 'uc-ipm/updated-Dec2021/veggieItems_new.json', 'source': 'infoVeggies',
+     'fields': {'title': 'name', 'description': 'description', 'management': 'tips'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'},
+                {'key': 'pests_and_disorders', 'type': 'problem', 'text': 'problem', 'src': 'link', 'link': None}]},
+    {'file': 'uc-ipm/updated-Dec2021/plantFlowerItems.json', 'source': 'infoFlowers',
+     'fields': {'title': 'name', 'identification': 'identification', 'management': 'optimum_conditions'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'},
+                {'key': 'pests_and_disorders', 'type': 'problem', 'text': 'problem', 'src': 'link', 'link': None}]},
+    {'file': 'uc-ipm/updated-Apr2022/FruitVegCulturalItems.json', 'source': 'infoFruitVegCultural',
+     'fields': {'title': 'name', 'description': 'description'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': None},
+                {'key': 'tips_table', 'type': 'problem', 'text': 'header', 'src': '@url', 'link': None}]},
+    {'file': 'uc-ipm/updated-Apr2022/GardenControlsPestItems.json', 'source': 'infoPestControl',
+     'fields': {'title': 'name', 'description': 'description'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'}]},
+    {'file': 'uc-ipm/updated-Apr2022/GardenControlsPesticideItems.json', 'source': 'infoPesticideControl',
+     'transform': '_transform_pesticide'},
+    {'file': 'uc-ipm/updated-Apr2022/PestNotes.json', 'source': 'pestsNotes',
+     'fields': {'url': 'urlPestNote', 'title': 'name', 'description': 'descriptionPestNote', 'development': 'lifecyclePestNote', 'damage': 'damagePestNote', 'management': 'managementPestNote'},
+     'links' : [{'key': 'imagePestNote', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'}]},
+    {'file': 'uc-ipm/updated-Apr2022/QuickTips.json', 'source': 'pestsQuickTips',
+     'fields': {'url': 'urlQuickTip', 'title': 'name', 'description': 'contentQuickTips'},
+     'links' : [{'key': 'imageQuickTips', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': 'link'}]},
+    {'file': 'uc-ipm/updated-Apr2022/Videos.json', 'source': 'pestsVideos',
+     'fields': {'title': 'title', 'description': 'description'},
+     'links' : []},
+    {'file': 'uc-ipm/updated-Apr2022/WeedIdItems.json', 'source': 'pestsWeed',
+     'fields': {'title': 'name', 'description': 'description'},
+     'links' : [{'key': 'images', 'type': 'image', 'text': 'caption', 'src': 'src', 'link': None}]},
+]
+
+askextension_files = 'askextension/2020-08-20/*.json'
+
+
+class IngestValidationError(Exception):
+    '''Raised when the new version of the index fails validation (the aliases are left as they were).'''
+
+
+def _clean(text: str) -> str:
+    '''Fix encodings and remove escape and redundant whitespace characters from text.'''
+    text = text.encode('ascii', 'ignore').decode()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+
+def _text(value) -> str:
+    return value if isinstance(value, str) else ''
+
+
+def _list(value) -> list:
+    return value if isinstance(value, list) else []
+
+
+def _read_items(path: str) -> Iterator[dict]:
+    '''Stream the items of a JSON array file (all at once if `ijson` is not installed).'''
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.items(f, 'item', use_float = True)
+        else:
+            yield from json.load(f)
+
+
+def _transform_item(spec: dict, item: dict) -> dict:
+    '''Transform a UC IPM item into a document according to the source spec (see `ucipm_sources`).'''
+    doc = {'source': spec['source'], 'url': _text(item.get('url'))}
+    for f in vector_fields:
+        keys    = spec['fields'].get(f, [])
+        keys    = [keys] if isinstance(keys, str) else keys
+        doc[f]  = next((_text(item[k]) for k in keys if k in item), '')
+    if 'url' in spec['fields']:
+        doc['url'] = _text(item.get(spec['fields']['url']))
+
+    def _url(key, i):
+        if key is None  : return ''
+        if key == '@url': return doc['url']
+        return _text(i.get(key))
+
+    doc['links'] = []
+    for l in spec['links']:
+        for i in _list(item.get(l['key'])):
+            text = _text(i.get(l['text']))
+            if len(text) > 0:
+                doc['links'].append({
+                    'type'  : l['type']                 ,
+                    'src'   : _url(l['src'  ], i)       ,
+                    'link'  : _url(l['link' ], i)       ,
+                    'title' : doc['title'] + ' - ' + text
+                })
+
+    return doc
+
+
+def _transform_pesticide(spec: dict, item: dict) -> dict:
+    '''Transform a UC IPM garden pesticide item into a document.'''
+    information = _list(item.get('information'))
+    doc = {f: '' for f in vector_fields}
+    doc.update({
+        'source'        : spec['source']                                                                ,
+        'url'           : _text(item.get('url'))                                                        ,
+        'title'         : ' - '.join([_text(item.get('active_ingredient')), _text(item.get('pesticide_type'))]),
+        'description'   : _text(information[0].get('associated_pests')) if information else ''         ,
+        'links'         : []                                                                            ,
+    })
+    return doc
+
+
+def _transform_askextension(item: dict) -> dict:
+    '''Transform an AskExtension ticket into a document (None if filtered out).'''
+    if item.get('state') not in STATE_FILTER:
+        return None
+
+    ticket_no   = _text(item.get('title')).split('#')[-1]
+    url         = f'{ASKEXTENSION_QUESTION_URL}{ticket_no}' if len(ticket_no) == 6 else ''
+
+    answers     = item.get('answer') or {}
+    answers     = [_clean(_text(answers[k].get('response'))) for k in sorted(answers, key = int)]
+
+    # remove the question id from title and append '.' if no punctuation in the end
+    title       = _clean(_text(item.get('title')))
+    title       = ''.join(title.split('#')[:-1]).strip().strip('...')
+    title       = title if (title and title[-1] in pn) else title + '.'
+
+    # merge title and question, unless the question already starts with the title
+    question    = _clean(_text(item.get('question')))
+    description = question if (title and question.startswith(title[:-1])) else title + ' ' + question
+
+    if MIN_WORD_COUNT and len(description.split()) <= MIN_WORD_COUNT:
+        return None
+
+    doc = {f: '' for f in vector_fields}
+    doc.update({
+        'source'        : 'askExtension',
+        'url'           : url           ,
+        'title'         : title         ,
+        'description'   : description   ,
+        'links'         : [{'type': 'answer', 'src': url, 'link': '', 'title': a} for a in answers if len(a) > 0],
+    })
+    return doc
+
+
+def read_documents(
+    data_dir    : str               ,
+    sources     : List[str] = None
+    ) -> Iterator[dict]:
+    '''Stream the documents from the source files, in the format ingested into ES (without vectors).
+
+    Args:
+        data_dir    (str)       : Folder with the source data.
+        sources     (List[str]) : Sources to read. Defaults to None (all).
+
+    Returns:
+        Iterator[dict]: Documents.
+    '''
+    for spec in ucipm_sources:
+        if sources is not None and spec['source'] not in sources:
+            continue
+        path = os.path.join(data_dir, spec['file'])
+        if not os.path.isfile(path):
+            logger.warning(f'Missing source file - {path}')
+            continue
+
+        transform = globals()[spec['transform']] if 'transform' in spec else _transform_item
+        logger.info(f'Reading {spec["source"]} - {path}')
+        for item in _read_items(path):
+            doc = transform(spec, item)
+            for f in vector_fields:
+                doc[f] = _clean(doc[f])
+            yield doc
+
+    if sources is None or 'askExtension' in sources:
+        for path in sorted(glob.glob(os.path.join(data_dir, askextension_files))):
+            logger.info(f'Reading askExtension - {path}')
+            for item in _read_items(path):
+                doc = _transform_askextension(item)
+                if doc is not None:
+                    yield doc
+
+
+def document_id(doc: dict) -> str:
+    '''Stable id of the document (source, url, title and description), so re-ingestion updates it in place.'''
+    key = '|'.join([doc['source'], doc['url'], doc['title'], doc['description']])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def content_hash(doc: dict, model: str) -> str:
+    '''Hash of everything the ingested document depends on (fields, embedding model, sentence windows).'''
+    key = json.dumps([{f: doc[f] for f in doc_fields}, model, CHUNK_SIZE, ROLLING_SIZE], sort_keys = True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def chunk_documents(
+    docs        : List[dict],
+    nlp                     ,
+    batch_size  : int = 64  ,
+    n_process   : int = 1
+    ) -> List[List[dict]]:
+    '''Split the fields of the documents into sentence windows and the links into titles.
+
+    Args:
+        docs        (List[dict]): Documents.
+        nlp                     : spaCy pipeline with sentence boundaries.
+        batch_size  (int)       : Batch size of `nlp.pipe`. Defaults to 64.
+        n_process   (int)       : Number of processes of `nlp.pipe`. Defaults to 1.
+
+    Returns:
+        List[List[dict]]: Chunks (`text`, `name`, `start`, `end`) of every document.
+    '''
+    texts   = [d[f] for d in docs for f in vector_fields]
+    parsed  = nlp.pipe(texts, batch_size = batch_size, n_process = n_process)
+
+    chunks = []
+    for d in docs:
+        d_chunks = []
+        for f in vector_fields:
+            ts = list(next(parsed).sents)
+            # windows of ROLLING_SIZE sentences, fields with fewer sentences produce no chunks
+            ts = [ts[i:i + CHUNK_SIZE + (ROLLING_SIZE - 1)] for i in range(0, len(ts) - (ROLLING_SIZE - 1), CHUNK_SIZE)]
+            d_chunks.extend([{
+                'text'  : ' '.join([s.text for s in w]),
+                'name'  : f + '_' + str(i)              ,
+                'start' : w[0].start_char               ,
+                'end'   : w[-1].end_char                ,
+            } for i, w in enumerate(ts)])
+
+        for i, l in enumerate(d['links']):
+            d_chunks.append({'text': d['title'] + ' - ' + l['title'], 'name': 'links_' + str(i), 'start': 0, 'end': -1})
+
+        chunks.append(d_chunks)
+
+    return chunks
+
+
+def combined_mapping(dims: int) -> dict:
+    '''Mapping of the combined index.'''
+    keyword = {"type": "keyword", "index": "false", "ignore_above": 32766}
+    return {
+        "settings": {"number_of_shards": 2, "number_of_replicas": 1},
+        "mappings": {
+            "dynamic"   : "false",
+            "_source"   : {"enabled": "true"},
+            "properties": {
+                "source"        : {"type": "keyword", "index": "true" , "ignore_above": 32766},
+                "url"           : keyword,
+                "content_hash"  : {"type": "keyword", "index": "true" , "ignore_above": 32766},
+
+                "title"         : keyword,
+                "description"   : keyword,
+                "identification": keyword,
+                "development"   : keyword,
+                "damage"        : keyword,
+                "management"    : keyword,
+                "vectors"       : {
+                    "type"      : "nested",
+                    "properties": {
+                        "vector": {"type": "dense_vector", "dims": dims},
+                        "name"  : keyword,
+                        "start" : {"type": "integer"},
+                        "end"   : {"type": "integer"},
+                    }
+                },
+
+                "links"         : {
+                    "type"      : "nested",
+                    "properties": {"type": keyword, "src": keyword, "link": keyword, "title": keyword}
+                }
+            }
+        }
+    }
+
+
+def chunks_mapping(dims: int) -> dict:
+    '''Mapping of the flattened chunk index (approximate kNN search, ES 8.4+).'''
+    keyword = {"type": "keyword", "index": "false", "ignore_above": 32766}
+    return {
+        "settings": {"number_of_shards": 2, "number_of_replicas": 1},
+        "mappings": {
+            "dynamic"   : "false",
+            "_source"   : {"enabled": "true"},
+            "properties": {
+                "doc_id"    : {"type": "keyword", "index": "true" , "ignore_above": 32766},
+                "source"    : {"type": "keyword", "index": "true" , "ignore_above": 32766},
+                "name"      : keyword,
+                "start"     : {"type": "integer"},
+                "end"       : {"type": "integer"},
+                "vector"    : {
+                    "type"          : "dense_vector",
+                    "dims"          : dims          ,
+                    "index"         : True          ,
+                    "similarity"    : "cosine"      ,
+                    "index_options" : {"type": "hnsw", "m": 16, "ef_construction": 100}
+                }
+            }
+        }
+    }
+
+
+class Checkpoint:
+    '''Ids and content hashes of the documents written by an unfinished run (JSON lines, appended per batch).
+
+    The first line records the index written to, and the checkpoint of a
+    run into a different index is discarded.
+    '''
+
+    def __init__(
+        self,
+        path    : str       ,
+        index   : str = None
+        ) -> None:
+
+        self.path   = path
+        self.index  = index
+        self.hashes = {}
+        if path and os.path.isfile(path):
+            stored = None
+            with open(path) as f:
+                for line in f:
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        # torn last line of an interrupted run
+                        continue
+                    if 'index' in r:
+                        stored = r['index']
+                    else:
+                        self.hashes[r['_id']] = r['hash']
+
+            if index is None:
+                self.index = stored
+            elif stored != index:
+                logger.warning(f'Discarding checkpoint {path} of index {stored}')
+                self.hashes = {}
+                self.remove()
+                return
+            logger.info(f'Resuming from checkpoint {path} - {len(self.hashes)} documents')
+
+    def add(self, docs: Iterable[dict]) -> None:
+        if not self.path:
+            return
+        header = not os.path.isfile(self.path)
+        with open(self.path, 'a') as f:
+            if header:
+                f.write(json.dumps({'index': self.index}) + '\n')
+            for d in docs:
+                f.write(json.dumps({'_id': d['_id'], 'hash': d['content_hash']}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self) -> None:
+        if self.path and os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class Ingest:
+    '''Incremental ingestion of the source documents into the combined index (and the chunk index).
+
+    Documents are processed in batches - split into sentence windows with
+    `nlp.pipe`, encoded in one call of the model per batch and written with
+    `parallel_bulk`, while the next batch is being processed. Documents whose
+    content hash matches the one in the index (or in the checkpoint of an
+    interrupted run) are skipped, and documents no longer in the sources are
+    deleted once all of the sources were read.
+
+    If `dims` is set, the vectors are reduced with the projection at
+    `projection_path`, fitted on the first batch of documents if the file is
+    missing. The projection is part of the content hash, so a new projection
+    re-encodes all the documents.
+    '''
+
+    def __init__(
+        self,
+        es_client                   ,
+        model                       ,
+        model_name          : str   ,
+        index               : str   ,
+        chunk_index         : str   = None,
+        checkpoint          : str   = None,
+        batch_size          : int   = 256,
+        pipe_batch_size     : int   = 64,
+        n_process           : int   = 1,
+        encode_batch_size   : int   = 64,
+        bulk_threads        : int   = 4,
+        force               : bool  = False,
+        dims                : int   = 0,
+        projection_method   : str   = 'pca',
+        projection_path     : str   = None
+        ) -> None:
+
+        from spacy.lang.en import English
+
+        self.es_client          = es_client
+        self.model              = model
+        self.model_name         = model_name
+        self.index              = index
+        self.chunk_index        = chunk_index
+        self.checkpoint         = Checkpoint(checkpoint, index)
+        self.batch_size         = batch_size
+        self.pipe_batch_size    = pipe_batch_size
+        self.n_process          = n_process
+        self.encode_batch_size  = encode_batch_size
+        self.bulk_threads       = bulk_threads
+        self.force              = force
+        self.dims               = dims
+        self.projection_method  = projection_method
+        self.projection_path    = projection_path
+
+        self.projection = None
+        if projection_path and os.path.isfile(projection_path):
+            self.projection = Projection.load(projection_path)
+            if dims and dims != self.projection.dims:
+                raise ValueError(f'Projection {projection_path} is to {self.projection.dims} dims, not {dims}, remove it to fit a new one')
+            self.dims = self.projection.dims
+        elif dims and not projection_path:
+            raise ValueError('Reduced vectors need the path of the projection')
+
+        self.nlp = English()
+        self.nlp.add_pipe('sentencizer')
+
+        self.stats = {'read': 0, 'skipped': 0, 'written': 0, 'deleted': 0}
+
+    def create_indices(self, recreate: bool = False) -> None:
+        '''Create the missing indices (drop them first if `recreate`).'''
+        dims = self.dims or self.model.get_sentence_embedding_dimension()
+        for index, mapping in [(self.index, combined_mapping(dims)), (self.chunk_index, chunks_mapping(dims))]:
+            if index is None:
+                continue
+            if recreate:
+                self.es_client.indices.delete(index = index, ignore = 404)
+            if not self.es_client.indices.exists(index = index):
+                logger.info(f'Creating index {index}')
+                self.es_client.indices.create(index = index, settings = mapping['settings'], mappings = mapping['mappings'])
+        if recreate:
+            self.checkpoint.remove()
+            self.checkpoint = Checkpoint(self.checkpoint.path, self.index)
+
+    def _indexed_hashes(self) -> dict:
+        '''Get the content hashes of the documents in the combined index.'''
+        from elasticsearch.helpers import scan
+
+        hashes = {}
+        for h in scan(self.es_client, index = self.index, query = {'query': {'match_all': {}}}, _source = ['content_hash'], size = 1000):
+            hashes[h['_id']] = h['_source'].get('content_hash')
+        return hashes
+
+    @property
+    def model_id(self) -> str:
+        '''Model the vectors are encoded with (and the projection they are reduced with).'''
+        if self.projection is None:
+            return self.model_name
+        return f'{self.model_name}|{self.projection.method}:{self.projection.id}'
+
+    def _encode(self, docs: List[dict]) -> tuple:
+        '''Chunk and encode the documents (full vectors).'''
+        from actions.es.es import _synonym_replace
+
+        chunks  = chunk_documents(docs, self.nlp, batch_size = self.pipe_batch_size, n_process = self.n_process)
+        texts   = [_synonym_replace(c['text']) for cs in chunks for c in cs]
+        vectors = self.model.encode(texts, batch_size = self.encode_batch_size, show_progress_bar = False) if texts else []
+        return chunks, vectors
+
+    def _fit_projection(self, docs: List[dict]) -> None:
+        '''Fit the projection on the vectors of the documents and save it.'''
+        _, vectors      = self._encode(docs)
+        self.projection = Projection.fit(vectors, self.dims, self.projection_method)
+        self.projection.save(self.projection_path)
+        logger.info(f'Saved projection {self.projection.id} to {self.projection_path}')
+
+    def _embed(self, docs: List[dict]) -> None:
+        '''Chunk and encode the batch of documents (sets their `vectors`).'''
+        chunks, vectors = self._encode(docs)
+        if self.projection is not None and len(vectors) > 0:
+            vectors = self.projection.apply(vectors)
+        vectors = np.asarray(vectors).tolist()
+
+        i = 0
+        for d, cs in zip(docs, chunks):
+            d['vectors'] = []
+            for c in cs:
+                d['vectors'].append({'vector': vectors[i], 'name': c['name'], 'start': c['start'], 'end': c['end']})
+                i += 1
+
+    def _write(self, docs: List[dict]) -> None:
+        '''Write the batch of documents into the indices and record them in the checkpoint.'''
+        from elasticsearch.helpers import parallel_bulk
+
+        def _actions():
+            for d in docs:
+                yield {'_index': self.index, '_id': d['_id'], '_source': {k: v for k, v in d.items() if k != '_id'}}
+
+        for ok, info in parallel_bulk(self.es_client, _actions(), thread_count = self.bulk_threads, chunk_size = 100, max_chunk_bytes = 5 * 1024 * 1024, raise_on_error = True):
+            pass
+
+        if self.chunk_index is not None:
+            ids = [d['_id'] for d in docs]
+            self.es_client.delete_by_query(index = self.chunk_index, body = {'query': {'terms': {'doc_id': ids}}}, refresh = True, conflicts = 'proceed')
+
+            def _chunks():
+                for d in docs:
+                    for v in d['vectors']:
+                        yield {'_index': self.chunk_index, '_source': {
+                            'doc_id': d['_id'], 'source': d['source'], 'name': v['name'], 'start': v['start'], 'end': v['end'], 'vector': v['vector']}}
+
+            for ok, info in parallel_bulk(self.es_client, _chunks(), thread_count = self.bulk_threads, chunk_size = 500, max_chunk_bytes = 5 * 1024 * 1024, raise_on_error = True):
+                pass
+
+        self.checkpoint.add(docs)
+        self.stats['written'] += len(docs)
+        logger.info(f'Written {self.stats["written"]} documents (read {self.stats["read"]}, skipped {self.stats["skipped"]})')
+
+    def _delete(self, ids: List[str]) -> None:
+        '''Delete the documents no longer in the sources.'''
+        from elasticsearch.helpers import bulk
+
+        for i in range(0, len(ids), 1000):
+            batch = ids[i:i + 1000]
+            bulk(self.es_client, [{'_op_type': 'delete', '_index': self.index, '_id': _id} for _id in batch], raise_on_error = False)
+            if self.chunk_index is not None:
+                self.es_client.delete_by_query(index = self.chunk_index, body = {'query': {'terms': {'doc_id': batch}}}, conflicts = 'proceed')
+        self.stats['deleted'] += len(ids)
+
+    def run(
+        self,
+        docs    : Iterable[dict],
+        delete  : bool = True
+        ) -> dict:
+        '''Ingest the documents.
+
+        Args:
+            docs    (Iterable[dict]): Documents (see `read_documents`).
+            delete  (bool)          : Delete the indexed documents missing in `docs`. Defaults to True.
+
+        Returns:
+            dict: Number of read, skipped, written and deleted documents.
+        '''
+        docs = iter(docs)
+        if self.dims and self.projection is None:
+            sample  = list(itertools.islice(docs, self.batch_size))
+            docs    = itertools.chain(sample, docs)
+            self._fit_projection(sample)
+
+        indexed = self._indexed_hashes()
+        known   = {**indexed, **self.checkpoint.hashes}
+        logger.info(f'Documents in the index - {len(indexed)}, in the checkpoint - {len(self.checkpoint.hashes)}')
+
+        seen    = set()
+        batch   = []
+        pending = None
+        with ThreadPoolExecutor(max_workers = 1) as writer:
+
+            def _flush(batch, pending):
+                self._embed(batch)
+                if pending is not None:
+                    pending.result()
+                return writer.submit(self._write, batch)
+
+            for d in docs:
+                d['_id'         ] = document_id(d)
+                d['content_hash'] = content_hash(d, self.model_id)
+                if d['_id'] in seen:
+                    continue
+                seen.add(d['_id'])
+                self.stats['read'] += 1
+
+                if not self.force and known.get(d['_id']) == d['content_hash']:
+                    self.stats['skipped'] += 1
+                    continue
+
+                batch.append(d)
+                if len(batch) >= self.batch_size:
+                    pending = _flush(batch, pending)
+                    batch   = []
+
+            if batch:
+                pending = _flush(batch, pending)
+            if pending is not None:
+                pending.result()
+
+        if delete:
+            stale = [_id for _id in indexed if _id not in seen]
+            if stale:
+                logger.info(f'Deleting {len(stale)} documents no longer in the sources')
+                self._delete(stale)
+
+        self.es_client.indices.refresh(index = self.index)
+        self.checkpoint.remove()
+
+        logger.info(f'Done ingesting - {self.stats}')
+        return self.stats
+
+
+def index_versions(es_client, alias: str) -> List[str]:
+    '''Get the versions (physical indices `<alias>-<version>`) of the index, oldest first.'''
+    return sorted(es_client.indices.get(index = f'{alias}-*', ignore_unavailable = True, allow_no_indices = True).keys())
+
+
+def aliased_indices(es_client, alias: str) -> List[str]:
+    '''Get the physical indices behind the alias (empty if it is not an alias).'''
+    if not es_client.indices.exists_alias(name = alias):
+        return []
+    return list(es_client.indices.get_alias(name = alias).keys())
+
+
+def seed_index(
+    es_client           ,
+    source  : str       ,
+    dest    : str
+    ) -> None:
+    '''Copy the documents of the current version into the new one, so only the changes get encoded.'''
+    if not es_client.indices.exists(index = source):
+        return
+    logger.info(f'Copying {source} into {dest}')
+    es_client.reindex(
+        body                = {'source': {'index': source}, 'dest': {'index': dest}},
+        wait_for_completion = True  ,
+        refresh             = True  ,
+        request_timeout     = 6 * 3600)
+
+
+def validate_index(
+    es_client               ,
+    index       : str       ,
+    alias       : str       ,
+    min_ratio   : float = 0.9
+    ) -> None:
+    '''Check the new version of the index before switching the alias to it.
+
+    The new version must not be empty, must hold at least `min_ratio` of the
+    documents of the current version, and a document must be found by the
+    vector search with its own vector.
+
+    Raises:
+        IngestValidationError: If any of the checks failed.
+    '''
+    from actions.es.retriever import ESScriptRetriever, SearchRequest
+
+    es_client.indices.refresh(index = index)
+    count = es_client.count(index = index)['count']
+    if count == 0:
+        raise IngestValidationError(f'Index {index} is empty')
+
+    if es_client.indices.exists(index = alias):
+        current = es_client.count(index = alias)['count']
+        if count < min_ratio * current:
+            raise IngestValidationError(f'Index {index} has {count} documents, the current version has {current}')
+
+    response = es_client.search(index = index, body = {
+        'size'      : 1,
+        'query'     : {'nested': {'path': 'vectors', 'query': {'exists': {'field': 'vectors.name'}}}},
+        '_source'   : ['vectors.vector']})
+    sample = response['hits']['hits'][0]
+    body = ESScriptRetriever(None, index)._body(SearchRequest(sample['_source']['vectors'][0]['vector'], 10))
+    hits = es_client.search(index = index, body = body)['hits']['hits']
+    if sample['_id'] not in [h['_id'] for h in hits]:
+        raise IngestValidationError(f'Document {sample["_id"]} of index {index} is not found by its own vector')
+
+    logger.info(f'Index {index} validated - {count} documents')
+
+
+def swap_aliases(es_client, aliases: dict) -> None:
+    '''Point the aliases to the new versions in one atomic update.
+
+    A concrete index with the name of the alias (from before the versioning)
+    is deleted in the same update.
+
+    Args:
+        aliases (dict): New index of every alias.
+    '''
+    actions = []
+    for alias, index in aliases.items():
+        current = aliased_indices(es_client, alias)
+        if current:
+            actions.extend([{'remove': {'index': i, 'alias': alias}} for i in current])
+        elif es_client.indices.exists(index = alias):
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': index, 'alias': alias}})
+
+    es_client.indices.update_aliases(body = {'actions': actions})
+    logger.info(f'Switched aliases - {aliases}')
+
+
+def prune_versions(
+    es_client       ,
+    alias   : str   ,
+    keep    : int = 2
+    ) -> None:
+    '''Delete the old versions of the index, keeping the `keep` latest (and the aliased ones).'''
+    current = set(aliased_indices(es_client, alias))
+    for index in [i for i in index_versions(es_client, alias) if i not in current][:-keep or None]:
+        logger.info(f'Deleting old version {index}')
+        es_client.indices.delete(index = index, ignore = 404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Ingest the source data into ES (incrementally, resuming interrupted runs).')
+    parser.add_argument('--data-dir'            , default = os.path.join(os.path.dirname(__file__), 'data'),    help = 'folder with the source data')
+    parser.add_argument('--sources'             , default = None,               help = 'comma separated sources to ingest (all by default, implies --no-delete)')
+    parser.add_argument('--batch-size'          , default = 256 , type = int,   help = 'documents per batch')
+    parser.add_argument('--pipe-batch-size'     , default = 64  , type = int,   help = 'batch size of the sentence splitting')
+    parser.add_argument('--n-process'           , default = 1   , type = int,   help = 'processes of the sentence splitting')
+    parser.add_argument('--encode-batch-size'   , default = 64  , type = int,   help = 'batch size of the encoding')
+    parser.add_argument('--bulk-threads'        , default = 4   , type = int,   help = 'threads of the bulk writes')
+    parser.add_argument('--checkpoint'          , default = '/var/tmp/ingest_checkpoint.jsonl', help = 'checkpoint file (empty to disable)')
+    parser.add_argument('--chunks'              , action = 'store_true',        help = 'also write the chunk index (for es_retrieval = knn)')
+    parser.add_argument('--vector-store'        , default = None,               help = 'also write the vector store into the folder (for es_retrieval = local)')
+    parser.add_argument('--recreate'            , action = 'store_true',        help = 'drop and recreate the indices')
+    parser.add_argument('--force'               , action = 'store_true',        help = 're-embed unchanged documents (i.e. after changing the synonym list)')
+    parser.add_argument('--no-delete'           , action = 'store_true',        help = 'keep the documents no longer in the sources')
+    parser.add_argument('--new-version'         , action = 'store_true',        help = 'ingest into a new version of the indices and switch the aliases to it once validated')
+    parser.add_argument('--keep-versions'       , default = 2   , type = int,   help = 'old versions of the indices to keep')
+    parser.add_argument('--min-ratio'           , default = 0.9 , type = float, help = 'minimum ratio of documents of the new version to the current one')
+    parser.add_argument('--dims'                , default = 0   , type = int,   help = 'reduce the vectors to the dimensions (0 keeps all, implied by an existing projection)')
+    parser.add_argument('--projection'          , default = 'pca',              help = 'method of the reduction - pca or truncate')
+    parser.add_argument('--projection-path'     , default = None,               help = 'projection file of the reduced vectors (es_projection_path by default)')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    from elasticsearch import Elasticsearch
+
+    from actions.es import config
+
+    es_client = Elasticsearch(
+        [config.es_host], http_auth = (config.es_username, config.es_password),
+        timeout = 60, max_retries = config.es_max_retries, retry_on_timeout = True)
+
+    sources = args.sources.split(',') if args.sources else None
+
+    if args.chunks:
+        from actions.es.retriever import server_version, knn_min_version
+        if server_version(es_client) < knn_min_version:
+            logger.warning(f'The chunk index needs ES {".".join(map(str, knn_min_version))}+ (kNN search), skipping it')
+            args.chunks = False
+
+    # the index names of config are aliases of the versioned indices (or plain indices before the first version)
+    aliases = {config.es_combined_index: config.es_combined_index}
+    if args.chunks:
+        aliases[config.es_chunk_index] = config.es_chunk_index
+
+    if args.new_version:
+        # resume an interrupted run into a new version, if any
+        previous = Checkpoint(args.checkpoint).index if args.checkpoint else None
+        if  previous and previous.startswith(config.es_combined_index + '-') and es_client.indices.exists(index = previous) \
+            and previous not in aliased_indices(es_client, config.es_combined_index):
+            version = previous[len(config.es_combined_index) + 1:]
+            logger.info(f'Resuming new version {version}')
+        else:
+            version = time.strftime('%Y%m%d-%H%M%S')
+            previous = None
+        aliases = {a: f'{a}-{version}' for a in aliases}
+
+    # the ingested vectors are always of the fp32 model, the other backends only approximate them (loaded
+    # directly, the embedding service of config would also load the configured backend and the caches)
+    from actions.es.embed import load_model
+    model = load_model(config.embed_url, config.embed_cache_dir)
+
+    ingest = Ingest(
+        es_client           = es_client                                         ,
+        model               = model                                             ,
+        model_name          = config.embed_url                                  ,
+        index               = aliases[config.es_combined_index]                 ,
+        chunk_index         = aliases.get(config.es_chunk_index)                ,
+        checkpoint          = args.checkpoint                                   ,
+        batch_size          = args.batch_size                                   ,
+        pipe_batch_size     = args.pipe_batch_size                              ,
+        n_process           = args.n_process                                    ,
+        encode_batch_size   = args.encode_batch_size                            ,
+        bulk_threads        = args.bulk_threads                                 ,
+        force               = args.force                                        ,
+        dims                = args.dims                                         ,
+        projection_method   = args.projection                                   ,
+        projection_path     = args.projection_path or config.es_projection_path )
+    if args.new_version:
+        ingest.create_indices()
+        if previous is None and not args.recreate:
+            for alias, index in aliases.items():
+                seed_index(es_client, alias, index)
+    else:
+        ingest.create_indices(recreate = args.recreate)
+
+    ingest.run(read_documents(args.data_dir, sources), delete = sources is None and not args.no_delete)
+
+    if args.new_version:
+        validate_index(es_client, aliases[config.es_combined_index], config.es_combined_index, min_ratio = args.min_ratio)
+        swap_aliases(es_client, aliases)
+        for alias in aliases:
+            prune_versions(es_client, alias, keep = args.keep_versions)
+
+    if args.vector_store:
+        from actions.es.vectors import export_vector_store
+        export_vector_store(args.vector_store, dtype = config.vector_store_dtype, dims = config.vector_store_dims, method = config.vector_store_projection)
+
+
+if __name__ == '__main__':
+    # python -m actions.es.ingest --help
+    main()
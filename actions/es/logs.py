@@ -0,0 +1,381 @@
+import os
+import glob
+import json
+import time
+import atexit
+import asyncio
+import logging
+
+from typing import List
+from collections import OrderedDict
+
+from elasticsearch import TransportError
+
+logger = logging.getLogger(__name__)
+
+# Adds the entries of the chat history past the `last_offset` of the stored chat (the tracker event offset of
+# its last entry, see `helper._parse_tracker_events`), so retried and replayed saves are idempotent without
+# reading the stored history. The entries arrive in the order of the events, so the history stays ordered.
+# The chats stored (or journaled) before the offsets were kept continue after the timestamp of the last entry.
+append_script = '''
+if (ctx._source.chat_history == null) { ctx._source.chat_history = new ArrayList(); }
+def history = ctx._source.chat_history;
+boolean legacy = ctx._source.last_offset == null;
+long last = legacy ? -1 : ((Number) ctx._source.last_offset).longValue();
+def after = history.isEmpty() ? null : history.get(history.size() - 1).timestamp;
+boolean added = false;
+for (def h : params.history) {
+    boolean add = legacy || h.offset == null ? after == null || h.timestamp.compareTo(after) > 0 : h.offset > last;
+    if (add) {
+        history.add(h);
+        after = h.timestamp;
+        if (h.offset != null) { last = h.offset; }
+        added = true;
+    }
+}
+if (!added) { ctx.op = 'noop'; } else if (last >= 0) { ctx._source.last_offset = last; }
+'''
+
+
+def _merge(pending: dict, chat_export: dict) -> dict:
+    '''Merge the save of the conversation into its pending save (appends are added to it, a whole chat replaces it).'''
+    if pending is None or not chat_export.get('append'):
+        return chat_export
+    merged = dict(pending)
+    merged['chat_history'] = pending['chat_history'] + chat_export['chat_history']
+    return merged
+
+
+class ChatLogWriter:
+    '''Background writer of the chat logs into ES, in `_bulk` batches.
+
+    `write` only queues the conversation, so saving adds no ES round trip to
+    the turn. A conversation is either exported whole, or, if its export is
+    marked with `append`, with only the new entries of its chat history. Both
+    are saved as a scripted upsert adding the entries past the `last_offset` of
+    the stored chat (see `append_script`), so a whole chat replayed from the
+    journal after a newer append does not drop the appended entries. The queue holds one
+    pending save per conversation, saving it again before it was flushed
+    merges into it.
+    The flusher sends a batch once `batch_size` conversations are queued or
+    `flush_interval` seconds passed, and retries the failed ones (all of them
+    if ES is unavailable) `max_retries` times with exponential backoff.
+
+    Conversations that could not be saved, or did not fit into the queue, are
+    appended to the journal (JSON lines, one file per process, so no locking is
+    needed) and saved once ES accepts the batches again. The journals of dead
+    processes are taken over. `stop` saves the queue before the server stops
+    (from its `before_server_stop` listener, while the event loop still runs),
+    and `close` spills whatever is left into the journal on exit.
+    '''
+
+    def __init__(
+        self,
+        client                          ,
+        index           : str           ,
+        queue_size      : int   = 1000  ,
+        batch_size      : int   = 100   ,
+        flush_interval  : float = 2.0   ,
+        max_retries     : int   = 3     ,
+        backoff         : float = 0.5   ,
+        journal_path    : str   = ''    ,
+        request_timeout : float = None
+        ) -> None:
+
+        self.client             = client
+        self.index              = index
+        self.queue_size         = queue_size
+        self.batch_size         = batch_size
+        self.flush_interval     = flush_interval
+        self.max_retries        = max_retries
+        self.backoff            = backoff
+        self.journal_path       = journal_path
+        self.request_timeout    = request_timeout
+
+        self.written    = 0
+        self.flushed    = 0
+        self.spilled    = 0
+
+        self._pending   = OrderedDict()
+        # batch being sent by the flusher - saved again on shutdown, as it may not have reached ES
+        self._inflight  = []
+        self._full      = None
+        self._flusher   = None
+        # replays of the journals back off while ES keeps failing
+        self._failures  = 0
+        self._replay_at = 0.0
+
+        atexit.register(self.close)
+
+    @property
+    def _journal(self) -> str:
+        # the pid is read on every use, so a forked worker journals into its own file
+        return f'{self.journal_path}.{os.getpid()}'
+
+    def _start(self) -> None:
+        '''Start the flusher (within the running event loop, on first use).'''
+        if self._flusher is None:
+            self._full      = asyncio.Event()
+            self._flusher   = asyncio.ensure_future(self._run())
+
+    def write(self, chat_export: dict) -> bool:
+        '''Queue the conversation for saving (merges into its queued version, if any).
+
+        Args:
+            chat_export (dict): Conversation with `chat_id`.
+
+        Returns:
+            bool: If the conversation was accepted - queued, or journaled if the queue is full.
+        '''
+        self._start()
+        self.written += 1
+
+        chat_id = chat_export['chat_id']
+        if chat_id not in self._pending and len(self._pending) >= self.queue_size:
+            logger.warning(f'Chat log queue is full ({self.queue_size}), journaling chat_id - {chat_id}')
+            return self._spill([chat_export])
+
+        self._pending[chat_id] = _merge(self._pending.get(chat_id), chat_export)
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        return True
+
+    def _take(self) -> List[dict]:
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            batch.append(self._pending.popitem(last = False)[1])
+        return batch
+
+    def _params(self) -> dict:
+        return {'request_timeout': self.request_timeout} if self.request_timeout else {}
+
+    async def _bulk(self, docs: List[dict]) -> List[dict]:
+        '''Save the conversations with one `_bulk` request, as scripted upserts (see `append_script`).
+
+        Returns:
+            List[dict]: Conversations failed with a retriable error (the rest is saved, or dropped as invalid).
+        '''
+        body = []
+        for d in docs:
+            doc = {k: v for k, v in d.items() if k != 'append'}
+            offsets = [h['offset'] for h in d['chat_history'] if h.get('offset') is not None]
+            if offsets:
+                doc['last_offset'] = max(offsets)
+            body.extend([
+                {'update': {'_index': self.index, '_id': d['chat_id'], 'retry_on_conflict': 3}},
+                {
+                    'script': {'source': append_script, 'lang': 'painless', 'params': {'history': d['chat_history']}},
+                    'upsert': doc,
+                }
+            ])
+
+        response = await self.client.bulk(body = body, **self._params())
+        if not response.get('errors'):
+            return []
+
+        failed = []
+        for d, item in zip(docs, response['items']):
+            result = next(iter(item.values()))
+            if result.get('status', 200) == 429 or result.get('status', 200) >= 500:
+                failed.append(d)
+            elif 'error' in result:
+                logger.error(f'Chat log rejected by ES, dropping chat_id - {d["chat_id"]} - {result["error"]}')
+        return failed
+
+    async def _send(self, docs: List[dict]) -> List[dict]:
+        '''Save the conversations, retrying the failed ones with exponential backoff.
+
+        Returns:
+            List[dict]: Conversations still not saved after the retries.
+        '''
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                docs = await self._bulk(docs)
+            except (TransportError, asyncio.TimeoutError, OSError) as e:
+                logger.warning(f'Chat log batch of {len(docs)} failed (attempt {attempt + 1}) - {e}')
+            if len(docs) == 0:
+                return []
+        return docs
+
+    def _spill(self, docs: List[dict]) -> bool:
+        '''Append the conversations to the journal of the process.
+
+        Returns:
+            bool: If journaled (False if there is no journal, or it could not be written).
+        '''
+        if not self.journal_path:
+            logger.error(f'No chat log journal, dropping {len(docs)} conversations')
+            return False
+        try:
+            with open(self._journal, 'a') as f:
+                for d in docs:
+                    f.write(json.dumps(d, default = str) + '\n')
+        except OSError as e:
+            logger.error(f'Failed writing the chat log journal, dropping {len(docs)} conversations - {e}')
+            return False
+        self.spilled += len(docs)
+        return True
+
+    def _journals(self) -> List[str]:
+        '''Journal files to replay - the one of this process and the ones of dead processes.'''
+        if not self.journal_path:
+            return []
+
+        paths = []
+        for path in glob.glob(f'{self.journal_path}.*'):
+            pid = path.rsplit('.', 1)[1]
+            if not pid.isdigit():
+                continue
+            if int(pid) != os.getpid():
+                try:
+                    os.kill(int(pid), 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+            paths.append(path)
+        return paths
+
+    def _failed(self) -> None:
+        self._failures  += 1
+        self._replay_at = time.monotonic() + min(60.0, self.flush_interval * 2 ** self._failures)
+
+    async def _replay(self) -> None:
+        '''Save the journaled conversations (the ones failing again are journaled again).'''
+        if time.monotonic() < self._replay_at:
+            return
+
+        for path in self._journals():
+            # take the file over - rename is atomic, so only one process replays a journal of a dead one
+            replay = f'{path}.replay{os.getpid()}'
+            try:
+                os.replace(path, replay)
+            except FileNotFoundError:
+                continue
+
+            docs = OrderedDict()
+            with open(replay) as f:
+                for line in f:
+                    if line.strip():
+                        d = json.loads(line)
+                        docs[d['chat_id']] = _merge(docs.get(d['chat_id']), d)
+            os.remove(replay)
+            logger.info(f'Replaying {len(docs)} journaled conversations from {path}')
+
+            docs = list(docs.values())
+            for i in range(0, len(docs), self.batch_size):
+                self._inflight  = docs[i:]
+                failed          = await self._send(docs[i:i + self.batch_size])
+                self._inflight  = []
+                if failed:
+                    # ES is still unavailable - keep the rest for later
+                    self._spill(failed + docs[i + self.batch_size:])
+                    self._failed()
+                    return
+                self.flushed += min(self.batch_size, len(docs) - i)
+        self._failures = 0
+
+    async def _run(self) -> None:
+        '''Flush the queue on a size or time trigger, and replay the journals when idle.'''
+        await self._replay()
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout = self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            try:
+                if not self._pending:
+                    await self._replay()
+                    continue
+
+                batch           = self._take()
+                self._inflight  = batch
+                failed          = await self._send(batch)
+                self._inflight  = []
+                self.flushed += len(batch) - len(failed)
+                if failed:
+                    logger.error(f'Failed saving {len(failed)} conversations into ES, journaling them')
+                    self._spill(failed)
+                    self._failed()
+                if len(self._pending) >= self.batch_size:
+                    self._full.set()
+            except Exception:
+                logger.exception('Chat log flusher failed')
+
+    def stats(self) -> dict:
+        '''Get the counters of the writer.
+
+        Returns:
+            dict: Conversations written, flushed into ES (or dropped as invalid), appended to the journal and still queued.
+        '''
+        return {
+            'written'   : self.written          ,
+            'flushed'   : self.flushed          ,
+            'spilled'   : self.spilled          ,
+            'queued'    : len(self._pending)    ,
+        }
+
+    def _drain(self) -> List[dict]:
+        '''Take the batch in flight and the queue, merged per conversation.
+
+        The batch in flight may have been saved already, saving it again adds no
+        duplicate entries (see `append_script`).
+        '''
+        docs = OrderedDict()
+        for d in self._inflight + list(self._pending.values()):
+            docs[d['chat_id']] = _merge(docs.get(d['chat_id']), d)
+        self._inflight = []
+        self._pending.clear()
+        return list(docs.values())
+
+    async def stop(self) -> None:
+        '''Stop the flusher and save the queued conversations (the failed ones are journaled).
+
+        Meant for the `before_server_stop` listener of the server, while its event loop still runs.
+        Every batch is tried once, so a down ES does not hold the shutdown for long.
+        '''
+        if self._flusher is not None:
+            flusher, self._flusher = self._flusher, None
+            flusher.cancel()
+            try:
+                await flusher
+            except BaseException:
+                pass
+
+        docs = self._drain()
+        if not docs:
+            return
+        logger.info(f'Saving {len(docs)} queued conversations on shutdown')
+        for i in range(0, len(docs), self.batch_size):
+            batch = docs[i:i + self.batch_size]
+            try:
+                failed = await self._bulk(batch)
+            except (TransportError, asyncio.TimeoutError, OSError) as e:
+                logger.warning(f'Chat log batch of {len(batch)} failed on shutdown - {e}')
+                # ES is unavailable - journal the rest without waiting for it again
+                self._spill(docs[i:])
+                return
+            self.flushed += len(batch) - len(failed)
+            if failed:
+                self._spill(failed)
+
+    def close(self) -> None:
+        '''Spill the queued conversations and the batch in flight into the journal (they are saved on next start).
+
+        Registered with atexit as the last resort - the event loop may be closed by then, so nothing
+        is awaited, and the conversations are spilled before the flusher is touched.
+        '''
+        docs = self._drain()
+        if docs:
+            logger.info(f'Journaling {len(docs)} queued conversations on exit')
+            self._spill(docs)
+
+        if self._flusher is not None:
+            flusher, self._flusher = self._flusher, None
+            if not flusher.get_loop().is_closed():
+                flusher.cancel()
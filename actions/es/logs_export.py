@@ -0,0 +1,279 @@
+import os
+import sys
+import glob
+import time
+import uuid
+import logging
+import argparse
+
+from typing import Iterator
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError('The chat log export needs pyarrow 7+ - pip install -r requirements-local.txt')
+
+
+def _schemas() -> dict:
+    '''Schemas of the exported tables.'''
+    return {
+        'turns': pa.schema([
+            ('chat_id'      , pa.string()           ),
+            ('chat_start'   , pa.timestamp('us')    ),
+            ('turn'         , pa.int32()            ),  # position of the message in the chat
+            ('agent'        , pa.string()           ),
+            ('timestamp'    , pa.timestamp('us')    ),
+            ('text'         , pa.string()           ),
+            ('intent'       , pa.string()           ),
+            ('latency_ms'   , pa.float32()          ),  # bot messages - since the last user message
+            ('n_results'    , pa.int16()            ),
+            ('top_score'    , pa.float32()          ),
+        ]),
+        'results': pa.schema([
+            ('chat_id'      , pa.string()           ),
+            ('turn'         , pa.int32()            ),
+            ('timestamp'    , pa.timestamp('us')    ),
+            ('rank'         , pa.int16()            ),  # 1 for the best result
+            ('url'          , pa.string()           ),
+            ('score'        , pa.float32()          ),
+        ]),
+    }
+
+
+def _timestamp(value: str) -> datetime:
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _score(value) -> float:
+    '''Scores are stored as formatted strings (i.e. '0.73').'''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def flatten_chat(doc: dict) -> tuple:
+    '''Flatten the chat of the logs index into the rows of the turns and the results tables.
+
+    Args:
+        doc (dict): Chat with `chat_id`, `timestamp` and `chat_history`.
+
+    Returns:
+        tuple: Rows of the turns and of the results (lists of dicts).
+    '''
+    chat_id     = doc['chat_id']
+    chat_start  = _timestamp(doc.get('timestamp'))
+    turns       = []
+    results     = []
+    last_user   = None
+    for i, h in enumerate(doc.get('chat_history') or []):
+        timestamp   = _timestamp(h.get('timestamp'))
+        hits        = h.get('results') or []
+        latency     = None
+        if h.get('agent') == 'user':
+            last_user = timestamp
+        elif last_user is not None and timestamp is not None:
+            latency = (timestamp - last_user).total_seconds() * 1000
+
+        scores = [_score(r.get('score')) for r in hits]
+        turns.append({
+            'chat_id'   : chat_id                                           ,
+            'chat_start': chat_start                                        ,
+            'turn'      : i                                                 ,
+            'agent'     : h.get('agent')                                    ,
+            'timestamp' : timestamp                                         ,
+            'text'      : h.get('text')                                     ,
+            'intent'    : h.get('intent')                                   ,
+            'latency_ms': latency                                           ,
+            'n_results' : len(hits)                                         ,
+            'top_score' : max([s for s in scores if s is not None], default = None),
+        })
+        for rank, (r, s) in enumerate(zip(hits, scores)):
+            results.append({
+                'chat_id'   : chat_id   ,
+                'turn'      : i         ,
+                'timestamp' : timestamp ,
+                'rank'      : rank + 1  ,
+                'url'       : r.get('url'),
+                'score'     : s         ,
+            })
+
+    return turns, results
+
+
+def scan_logs(
+    es_client                   ,
+    index       : str           ,
+    after       : str   = None  ,
+    before      : str   = None  ,
+    page_size   : int   = 1000  ,
+    keep_alive  : str   = '2m'
+    ) -> Iterator[dict]:
+    '''Stream the chats of the logs index with a point in time and `search_after`.
+
+    The point in time keeps a consistent view of the index without the
+    server-side state of a scroll, and the pages are sorted by `_shard_doc`,
+    the cheapest order to page in.
+
+    Args:
+        es_client               : ES client (sync).
+        index       (str)       : Logs index.
+        after       (str)       : Chats started at or after the date (ISO). Defaults to None.
+        before      (str)       : Chats started before the date (ISO). Defaults to None.
+        page_size   (int)       : Chats per page. Defaults to 1000.
+        keep_alive  (str)       : Keep alive of the point in time between the pages. Defaults to '2m'.
+
+    Yields:
+        dict: Chats.
+    '''
+    query = {'match_all': {}}
+    if after or before:
+        query = {'range': {'timestamp': {k: v for k, v in [('gte', after), ('lt', before)] if v}}}
+
+    pit = es_client.open_point_in_time(index = index, keep_alive = keep_alive)['id']
+    try:
+        search_after = None
+        while True:
+            body = {
+                'size'  : page_size                         ,
+                'query' : query                             ,
+                'pit'   : {'id': pit, 'keep_alive': keep_alive},
+                'sort'  : [{'_shard_doc': 'asc'}]           ,
+            }
+            if search_after is not None:
+                body['search_after'] = search_after
+
+            response    = es_client.search(body = body)
+            hits        = response['hits']['hits']
+            if len(hits) == 0:
+                return
+            pit         = response.get('pit_id', pit)
+            search_after = hits[-1]['sort']
+
+            for h in hits:
+                yield h['_source']
+    finally:
+        es_client.close_point_in_time(body = {'id': pit})
+
+
+def export_logs(
+    path            : str               ,
+    chats           : Iterator[dict]    ,
+    rows_per_file   : int   = 500000
+    ) -> dict:
+    '''Write the chats into Parquet tables partitioned by the start date of the chat.
+
+    Layout of the export:
+        turns/date=<YYYY-MM-DD>/*.parquet   - one row per message (see `_schemas`)
+        results/date=<YYYY-MM-DD>/*.parquet - one row per result shown by the bot
+
+    The partitions written by the export replace the exported ones, so
+    exporting a range of whole days again updates it.
+
+    Args:
+        path            (str)           : Folder of the export.
+        chats           (Iterator[dict]): Chats of the logs index (see `scan_logs`).
+        rows_per_file   (int)           : Maximum rows of the turns kept in memory per partition. Defaults to 500000.
+
+    Returns:
+        dict: Number of the chats, turns and results exported.
+    '''
+    _require_pyarrow()
+
+    schemas     = _schemas()
+    run         = uuid.uuid4().hex[:8]
+    buffers     = {}
+    written     = set()
+    counts      = {'chats': 0, 'turns': 0, 'results': 0}
+
+    def _flush(date: str) -> None:
+        for table, rows in buffers.pop(date).items():
+            if len(rows) == 0:
+                continue
+            folder = os.path.join(path, table, f'date={date}')
+            if (table, date) not in written:
+                for f in glob.glob(os.path.join(folder, '*.parquet')):
+                    os.remove(f)
+                os.makedirs(folder, exist_ok = True)
+                written.add((table, date))
+            n = len(glob.glob(os.path.join(folder, f'part-{run}-*.parquet')))
+            name = os.path.join(folder, f'part-{run}-{n:05d}.parquet')
+            pq.write_table(pa.Table.from_pylist(rows, schema = schemas[table]), name + '.tmp', compression = 'zstd')
+            os.replace(name + '.tmp', name)
+
+    start = time.monotonic()
+    for chat in chats:
+        turns, results = flatten_chat(chat)
+        chat_start  = _timestamp(chat.get('timestamp'))
+        date        = chat_start.date().isoformat() if chat_start else 'unknown'
+
+        buffer = buffers.setdefault(date, {'turns': [], 'results': []})
+        buffer['turns'  ].extend(turns)
+        buffer['results'].extend(results)
+        if len(buffer['turns']) >= rows_per_file:
+            _flush(date)
+
+        counts['chats'  ] += 1
+        counts['turns'  ] += len(turns)
+        counts['results'] += len(results)
+        if counts['chats'] % 10000 == 0:
+            logger.info(f'Exported {counts["chats"]} chats')
+
+    for date in list(buffers):
+        _flush(date)
+
+    logger.info(
+        f'Exported {counts["chats"]} chats ({counts["turns"]} turns, {counts["results"]} results) '
+        f'into {len(set(d for _, d in written))} partitions in {time.monotonic() - start:.1f} s')
+    return counts
+
+
+def _parse_day(value: str) -> str:
+    '''Parse the date in the format `dd.mm.yyyy` (as the logging report) into ISO.'''
+    return datetime.strptime(value, '%d.%m.%Y').date().isoformat() if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Export the chat logs into Parquet tables partitioned by day, for offline analysis.')
+    parser.add_argument('path'                                  , help = 'folder of the export')
+    parser.add_argument('--after'       , default = None        , help = 'export the chats started at or after the day (dd.mm.yyyy)')
+    parser.add_argument('--before'      , default = None        , help = 'export the chats started before the day (dd.mm.yyyy)')
+    parser.add_argument('--page-size'   , default = 1000        , type = int, help = 'chats per search page')
+    parser.add_argument('--keep-alive'  , default = '2m'        , help = 'keep alive of the point in time')
+    parser.add_argument('--rows-per-file', default = 500000     , type = int, help = 'maximum rows per file')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    from elasticsearch import Elasticsearch
+
+    from actions.es import config
+
+    es_client = Elasticsearch(
+        [config.es_host], http_auth = (config.es_username, config.es_password),
+        timeout = 60, max_retries = config.es_max_retries, retry_on_timeout = True)
+
+    chats = scan_logs(
+        es_client, config.es_logging_index,
+        after       = _parse_day(args.after )   ,
+        before      = _parse_day(args.before)   ,
+        page_size   = args.page_size            ,
+        keep_alive  = args.keep_alive           )
+    export_logs(args.path, chats, rows_per_file = args.rows_per_file)
+
+
+if __name__ == '__main__':
+    # python -m actions.es.logs_export /var/tmp/logs_export --after 01.05.2022
+    main()
@@ -0,0 +1,371 @@
+import os
+import json
+import time
+import bisect
+import inspect
+import logging
+import functools
+import threading
+import contextlib
+import contextvars
+
+from typing import Callable, List
+
+from actions.es import config
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# `sender_id` of the conversation whose action is running (set by `action`, per request task)
+_sender_id  = contextvars.ContextVar('sender_id', default = None)
+_tracer     = None
+
+
+class Histogram:
+    '''Latency histogram with fixed buckets, per label values (Prometheus `histogram` type).
+
+    Observing a value is a bisect and two increments, so it is cheap enough for
+    every stage of every request. The counts are kept per bucket and only made
+    cumulative when rendered.
+
+    If `collect` is given, the series are not observed, but taken from the
+    state of the process (i.e. the counters of the embedding service) when
+    the snapshot is taken.
+    '''
+
+    def __init__(
+        self,
+        name        : str               ,
+        description : str               ,
+        labelnames  : List[str]         ,
+        buckets     : List[float]       ,
+        collect     : Callable  = None
+        ) -> None:
+
+        self.name           = name
+        self.description    = description
+        self.labelnames     = labelnames
+        self.buckets        = sorted(buckets)
+        self.collect        = collect
+
+        # label values -> counts per bucket (the last one is +Inf) and the sum
+        self._series    = {}
+        self._lock      = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        '''Count the value in its bucket.
+
+        Args:
+            value   (float) : Observed value (seconds).
+            labels  (str)   : Values of the labels, in the order of `labelnames`.
+        '''
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i]   += 1
+            series[-1]  += value
+
+    def snapshot(self) -> list:
+        '''Get a copy of the series - `[labels, counts, sum]` each.'''
+        if self.collect is not None:
+            return self.collect()
+        with self._lock:
+            return [[list(labels), series[:-1], series[-1]] for labels, series in self._series.items()]
+
+
+class Sampled:
+    '''Counter or gauge per label values, sampled from the state of the process when the snapshot is taken.
+
+    The counters are kept by the objects they count (i.e. `LRUCache.stats`),
+    so there is nothing to update on the request path.
+    '''
+
+    def __init__(
+        self,
+        name        : str       ,
+        description : str       ,
+        type        : str       ,
+        labelnames  : List[str] ,
+        collect     : Callable
+        ) -> None:
+
+        self.name           = name
+        self.description    = description
+        self.type           = type
+        self.labelnames     = labelnames
+        self.collect        = collect
+
+    def snapshot(self) -> list:
+        '''Get the series - `[labels, value]` each.'''
+        return [[list(labels), value] for labels, value in self.collect().items()]
+
+
+def _caches() -> list:
+    '''Caches of the process loaded so far (`(name, LRUCache)` each, without loading the others).'''
+    caches = [
+        ('embed'            , vars(config).get('embed_cache'     )),
+        ('es_result'        , vars(config).get('es_result_cache' )),
+        ('es_session'       , vars(config).get('es_session_cache')),
+        ('chat_log_offsets' , config.chat_log_offsets             ),
+    ]
+    return [(name, cache) for name, cache in caches if cache is not None]
+
+
+def _cache_requests() -> dict:
+    requests = {}
+    for name, cache in _caches():
+        stats                   = cache.stats()
+        requests[(name, 'hit' )] = stats['hits'  ]
+        requests[(name, 'miss')] = stats['misses']
+    return requests
+
+
+def _cache_entries() -> dict:
+    return {(name,): cache.stats()['size'] for name, cache in _caches()}
+
+
+def _embed_batches() -> list:
+    '''Sizes of the batches encoded by the embedding service of the process (if loaded, see `EmbedService.batch_stats`).'''
+    service = vars(config).get('embed_service')
+    if service is None or service.batches == 0:
+        return []
+    counts = list(service.batch_fill[1:])[:len(embed_batch_size.buckets)]
+    counts += [0] * (len(embed_batch_size.buckets) + 1 - len(counts))
+    return [[[], counts, float(service.batched_texts)]]
+
+
+stage_seconds   = Histogram('actions_stage_seconds'      , 'Latency of the stages of the search pipeline.'  , ['stage']             , config.metrics_buckets)
+action_seconds  = Histogram('actions_action_seconds'     , 'Latency of the actions.'                        , ['action', 'outcome'] , config.metrics_buckets)
+# the mean batch fill is `sum / count / embed_batch_size`
+embed_batch_size = Histogram(
+    'actions_embed_batch_size', 'Number of texts of the batches of the embedding service.', [],
+    list(range(1, max(1, config.embed_batch_size) + 1)), collect = _embed_batches)
+histograms      = [stage_seconds, action_seconds, embed_batch_size]
+# the hit rate of a cache is `hit / (hit + miss)`, the entries are summed up over the workers
+cache_requests  = Sampled('actions_cache_requests_total' , 'Lookups of the caches.'                 , 'counter' , ['cache', 'result'] , _cache_requests)
+cache_entries   = Sampled('actions_cache_entries'        , 'Number of entries kept in the caches.'  , 'gauge'   , ['cache']           , _cache_entries )
+sampled         = [cache_requests, cache_entries]
+
+
+def _get_tracer():
+    '''Tracer of the process (set up on first use, so in every forked worker), None if tracing is not available.'''
+    global _tracer
+    if _tracer is not None:
+        return _tracer
+
+    if trace is None:
+        logger.warning('METRICS_OTEL is set, but opentelemetry-api is not installed - tracing disabled')
+        config.metrics_otel = False
+        return None
+
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        # keep the provider set up elsewhere (i.e. by opentelemetry-instrument)
+        if not isinstance(trace.get_tracer_provider(), TracerProvider):
+            provider = TracerProvider(resource = Resource.create({'service.name': os.getenv('OTEL_SERVICE_NAME', 'rasa-actions')}))
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+            trace.set_tracer_provider(provider)
+            logger.info(f'Exporting the traces over OTLP (pid {os.getpid()})')
+    except ImportError:
+        logger.info('No opentelemetry-sdk with the OTLP exporter, the spans go to the global tracer provider')
+
+    _tracer = trace.get_tracer(__name__)
+    return _tracer
+
+
+def _otel_span(name: str):
+    tracer = _get_tracer() if config.metrics_otel else None
+    if tracer is None:
+        return contextlib.nullcontext()
+    sender_id = _sender_id.get()
+    return tracer.start_as_current_span(name, attributes = {'sender_id': sender_id} if sender_id else None)
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    '''Time the stage of the search pipeline (and trace it as a span of the running action if `metrics_otel` is set).
+
+    Args:
+        stage (str): Name of the stage.
+    '''
+    if not config.metrics_enabled:
+        yield
+        return
+
+    with _otel_span(stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_seconds.observe(time.perf_counter() - start, stage)
+
+
+def timed(stage: str) -> Callable:
+    '''Decorator timing the whole (async) function as the stage (see `span`).'''
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def action(name: str, sender_id: str = None):
+    '''Time the action, with the outcome `ok` or `error` (raised), keeping the `sender_id` for the spans of its stages.
+
+    Args:
+        name        (str): Name of the action.
+        sender_id   (str): Sender id of the conversation. Defaults to None.
+    '''
+    if not config.metrics_enabled:
+        yield
+        return
+
+    token   = _sender_id.set(sender_id)
+    outcome = 'error'
+    start   = time.perf_counter()
+    try:
+        with _otel_span(name):
+            yield
+        outcome = 'ok'
+    finally:
+        action_seconds.observe(time.perf_counter() - start, name, outcome)
+        _sender_id.reset(token)
+
+
+def timed_action(func: Callable) -> Callable:
+    '''Decorator timing the `run` of the action (or the extraction or validation method of the form) (see `action`).
+
+    The label is the name of the action, followed by the name of the method for the methods other than `run`,
+    the `sender_id` is taken from the tracker argument.
+    '''
+    def _args(self, args: tuple, kwargs: dict) -> tuple:
+        name    = self.name() if func.__name__ == 'run' else f'{self.name()}.{func.__name__}'
+        tracker = kwargs.get('tracker', next((a for a in args if hasattr(a, 'sender_id')), None))
+        return name, getattr(tracker, 'sender_id', None)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            with action(*_args(self, args, kwargs)):
+                return await func(self, *args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with action(*_args(self, args, kwargs)):
+                return func(self, *args, **kwargs)
+    return wrapper
+
+
+def snapshot() -> dict:
+    '''Get the series of all the metrics of the process (JSON serialisable, see `render`).'''
+    return {m.name: m.snapshot() for m in histograms + sampled}
+
+
+def _labels(names: List[str], values: List[str], **extra: str) -> str:
+    '''Compose the labels of the sample (with the braces, empty without labels).'''
+    def _escape(v: str) -> str:
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    labels = ','.join(f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra.items()))
+    return f'{{{labels}}}' if labels else ''
+
+
+def render(snapshots: List[dict] = None) -> str:
+    '''Render the metrics in the Prometheus text format.
+
+    Args:
+        snapshots (List[dict]): Snapshots to sum (i.e. of the workers). Defaults to None - the metrics of the process.
+
+    Returns:
+        str: Metrics in the Prometheus text format.
+    '''
+    if snapshots is None:
+        snapshots = [snapshot()]
+
+    lines = []
+    for h in histograms:
+        merged = {}
+        for s in snapshots:
+            for labels, counts, total in s.get(h.name, []):
+                key     = tuple(labels)
+                series  = merged.setdefault(key, [[0] * len(counts), 0.0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+
+        lines.append(f'# HELP {h.name} {h.description}')
+        lines.append(f'# TYPE {h.name} histogram')
+        for key, (counts, total) in sorted(merged.items()):
+            labels      = _labels(h.labelnames, key)
+            cumulative  = 0
+            for bound, count in zip([str(b) for b in h.buckets] + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{h.name}_bucket{_labels(h.labelnames, key, le = bound)} {cumulative}')
+            lines.append(f'{h.name}_sum{labels} {total}')
+            lines.append(f'{h.name}_count{labels} {cumulative}')
+
+    for m in sampled:
+        merged = {}
+        for s in snapshots:
+            for labels, value in s.get(m.name, []):
+                merged[tuple(labels)] = merged.get(tuple(labels), 0) + value
+
+        lines.append(f'# HELP {m.name} {m.description}')
+        lines.append(f'# TYPE {m.name} {m.type}')
+        for key, value in sorted(merged.items()):
+            lines.append(f'{m.name}{_labels(m.labelnames, key)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def start_server(port: int, host: str = '0.0.0.0') -> None:
+    '''Serve the metrics of the process from a background thread.
+
+    `GET /metrics` returns them in the Prometheus text format and
+    `GET /metrics/snapshot` as JSON (summed up by the router of the preforked server).
+
+    Args:
+        port    (int): Port of the endpoint.
+        host    (str): Host of the endpoint. Defaults to '0.0.0.0'.
+    '''
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = render().encode('utf-8'), CONTENT_TYPE
+            elif self.path == '/metrics/snapshot':
+                body, content_type = json.dumps(snapshot()).encode('utf-8'), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type'     , content_type  )
+            self.send_header('Content-Length'   , str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.warning(f'Failed serving the metrics on {host}:{port} - {e}')
+        return
+
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, name = 'metrics', daemon = True).start()
+    logger.info(f'Serving the metrics on {host}:{port}/metrics (pid {os.getpid()})')
@@ -0,0 +1,107 @@
+import os
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Methods of reducing the dimensions of the vectors - principal components of the corpus vectors,
+# or the leading dimensions (Matryoshka-style, only for models trained for it)
+projection_methods = ['pca', 'truncate']
+
+
+class Projection:
+    '''Linear projection of the vectors to fewer dimensions, fitted on the corpus vectors at ingestion.
+
+    The corpus and the query vectors are projected with the same projection
+    and L2-normalised, so cosine similarity of the projected vectors
+    approximates the one of the full vectors.
+
+    The principal components are fitted without centring the vectors (on their
+    second moment instead of the covariance), since subtracting the corpus mean
+    shifts the cosine scores, and the absolute cut-offs of config (`es_cut_off`,
+    `es_followup_confidence`) and the hardcoded queries matched with the full
+    vectors have to stay on the same scale. The `mean` is kept for projections
+    fitted before, and is zero for the new ones.
+    '''
+
+    def __init__(
+        self,
+        method      : str       ,
+        mean        : np.ndarray,
+        components  : np.ndarray
+        ) -> None:
+
+        if method not in projection_methods:
+            raise ValueError(f'Unknown projection method - {method}')
+
+        self.method     = method
+        self.mean       = np.asarray(mean      , dtype = np.float32)
+        self.components = np.asarray(components, dtype = np.float32)
+        self.id         = hashlib.sha1(self.mean.tobytes() + self.components.tobytes()).hexdigest()[:16]
+
+    @property
+    def dims(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(
+        cls,
+        vectors : np.ndarray        ,
+        dims    : int               ,
+        method  : str = 'pca'       ,
+        sample  : int = 100000
+        ) -> 'Projection':
+        '''Fit the projection on the corpus vectors.
+
+        Args:
+            vectors (np.ndarray): Corpus vectors, one per row.
+            dims    (int)       : Dimensions of the projected vectors.
+            method  (str)       : 'pca' or 'truncate'. Defaults to 'pca'.
+            sample  (int)       : Maximum number of vectors the principal components are computed from. Defaults to 100000.
+
+        Returns:
+            Projection: Fitted projection.
+        '''
+        vectors = np.asarray(vectors, dtype = np.float32)
+        if dims >= vectors.shape[1]:
+            raise ValueError(f'Projection to {dims} dimensions of {vectors.shape[1]} dimensional vectors')
+
+        if method == 'truncate':
+            return cls(method, np.zeros(vectors.shape[1]), np.eye(vectors.shape[1], dims))
+
+        if vectors.shape[0] < dims:
+            raise ValueError(f'Fitting {dims} principal components needs at least as many vectors, got {vectors.shape[0]}')
+        if vectors.shape[0] > sample:
+            vectors = vectors[np.random.default_rng(0).choice(vectors.shape[0], sample, replace = False)]
+
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis = 1, keepdims = True), 1e-12)
+        _, s, vt = np.linalg.svd(vectors, full_matrices = False)
+        explained = (s[:dims] ** 2).sum() / (s ** 2).sum()
+        logger.info(f'Fitted PCA projection to {dims} dimensions - explained energy {explained * 100:.2f}%')
+
+        return cls(method, np.zeros(vectors.shape[1]), vt[:dims].T)
+
+    @property
+    def centred(self) -> bool:
+        '''If the projection subtracts a mean (fitted before the uncentred components), which shifts the cosine scores.'''
+        return bool(np.any(self.mean))
+
+    @classmethod
+    def load(cls, path: str) -> 'Projection':
+        with np.load(path) as p:
+            return cls(str(p['method']), p['mean'], p['components'])
+
+    def save(self, path: str) -> None:
+        '''Save the projection (through a temporary file, so readers never see it half written).'''
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, method = self.method, mean = self.mean, components = self.components)
+        os.replace(path + '.tmp', path)
+
+    def apply(self, vectors: np.ndarray) -> np.ndarray:
+        '''Project the vectors (one per row) and L2-normalise them.'''
+        vectors = np.asarray(vectors, dtype = np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis = -1, keepdims = True), 1e-12)
+        vectors = (vectors - self.mean) @ self.components
+        return vectors / np.maximum(np.linalg.norm(vectors, axis = -1, keepdims = True), 1e-12)
@@ -0,0 +1,605 @@
+import os
+import time
+import asyncio
+import logging
+
+from typing import List, NamedTuple
+from collections import OrderedDict
+
+import numpy as np
+
+from elasticsearch import TransportError
+
+from actions.es.vectors import VectorStore
+from actions.es.projection import Projection
+
+logger = logging.getLogger(__name__)
+
+# Fields of the documents returned with hits
+source_fields   = ['source', 'url', 'title', 'description', 'identification', 'development', 'damage', 'management', 'links']
+# Fields needed for filtering and ranking, the rest is fetched for the final results only
+light_fields    = ['source', 'url']
+# Approximate kNN search (the `knn` option of the search API over indexed `dense_vector` fields) needs ES 8.4+
+knn_min_version = (8, 4)
+
+
+def server_version(es_client) -> tuple:
+    '''Get the version of the ES server.
+
+    Args:
+        es_client: ES client (sync).
+
+    Returns:
+        tuple: Major and minor version.
+    '''
+    number = es_client.info()['version']['number']
+    return tuple(int(v) for v in number.split('.')[:2])
+
+
+class SearchRequest(NamedTuple):
+    '''Single search of `Retriever.search_many`.'''
+    vector  : np.ndarray
+    size    : int
+    sources : List[str] = None  # search only the documents of these sources (None for all)
+    exclude : List[str] = None  # skip the documents of these sources
+    ids     : List[str] = None  # search only the documents of these ids (i.e. rescore known candidates)
+
+
+class Retriever:
+    '''Interface of the retrieval backends.
+
+    Retrieval is done in two phases. `search` returns the hits with the
+    fields of `light_fields` (backends may return more) along with the
+    following fields:
+        _id         - id of the document
+        _score      - cosine similarity of the best matching chunk of the document
+        top_scores  - up to 3 best matching chunks of the document, as dicts of
+                      `score` and `source` (the `name`, `start`, `end` of the chunk)
+    Once the hits are filtered and ranked, `fetch` fills in the rest of the
+    fields of `source_fields` for the final results only.
+
+    If the searched vectors are reduced, the query vectors have to be
+    projected with `projection` before searching.
+    '''
+
+    projection: Projection = None
+
+    async def search(
+        self,
+        query_vector    : np.ndarray        ,
+        size            : int               ,
+        sources         : List[str] = None  ,
+        exclude         : List[str] = None  ,
+        ids             : List[str] = None
+        ) -> list:
+        '''Find the documents closest to the query.
+
+        Args:
+            query_vector    (np.ndarray): Query vector.
+            size            (int)       : Number of documents to return.
+            sources         (List[str]) : Search only the documents of these sources. Defaults to None (all).
+            exclude         (List[str]) : Skip the documents of these sources. Defaults to None.
+            ids             (List[str]) : Search only the documents of these ids. Defaults to None (all).
+
+        Returns:
+            list: Return hits, sorted by score.
+        '''
+        raise NotImplementedError
+
+    async def search_many(self, requests: List[SearchRequest]) -> List[list]:
+        '''Run several searches at once, concurrently.
+
+        Args:
+            requests (List[SearchRequest]): Searches to run.
+
+        Returns:
+            List[list]: Return hits of every search.
+        '''
+        return list(await asyncio.gather(*[self.search(*r) for r in requests]))
+
+    async def fetch(self, hits: list) -> list:
+        '''Fill in the document bodies of the hits.
+
+        Args:
+            hits (list): Hits returned by `search` (hits that already have the bodies are kept as is).
+
+        Returns:
+            list: Hits with the fields of `source_fields`.
+        '''
+        return hits
+
+    async def generation(self) -> str:
+        '''Get the generation of the searched data (changes whenever the data is re-ingested).'''
+        raise NotImplementedError
+
+
+class ESRetriever(Retriever):
+    '''Base of the ES retrieval backends.'''
+
+    def __init__(
+        self,
+        client                  ,
+        indices         : list  ,
+        generation_ttl  : float = 30,
+        request_timeout : float = None,
+        projection      : Projection = None
+        ) -> None:
+
+        self.client             = client
+        self.indices            = indices
+        self.generation_ttl     = generation_ttl
+        self.request_timeout    = request_timeout
+        self.projection         = projection
+
+        self._generation    = None
+        self._checked       = 0.0
+
+    async def generation(self) -> str:
+        '''Get the generation of the searched indices.
+
+        The generation is composed of the names and UUIDs of the physical indices
+        behind the index names (or aliases), so it changes on every re-ingestion
+        and on every switch of the aliases to a new version of the indices. It is
+        refreshed at most every `generation_ttl` seconds.
+
+        Returns:
+            str: Index generation.
+        '''
+        now = time.monotonic()
+        if self._generation is None or now - self._checked > self.generation_ttl:
+            response = await self.client.indices.get_settings(
+                index   = ','.join(self.indices),
+                name    = 'index.uuid'          )
+            self._generation = ','.join(sorted(
+                f'{k}:{v["settings"]["index"]["uuid"]}' for k, v in response.items()))
+            self._checked = now
+
+        return self._generation
+
+    def _params(self) -> dict:
+        '''Per-request parameters of the client calls.'''
+        return {'request_timeout': self.request_timeout} if self.request_timeout else {}
+
+    async def _msearch(self, index: str, bodies: List[dict]) -> List[dict]:
+        '''Run the search bodies in one `_msearch` round trip (or a plain search for a single body).
+
+        Args:
+            index   (str)       : Index to search.
+            bodies  (List[dict]): Search bodies.
+
+        Raises:
+            TransportError: If any of the searches failed.
+
+        Returns:
+            List[dict]: Responses, one per body.
+        '''
+        if len(bodies) == 1:
+            return [await self.client.search(index = index, body = bodies[0], **self._params())]
+
+        searches = []
+        for b in bodies:
+            searches.extend([{'index': index}, b])
+
+        response = await self.client.msearch(body = searches, **self._params())
+
+        for r in response['responses']:
+            if 'error' in r:
+                raise TransportError(r.get('status', 500), r['error'].get('type', 'msearch'), r['error'])
+
+        return response['responses']
+
+    def _source_filter(
+        self,
+        sources : List[str]         ,
+        exclude : List[str]         ,
+        ids     : List[str] = None  ,
+        id_field: str       = None
+        ) -> dict:
+        '''Compose the `bool` query clauses filtering the documents by source (and by id,
+        the `_id` of the documents or the `id_field` of the chunks pointing to them).'''
+        clauses = {}
+        filters = []
+        if sources is not None:
+            filters.append({"terms": {"source": sources}})
+        if ids is not None:
+            filters.append({"terms": {id_field: ids}} if id_field else {"ids": {"values": ids}})
+        if filters:
+            clauses['filter'    ] = filters if len(filters) > 1 else filters[0]
+        if exclude:
+            clauses['must_not'  ] = {"terms": {"source": exclude}}
+        return clauses
+
+    async def search(
+        self,
+        query_vector    : np.ndarray        ,
+        size            : int               ,
+        sources         : List[str] = None  ,
+        exclude         : List[str] = None  ,
+        ids             : List[str] = None
+        ) -> list:
+        '''Execute vector search in ES.
+
+        Args:
+            query_vector    (np.ndarray): Query vector.
+            size            (int)       : Number of documents to return.
+            sources         (List[str]) : Search only the documents of these sources. Defaults to None (all).
+            exclude         (List[str]) : Skip the documents of these sources. Defaults to None.
+            ids             (List[str]) : Search only the documents of these ids. Defaults to None (all).
+
+        Returns:
+            list: Return hits.
+        '''
+        return (await self.search_many([SearchRequest(query_vector, size, sources, exclude, ids)]))[0]
+
+    async def fetch(self, hits: list) -> list:
+        '''Fill in the document bodies of the hits with a single `mget` from the combined index.
+
+        Args:
+            hits (list): Hits returned by `search` (hits that already have the bodies are kept as is).
+
+        Returns:
+            list: Hits with the fields of `source_fields` (documents deleted in the meantime are dropped).
+        '''
+        ids = [h['_id'] for h in hits if not all(f in h for f in source_fields)]
+        if len(ids) == 0:
+            return hits
+
+        response = await self.client.mget(
+            index               = self.index    ,
+            body                = {'ids': ids}  ,
+            _source_includes    = source_fields ,
+            **self._params()
+        )
+        docs = {d['_id']: d['_source'] for d in response['docs'] if d.get('found', False)}
+
+        res = []
+        for h in hits:
+            if all(f in h for f in source_fields):
+                res.append(h)
+            elif h['_id'] in docs:
+                h.update(docs[h['_id']])
+                res.append(h)
+
+        return res
+
+
+class ESScriptRetriever(ESRetriever):
+    '''Exact search with `script_score` over the nested vectors of the combined index.'''
+
+    def __init__(
+        self,
+        client                  ,
+        index           : str   ,
+        generation_ttl  : float = 30,
+        request_timeout : float = None,
+        projection      : Projection = None
+        ) -> None:
+
+        super().__init__(client, [index], generation_ttl = generation_ttl, request_timeout = request_timeout, projection = projection)
+        self.index = index
+
+    def _body(self, request: SearchRequest) -> dict:
+        '''Compose the search body of vector search based on cosine similarity.'''
+        vector_name     = 'vectors.vector'
+        source_nested   = {'includes': ['vectors.name', 'vectors.start', 'vectors.end']}
+
+        cos     = f'cosineSimilarity(params.query_vector, "{vector_name}") + 1.0'
+        script  = {"source": cos, "params": {"query_vector": request.vector}}
+
+        source_query = {'includes': light_fields}
+
+        path = vector_name.split('.')[0]
+        query = {
+            "bool": {
+                "must": {"nested": {
+                            "score_mode": "max" ,
+                            "path"      : path  ,
+                            "inner_hits": {"size": 3, "name": "nested", "_source": source_nested},
+                            "query"     : {"function_score": {"script_score": {"script": script}}}}
+                },
+            }
+        }
+        query['bool'].update(self._source_filter(request.sources, request.exclude, request.ids))
+
+        return {"query": query, "size": request.size, "_source": source_query}
+
+    async def search_many(self, requests: List[SearchRequest]) -> List[list]:
+        '''Exectute vector searches in ES based on cosine similarity, in one round trip.
+
+        Args:
+            requests (List[SearchRequest]): Searches to run.
+
+        Returns:
+            List[list]: Return hits of every search.
+        '''
+        responses = await self._msearch(self.index, [self._body(r) for r in requests])
+
+        results = []
+        for response in responses:
+            hits = []
+
+            for h1 in response['hits']['hits']:
+                top_scores = []
+
+                for h2 in h1['inner_hits']['nested']['hits']['hits']:
+                    top_scores.append({'score': h2['_score'] - 1, 'source': h2['_source']})
+
+                h1['_source']['top_scores'  ] = top_scores
+                h1['_source']['_id'         ] = h1['_id'    ]
+                h1['_source']['_score'      ] = h1['_score' ] - 1
+
+                hits.append(h1['_source'])
+
+            results.append(hits)
+
+        return results
+
+
+class ESKnnRetriever(ESRetriever):
+    '''Approximate kNN (HNSW) search in ES over the flattened chunk index.
+
+    Every document of the combined index is stored in the chunk index as one
+    document per sentence window (`doc_id`, `name`, `start`, `end`, `vector`).
+    The closest chunks are grouped by document, and the `source` and `url`
+    of the documents are then fetched from the combined index. Requires ES 8.4+.
+    '''
+
+    def __init__(
+        self,
+        client                  ,
+        index           : str   ,
+        chunk_index     : str   ,
+        num_candidates  : int   = 500,
+        chunks_per_doc  : int   = 3,
+        generation_ttl  : float = 30,
+        request_timeout : float = None,
+        projection      : Projection = None
+        ) -> None:
+
+        super().__init__(client, [index, chunk_index], generation_ttl = generation_ttl, request_timeout = request_timeout, projection = projection)
+        self.index          = index
+        self.chunk_index    = chunk_index
+        self.num_candidates = num_candidates
+        self.chunks_per_doc = chunks_per_doc
+
+    def _body(self, request: SearchRequest) -> dict:
+        '''Compose the search body of approximate kNN search.'''
+        k = request.size * self.chunks_per_doc
+
+        knn = {
+            "field"         : "vector"                          ,
+            "query_vector"  : request.vector                    ,
+            "k"             : k                                 ,
+            "num_candidates": max(self.num_candidates, k)       ,
+        }
+        clauses = self._source_filter(request.sources, request.exclude, request.ids, id_field = 'doc_id')
+        if clauses:
+            knn['filter'] = {"bool": clauses}
+
+        return {"knn": knn, "size": k, "_source": ['doc_id', 'name', 'start', 'end']}
+
+    async def search_many(self, requests: List[SearchRequest]) -> List[list]:
+        '''Execute approximate kNN searches in ES, in one round trip (plus one `mget` for all of them).
+
+        Args:
+            requests (List[SearchRequest]): Searches to run.
+
+        Returns:
+            List[list]: Return hits of every search.
+        '''
+        responses = await self._msearch(self.chunk_index, [self._body(r) for r in requests])
+
+        groups = []
+        for request, response in zip(requests, responses):
+            # chunks come sorted by score, so the first chunk of a document is its best one
+            docs = OrderedDict()
+            for h in response['hits']['hits']:
+                chunk       = h['_source']
+                top_scores  = docs.setdefault(chunk['doc_id'], [])
+                if len(top_scores) < 3:
+                    # ES scores cosine similarity as (1 + cos) / 2
+                    top_scores.append({
+                        'score' : 2 * h['_score'] - 1,
+                        'source': {'name': chunk['name'], 'start': chunk['start'], 'end': chunk['end']}
+                    })
+
+            groups.append(OrderedDict(list(docs.items())[:request.size]))
+
+        ids = list(set(i for docs in groups for i in docs))
+        if len(ids) == 0:
+            return [[] for _ in groups]
+
+        response = await self.client.mget(
+            index               = self.index    ,
+            body                = {'ids': ids}  ,
+            _source_includes    = light_fields  ,
+            **self._params()
+        )
+        found = {d['_id']: d['_source'] for d in response['docs'] if d.get('found', False)}
+
+        results = []
+        for docs in groups:
+            hits = []
+
+            for i, top_scores in docs.items():
+                if i not in found:
+                    continue
+
+                hit = dict(found[i])
+                hit['top_scores'] = top_scores
+                hit['_id'       ] = i
+                hit['_score'    ] = top_scores[0]['score']
+
+                hits.append(hit)
+
+            results.append(hits)
+
+        return results
+
+
+class _StoreView:
+    '''Vector store with the lookups of the chunk groups (the chunks of every document).'''
+
+    def __init__(self, store: VectorStore) -> None:
+
+        self.store      = store
+
+        # the chunks are stored grouped by document, find where every group starts
+        doc             = np.asarray(store.chunk_doc)
+        self._starts    = np.flatnonzero(np.r_[True, doc[1:] != doc[:-1]]) if len(doc) > 0 else np.zeros(0, dtype = np.int64)
+        self._ends      = np.r_[self._starts[1:], len(doc)].astype(np.int64)
+        self._docs      = doc[self._starts]
+        self._sources   = np.asarray(store.doc_source)[self._docs]
+        self._group_of  = None
+
+    def _codes(self, sources: List[str]) -> List[int]:
+        return [self.store.sources.index(s) for s in sources if s in self.store.sources]
+
+    def _groups(self, ids: List[str]) -> np.ndarray:
+        '''Chunk groups of the documents of the ids (the id lookup is built on first use).'''
+        if self._group_of is None:
+            self._group_of = {self.store.document(int(d))['_id']: g for g, d in enumerate(self._docs)}
+        return np.unique([self._group_of[i] for i in ids if i in self._group_of]).astype(np.int64)
+
+    def search(
+        self,
+        query_vector    : np.ndarray,
+        size            : int       ,
+        sources         : List[str] ,
+        exclude         : List[str] ,
+        ids             : List[str] = None
+        ) -> list:
+        if len(self._starts) == 0:
+            return []
+
+        if ids is None:
+            groups  = np.arange(len(self._starts))
+            starts  = self._starts
+            rows    = None
+        else:
+            # score only the chunks of the documents of the ids
+            groups  = self._groups(ids)
+            if len(groups) == 0:
+                return []
+            lengths = self._ends[groups] - self._starts[groups]
+            starts  = np.r_[0, np.cumsum(lengths)[:-1]].astype(np.int64)
+            rows    = np.repeat(self._starts[groups] - starts, lengths) + np.arange(lengths.sum())
+        ends        = np.r_[starts[1:], len(rows) if rows is not None else len(self.store.chunk_doc)].astype(np.int64)
+
+        scores      = self.store.scores(query_vector, rows = rows)
+        doc_scores  = np.maximum.reduceat(scores, starts)
+        if sources is not None or exclude:
+            allowed = np.ones(len(doc_scores), dtype = bool)
+            if sources is not None:
+                allowed &= np.isin(self._sources[groups], self._codes(sources))
+            if exclude:
+                allowed &= ~np.isin(self._sources[groups], self._codes(exclude))
+            doc_scores  = np.where(allowed, doc_scores, -np.inf)
+            size        = min(size, int(allowed.sum()))
+        size        = min(size, len(doc_scores))
+        if size == 0:
+            return []
+        top         = np.argpartition(-doc_scores, size - 1)[:size]
+        top         = top[np.argsort(-doc_scores[top], kind = 'stable')]
+
+        hits = []
+        for t in top:
+            start, end  = starts[t], ends[t]
+            best        = start + np.argsort(-scores[start:end], kind = 'stable')[:3]
+
+            hit = self.store.document(int(self._docs[groups[t]]))
+            hit['top_scores'] = [{
+                'score' : float(scores[c]),
+                'source': self.store.chunk(int(c if rows is None else rows[c]))} for c in best]
+            hit['_score'] = float(doc_scores[t])
+
+            hits.append(hit)
+
+        return hits
+
+
+class LocalRetriever(Retriever):
+    '''Exact in-process search over the memory-mapped vector store.
+
+    The whole chunk matrix is scored with one matrix-vector product in a
+    worker thread (NumPy releases the GIL), so no ES round trip is involved.
+    The documents are read from the store along with the hits, so there is
+    nothing left to fetch.
+
+    If the folder of the store is given, the `CURRENT` generation is checked
+    at most every `generation_ttl` seconds on search (see `_refresh`) and a new
+    one is opened in place of the served one. Searches already running finish
+    on the generation they started with.
+    '''
+
+    def __init__(
+        self,
+        store           : VectorStore       ,
+        path            : str       = None  ,
+        generation_ttl  : float     = 30
+        ) -> None:
+
+        self.path           = path
+        self.generation_ttl = generation_ttl
+
+        self._view          = _StoreView(store)
+        self._checked       = time.monotonic()
+
+    @property
+    def store(self) -> VectorStore:
+        return self._view.store
+
+    @property
+    def projection(self) -> Projection:
+        return self._view.store.projection
+
+    async def search(
+        self,
+        query_vector    : np.ndarray        ,
+        size            : int               ,
+        sources         : List[str] = None  ,
+        exclude         : List[str] = None  ,
+        ids             : List[str] = None
+        ) -> list:
+        '''Execute exact vector search over the local vector store.
+
+        Args:
+            query_vector    (np.ndarray): Query vector.
+            size            (int)       : Number of documents to return.
+            sources         (List[str]) : Search only the documents of these sources. Defaults to None (all).
+            exclude         (List[str]) : Skip the documents of these sources. Defaults to None.
+            ids             (List[str]) : Search only the documents of these ids (scoring only their chunks). Defaults to None (all).
+
+        Returns:
+            list: Return hits.
+        '''
+        await self._refresh()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._view.search, query_vector, size, sources, exclude, ids)
+
+    async def _refresh(self) -> None:
+        '''Open the `CURRENT` generation of the store folder in place of the served one if it changed
+        (checked at most every `generation_ttl` seconds, see `write_vector_store`).'''
+        now = time.monotonic()
+        if self.path is None or now - self._checked <= self.generation_ttl:
+            return
+
+        self._checked = now
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                current = f.read().strip()
+            if current != self.store.generation:
+                loop        = asyncio.get_event_loop()
+                self._view  = await loop.run_in_executor(None, lambda: _StoreView(VectorStore(os.path.join(self.path, current))))
+                logger.info(f'Opened generation {current} of the vector store - {len(self.store)} documents')
+        except IOError as e:
+            logger.warning(f'Failed opening the current generation of the vector store, serving {self.store.generation} - {e}')
+
+    async def generation(self) -> str:
+        '''Get the generation of the served vector store (opening the current one if it changed, see `_refresh`).
+
+        Returns:
+            str: Store generation.
+        '''
+        await self._refresh()
+        return self.store.generation
@@ -0,0 +1,278 @@
+import gc
+import os
+import re
+import time
+import zlib
+import signal
+import asyncio
+import logging
+import argparse
+
+from typing import Callable, Dict, List
+
+from actions.es import config, metrics
+
+logger = logging.getLogger(__name__)
+
+# `sender_id` of the action request (the tracker repeats the same one, so the first occurrence is enough)
+_sender_id_re = re.compile(rb'"sender_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_next_action_re = re.compile(rb'"next_action"\s*:\s*"([^"]*)"')
+# Actions changing the config of the process (the debug parameters), run by every worker
+broadcast_actions = ['action_set_parameter']
+
+
+class _Stop(Exception):
+    '''Raised by the signal handler of the supervisor.'''
+
+
+def route(sender_id: str, workers: int) -> int:
+    '''Worker of the conversation - stable across restarts, so per-conversation state stays in one worker.
+
+    Args:
+        sender_id   (str): Sender id of the conversation.
+        workers     (int): Number of workers.
+
+    Returns:
+        int: Index of the worker.
+    '''
+    return zlib.crc32(sender_id.encode('utf-8')) % workers
+
+
+def is_broadcast(body: bytes) -> bool:
+    '''If the action request has to be run by every worker (see `broadcast_actions`).'''
+    match = _next_action_re.search(body) if body else None
+    return match is not None and match.group(1).decode('utf-8', 'replace') in broadcast_actions
+
+
+def _set_threads(threads: int) -> None:
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def _worker_ready_file(index: int) -> str:
+    return f'{config.ready_file}.{index}' if config.ready_file else ''
+
+
+def _run_worker(index: int, port: int, metrics_port: int, threads: int) -> None:
+    '''Run the rasa_sdk action server of the worker (in the forked process).'''
+    os.environ['SANIC_HOST'] = '127.0.0.1'
+    os.environ.pop('ACTION_SERVER_SANIC_WORKERS', None)
+    config.ready_file   = _worker_ready_file(index)
+    # the metrics of the worker are summed up by the router
+    config.metrics_host = '127.0.0.1'
+    config.metrics_port = metrics_port
+    _set_threads(threads)
+
+    from rasa_sdk import endpoint
+
+    logger.info(f'Worker {index} (pid {os.getpid()}) - serving on 127.0.0.1:{port} with {threads} threads')
+    endpoint.run('actions', port = port)
+
+
+def _run_router(port: int, worker_ports: List[int], metrics_ports: List[int]) -> None:
+    '''Run the router forwarding the action requests to the worker of their `sender_id` (in the forked process).'''
+    from aiohttp import web, ClientSession, ClientTimeout
+
+    ready_files = [_worker_ready_file(i) for i in range(len(worker_ports))]
+
+    def _ready() -> bool:
+        return all(os.path.isfile(f) for f in ready_files)
+
+    async def _watch_ready(app: web.Application) -> None:
+        # the ready file of the server is there while all the workers are warmed up
+        was_ready = False
+        while True:
+            is_ready = _ready()
+            if is_ready != was_ready:
+                logger.info(f'All {len(worker_ports)} workers are ready' if is_ready else 'A worker is not ready')
+                if config.ready_file and is_ready:
+                    with open(config.ready_file, 'w') as f:
+                        f.write(str(os.getpid()))
+                elif config.ready_file and os.path.isfile(config.ready_file):
+                    os.remove(config.ready_file)
+            was_ready = is_ready
+            await asyncio.sleep(1.0)
+
+    async def _on_startup(app: web.Application) -> None:
+        app['session'] = ClientSession(timeout = ClientTimeout(total = None), auto_decompress = False)
+        app['watcher'] = asyncio.ensure_future(_watch_ready(app))
+
+    async def _on_cleanup(app: web.Application) -> None:
+        app['watcher'].cancel()
+        await app['session'].close()
+
+    async def _handle_ready(request: web.Request) -> web.Response:
+        if _ready():
+            return web.json_response({'status': 'ready', 'workers': len(worker_ports)})
+        return web.json_response({'status': 'warming up', 'workers': len(worker_ports)}, status = 503)
+
+    async def _handle_metrics(request: web.Request) -> web.Response:
+        # the histograms of all the workers summed up
+        snapshots = []
+        for p in metrics_ports:
+            try:
+                async with request.app['session'].get(f'http://127.0.0.1:{p}/metrics/snapshot', timeout = ClientTimeout(total = 2.0)) as response:
+                    snapshots.append(await response.json())
+            except Exception as e:
+                logger.warning(f'Failed getting the metrics of the worker on port {p} - {e}')
+        return web.Response(body = metrics.render(snapshots).encode('utf-8'), headers = {'Content-Type': metrics.CONTENT_TYPE})
+
+    async def _handle(request: web.Request) -> web.Response:
+        body    = await request.read()
+        worker  = 0
+        match   = _sender_id_re.search(body) if body else None
+        if match is not None:
+            worker = route(match.group(1).decode('utf-8', 'replace'), len(worker_ports))
+
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in ('host', 'content-length')}
+
+        async def _forward(p: int) -> web.Response:
+            async with request.app['session'].request(
+                request.method, f'http://127.0.0.1:{p}{request.path_qs}',
+                data = body, headers = headers) as response:
+                return web.Response(
+                    status  = response.status,
+                    body    = await response.read(),
+                    headers = {k: v for k, v in response.headers.items() if k.lower() in ('content-type', 'content-encoding')})
+
+        if not is_broadcast(body):
+            return await _forward(worker_ports[worker])
+
+        # the config is set in every worker, the response is the one of the worker of the conversation
+        responses = await asyncio.gather(*[_forward(p) for p in worker_ports])
+        failed = [p for p, r in zip(worker_ports, responses) if r.status != 200]
+        if failed:
+            logger.warning(f'Failed running the broadcast action on the workers on ports {failed}')
+        return responses[worker]
+
+    app = web.Application(client_max_size = 64 * 1024 ** 2)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    app.router.add_get('/ready', _handle_ready)
+    if config.metrics_enabled:
+        app.router.add_get('/metrics', _handle_metrics)
+    app.router.add_route('*', '/{path:.*}', _handle)
+
+    logger.info(f'Router (pid {os.getpid()}) - serving on 0.0.0.0:{port}, {len(worker_ports)} workers')
+    web.run_app(app, host = '0.0.0.0', port = port, print = None, access_log = None)
+
+
+def _fork(target: Callable, *args) -> int:
+    '''Fork a child running the target, the child never returns to the caller.'''
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    code = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT , signal.SIG_DFL)
+        target(*args)
+    except BaseException:
+        logger.exception(f'{target.__name__} failed')
+        code = 1
+    finally:
+        logging.shutdown()
+        os._exit(code)
+
+
+def serve(
+    workers     : int = 2       ,
+    port        : int = 5055    ,
+    worker_port : int = 5100    ,
+    threads     : int = 0
+    ) -> None:
+    '''Load the model and the data once, then fork the action server workers and the router.
+
+    The model weights, the hardcoded queries and the synonyms are shared by the
+    workers copy-on-write (the vector store is memory mapped, so its pages are
+    shared by the page cache anyway). Each worker runs its own event loop,
+    embedding service and Elasticsearch connections. The router forwards each
+    request to the worker of its `sender_id` (the actions of `broadcast_actions`
+    to all of them), and dead workers are restarted from the loaded parent. `GET /metrics` of the router sums up the latency
+    histograms of the workers (see `actions.es.metrics`).
+
+    Args:
+        workers     (int): Number of the action server workers. Defaults to 2.
+        port        (int): Port of the router. Defaults to 5055.
+        worker_port (int): Port of the first worker, the following ones use the next ports. Defaults to 5100.
+        threads     (int): Torch threads of each worker, 0 divides the cores among the workers. Defaults to 0.
+    '''
+    threads         = threads or max(1, (os.cpu_count() or 1) // workers)
+    ports           = [worker_port + i for i in range(workers)]
+    # the metrics endpoints of the workers take the ports following the ones of the workers
+    metrics_ports   = [worker_port + workers + i for i in range(workers)]
+
+    start = time.monotonic()
+    # a single thread in the parent, so no OpenMP thread pool is started before forking
+    _set_threads(1)
+    for f in [config.ready_file] + [_worker_ready_file(i) for i in range(workers)]:
+        if f and os.path.isfile(f):
+            os.remove(f)
+    if config.embed_backend.startswith('onnx'):
+        # ONNX Runtime sessions own thread pools, which do not survive forking - each worker loads its own
+        for name in ['synonym_dict', 'hardcoded_queries'] + ([] if config.es_imitate else ['retriever']):
+            getattr(config, name)
+    else:
+        config.load()
+    # keep the loaded objects out of the garbage collector, so its passes do not copy their pages
+    gc.freeze()
+    logger.info(f'Loaded the model and the data in {time.monotonic() - start:.1f} s, forking {workers} workers')
+
+    children: Dict[int, tuple] = {}
+
+    def _spawn(target: Callable, *args) -> None:
+        children[_fork(target, *args)] = (target, args)
+
+    def _stop(signum, frame):
+        raise _Stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT , _stop)
+
+    for i, p in enumerate(ports):
+        _spawn(_run_worker, i, p, metrics_ports[i], threads)
+    _spawn(_run_router, port, ports, metrics_ports)
+
+    try:
+        while True:
+            pid, status = os.wait()
+            target, args = children.pop(pid, (None, None))
+            if target is None:
+                continue
+            logger.error(f'{target.__name__}{args} (pid {pid}) exited with status {status}, restarting')
+            if target is _run_worker and _worker_ready_file(args[0]) and os.path.isfile(_worker_ready_file(args[0])):
+                os.remove(_worker_ready_file(args[0]))
+            time.sleep(1.0)
+            _spawn(target, *args)
+    except _Stop:
+        logger.info('Stopping the workers')
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        for f in [config.ready_file] + [_worker_ready_file(i) for i in range(workers)]:
+            if f and os.path.isfile(f):
+                os.remove(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Preforked action server - workers sharing one copy of the model, routed by sender id.')
+    parser.add_argument('--workers'     , default = config.serve_workers    , type = int, help = 'number of the action server workers')
+    parser.add_argument('--port'        , default = config.serve_port       , type = int, help = 'port of the router')
+    parser.add_argument('--worker-port' , default = config.serve_worker_port, type = int, help = 'port of the first worker')
+    parser.add_argument('--threads'     , default = config.serve_threads    , type = int, help = 'torch threads of each worker (0 divides the cores)')
+    args = parser.parse_args()
+
+    serve(workers = args.workers, port = args.port, worker_port = args.worker_port, threads = args.threads)
+
+
+if __name__ == '__main__':
+    # python -m actions.es.serve --workers 4
+    main()
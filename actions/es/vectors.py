@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import uuid
+import shutil
+import logging
+
+from typing import Iterable
+
+import numpy as np
+
+from actions.es.projection import Projection
+
+logger = logging.getLogger(__name__)
+
+# Fields of the documents kept in the vector store
+doc_fields      = ['source', 'url', 'title', 'description', 'identification', 'development', 'damage', 'management', 'links']
+# Fields the chunks are taken from (chunk names are `<field>_<index>`)
+chunk_fields    = ['title', 'description', 'identification', 'development', 'damage', 'management', 'links']
+# Storage types of the vectors (int8 vectors are scaled by `int8_scale`)
+vector_dtypes   = ['float32', 'float16', 'int8']
+int8_scale      = 127.0
+
+
+class VectorStore:
+    '''Corpus vectors and metadata stored on disk for the in-process retrieval.
+
+    Every generation of the store is written into its own subfolder and the
+    `CURRENT` file holds the name of the active one. Layout of a generation:
+        manifest.json   - generation, model, vector dtype and dimensions, projection, counts, sources
+        vectors.npy     - L2-normalised chunk vectors (float32, float16 or int8), one row
+                          per chunk, chunks grouped by document
+        projection.npz  - projection of the vectors to fewer dimensions (see `Projection`), if reduced
+        chunk_doc.npy   - document of every chunk (int32)
+        chunk_field.npy - field of every chunk, as index into `chunk_fields` (uint8)
+        chunk_index.npy - index of the chunk within its field (int32)
+        chunk_start.npy - start offset of the chunk in the field text (int32)
+        chunk_end.npy   - end offset of the chunk in the field text (int32)
+        doc_source.npy  - source of every document, as index into the manifest `sources` (uint8)
+        docs.bin        - documents as concatenated UTF-8 JSON objects
+        docs_offsets.npy- offsets of the documents in `docs.bin` (int64, one more than documents)
+
+    All the arrays and the document table are memory-mapped, so opening the
+    store parses nothing but the manifest, and the worker processes on the
+    host share one page-cached copy. Documents are decoded on access.
+
+    The query vectors have to be projected with the `projection` of the store
+    (if any) before scoring.
+    '''
+
+    def __init__(self, path: str) -> None:
+
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        self.path           = path
+        self.generation     = manifest['generation']
+        self.model          = manifest['model']
+        self.sources        = manifest['sources']
+
+        def _load(name):
+            return np.load(os.path.join(path, name), mmap_mode = 'r')
+
+        self.vectors        = _load('vectors.npy'     )
+        self.chunk_doc      = _load('chunk_doc.npy'   )
+        self.chunk_field    = _load('chunk_field.npy' )
+        self.chunk_index    = _load('chunk_index.npy' )
+        self.chunk_start    = _load('chunk_start.npy' )
+        self.chunk_end      = _load('chunk_end.npy'   )
+        self.doc_source     = _load('doc_source.npy'  )
+        self.docs_offsets   = _load('docs_offsets.npy')
+        self.docs           = np.memmap(os.path.join(path, 'docs.bin'), dtype = np.uint8, mode = 'r') \
+                                if self.docs_offsets[-1] > 0 else np.zeros(0, dtype = np.uint8)
+        self.projection     = Projection.load(os.path.join(path, 'projection.npz')) \
+                                if os.path.isfile(os.path.join(path, 'projection.npz')) else None
+
+    @classmethod
+    def open(cls, path: str) -> 'VectorStore':
+        '''Open the current generation of the vector store.
+
+        Args:
+            path (str): Folder of the vector store.
+
+        Returns:
+            VectorStore: Opened vector store.
+        '''
+        with open(os.path.join(path, 'CURRENT')) as f:
+            generation = f.read().strip()
+
+        return cls(os.path.join(path, generation))
+
+    def __len__(self) -> int:
+        return len(self.docs_offsets) - 1
+
+    def document(self, i: int) -> dict:
+        '''Decode the i-th document (with its `_id`).'''
+        start, end = self.docs_offsets[i], self.docs_offsets[i + 1]
+        return json.loads(self.docs[start:end].tobytes().decode('utf-8'))
+
+    def chunk(self, i: int) -> dict:
+        '''Get the metadata of the i-th chunk, as stored in the nested `vectors` field in ES.'''
+        return {
+            'name'  : f'{chunk_fields[self.chunk_field[i]]}_{self.chunk_index[i]}'  ,
+            'start' : int(self.chunk_start[i])                                      ,
+            'end'   : int(self.chunk_end[i])                                        ,
+        }
+
+    def scores(
+        self,
+        query_vector    : np.ndarray        ,
+        block           : int = 65536       ,
+        rows            : np.ndarray = None
+        ) -> np.ndarray:
+        '''Cosine similarity of the query with every chunk (or with the chunks of `rows` only).
+
+        float16 and int8 vectors are upcast in blocks, since there are no fast
+        float16 or int8 matrix products in numpy.
+
+        Args:
+            query_vector    (np.ndarray): Query vector (projected with the `projection` of the store).
+            block           (int)       : Number of rows upcast at once for float16 and int8 vectors.
+            rows            (np.ndarray): Indices of the chunks to score. Defaults to None (all).
+
+        Returns:
+            np.ndarray: Scores (float32), one per chunk (of `rows`).
+        '''
+        query_vector = np.asarray(query_vector, dtype = np.float32)
+        query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        if vectors.dtype == np.float32:
+            return vectors @ query_vector
+
+        if vectors.dtype == np.int8:
+            query_vector = query_vector / int8_scale
+
+        scores = np.empty(vectors.shape[0], dtype = np.float32)
+        for i in range(0, vectors.shape[0], block):
+            scores[i:i + block] = vectors[i:i + block].astype(np.float32) @ query_vector
+
+        return scores
+
+
+def write_vector_store(
+    path    : str               ,
+    docs    : Iterable[dict]    ,
+    model   : str               ,
+    dtype       : str = 'float32'   ,
+    keep        : int = 2           ,
+    dims        : int = 0           ,
+    method      : str = 'pca'       ,
+    projection  : Projection = None
+    ) -> str:
+    '''Write a new generation of the vector store from the documents in the format ingested into ES.
+
+    Args:
+        path        (str)           : Folder of the vector store.
+        docs        (Iterable[dict]): Documents with `_id`, the fields of `doc_fields` and `vectors`
+                                        (list of dicts with `vector`, `name`, `start` and `end`).
+        model       (str)           : Name of the embedding model used for the vectors.
+        dtype       (str)           : Storage type of the vectors - 'float32', 'float16' or 'int8'. Defaults to 'float32'.
+        keep        (int)           : Number of generations to keep. The older ones are deleted while services
+                                        may still have them mapped, which is only safe on POSIX. Defaults to 2.
+        dims        (int)           : Reduce the vectors to the dimensions with a projection fitted on them
+                                        (0 keeps all the dimensions). Defaults to 0.
+        method      (str)           : Method of the fitted projection - 'pca' or 'truncate'. Defaults to 'pca'.
+        projection  (Projection)    : Projection the vectors are already reduced with (i.e. in the ES index). Defaults to None.
+
+    Returns:
+        str: Generation of the written store.
+    '''
+    if dtype not in vector_dtypes:
+        raise ValueError(f'Unknown vector store dtype - {dtype}')
+
+    generation  = uuid.uuid4().hex
+    folder      = os.path.join(path, generation)
+    os.makedirs(folder)
+
+    vectors     = []
+    chunks      = {'doc': [], 'field': [], 'index': [], 'start': [], 'end': []}
+    sources     = []
+    doc_source  = []
+    offsets     = [0]
+    with open(os.path.join(folder, 'docs.bin'), 'wb') as f:
+        for d in docs:
+            i = len(offsets) - 1
+            for v in d['vectors']:
+                field, index = v['name'].rsplit('_', 1)
+                vectors.append(v['vector'])
+                chunks['doc'    ].append(i                          )
+                chunks['field'  ].append(chunk_fields.index(field)  )
+                chunks['index'  ].append(int(index)                 )
+                chunks['start'  ].append(v['start']                 )
+                chunks['end'    ].append(v['end']                   )
+
+            if d['source'] not in sources:
+                sources.append(d['source'])
+            doc_source.append(sources.index(d['source']))
+
+            doc = json.dumps({**{k: d.get(k) for k in doc_fields}, '_id': d['_id']}).encode('utf-8')
+            f.write(doc)
+            offsets.append(offsets[-1] + len(doc))
+
+    vectors = np.asarray(vectors, dtype = np.float32)
+    if len(vectors) > 0:
+        vectors /= np.maximum(np.linalg.norm(vectors, axis = 1, keepdims = True), 1e-12)
+
+    if projection is None and dims > 0:
+        projection  = Projection.fit(vectors, dims, method)
+        vectors     = projection.apply(vectors)
+    if projection is not None:
+        projection.save(os.path.join(folder, 'projection.npz'))
+
+    if dtype == 'int8':
+        stored = np.clip(np.rint(vectors * int8_scale), -int8_scale, int8_scale).astype(np.int8)
+    else:
+        stored = vectors.astype(dtype)
+
+    np.save(os.path.join(folder, 'vectors.npy'      ), stored                                       )
+    np.save(os.path.join(folder, 'chunk_doc.npy'    ), np.asarray(chunks['doc'  ], dtype = np.int32))
+    np.save(os.path.join(folder, 'chunk_field.npy'  ), np.asarray(chunks['field'], dtype = np.uint8))
+    np.save(os.path.join(folder, 'chunk_index.npy'  ), np.asarray(chunks['index'], dtype = np.int32))
+    np.save(os.path.join(folder, 'chunk_start.npy'  ), np.asarray(chunks['start'], dtype = np.int32))
+    np.save(os.path.join(folder, 'chunk_end.npy'    ), np.asarray(chunks['end'  ], dtype = np.int32))
+    np.save(os.path.join(folder, 'doc_source.npy'   ), np.asarray(doc_source     , dtype = np.uint8))
+    np.save(os.path.join(folder, 'docs_offsets.npy' ), np.asarray(offsets        , dtype = np.int64))
+
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump({
+            'generation': generation            ,
+            'model'     : model                 ,
+            'dtype'     : dtype                 ,
+            'dims'      : int(vectors.shape[1]) if len(vectors) > 0 else 0,
+            'projection': f'{projection.method}:{projection.id}' if projection is not None else None,
+            'docs'      : len(offsets) - 1      ,
+            'chunks'    : len(vectors)          ,
+            'sources'   : sources               ,
+        }, f)
+
+    # switch to the new generation atomically
+    with open(os.path.join(path, 'CURRENT.tmp'), 'w') as f:
+        f.write(generation)
+    os.replace(os.path.join(path, 'CURRENT.tmp'), os.path.join(path, 'CURRENT'))
+
+    # remove the old generations - on POSIX the workers that still have them mapped keep reading
+    # them until they switch to the current one (the files are freed once unmapped), elsewhere
+    # (i.e. on Windows) mapped files can not be deleted and are left behind
+    generations = sorted(
+        [g for g in os.listdir(path) if os.path.isfile(os.path.join(path, g, 'manifest.json'))],
+        key = lambda g: os.path.getmtime(os.path.join(path, g, 'manifest.json')))
+    for g in generations[:-keep]:
+        shutil.rmtree(os.path.join(path, g), ignore_errors = True)
+
+    logger.info(f'Written vector store to {folder} - {len(offsets) - 1} documents, {len(vectors)} chunks ({dtype}, {vectors.shape[-1]} dims)')
+    return generation
+
+
+def export_vector_store(
+    path    : str               ,
+    dtype   : str = 'float32'   ,
+    dims    : int = 0           ,
+    method  : str = 'pca'
+    ) -> str:
+    '''Download the combined index from ES into the vector store.
+
+    If the vectors of the index are reduced (`es_projection_path` in config),
+    the store gets the same projection and `dims` is ignored.
+
+    Args:
+        path    (str): Folder of the vector store.
+        dtype   (str): Storage type of the vectors - 'float32', 'float16' or 'int8'. Defaults to 'float32'.
+        dims    (int): Reduce the vectors to the dimensions (0 keeps all the dimensions). Defaults to 0.
+        method  (str): Method of the projection - 'pca' or 'truncate'. Defaults to 'pca'.
+
+    Returns:
+        str: Generation of the written store.
+    '''
+    from elasticsearch import Elasticsearch
+    from elasticsearch.helpers import scan
+
+    from actions.es import config
+
+    es_client = Elasticsearch([config.es_host], http_auth = (config.es_username, config.es_password), timeout = 60)
+
+    def _docs():
+        for h in scan(es_client, index = config.es_combined_index, query = {'query': {'match_all': {}}}, size = 100):
+            yield {**h['_source'], '_id': h['_id']}
+
+    projection = None
+    if config.es_projection_path:
+        projection = Projection.load(config.es_projection_path)
+
+    return write_vector_store(path, _docs(), model = config.embed_url, dtype = dtype, dims = dims, method = method, projection = projection)
+
+
+if __name__ == '__main__':
+    # python -m actions.es.vectors <path> [float32|float16|int8] [dims] [pca|truncate]
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    export_vector_store(sys.argv[1], *sys.argv[2:3], *[int(d) for d in sys.argv[3:4]], *sys.argv[4:5])
@@ -12,11 +12,14 @@ from actions.es import config
 
 # Dictionary for parameters debug
 params = {
-    'es_search_size'    : int,
-    'es_top_n'          : int,
-    'es_cut_off'        : float,
-    'es_ask_weight'     : float,
-    'es_slots_weight'   : float
+    'es_search_size'            : int,
+    'es_top_n'                  : int,
+    'es_cut_off'                : float,
+    'es_ask_weight'             : float,
+    'es_slots_weight'           : float,
+    'es_slots_parallel'         : int,
+    'es_partitioned'            : int,
+    'es_hardcoded_shared_vector': int
 }
 
 # Utterances
@@ -31,6 +34,7 @@ utterances = {
     'fallback'              : "I'm sorry, I didn't catch that. Can you rephrase?",
     'ask_problem_desc'      : 'Please describe your problem.',
     'no_results'            : 'Unfortunately, I could not find any results that might help you... Please try to reword your pest problem.',
+    'busy'                  : 'Sorry, I am handling too many questions right now. Please try again in a moment.',
     'results'               : 'Here is what I found based on your description:',
     'more_details'          : 'Please provide additional information.',
     'ask_more_details'      : 'Did that answer your question? If not, can you give me more information?',
@@ -295,11 +299,15 @@ def _process_slots(slots, prev_slots = None):
     return slots_utterance, slots_query
 
 
-def _parse_tracker_events(events):
-    '''Parse chat history - filtering in only `bot` and `user` events.'''
+def _parse_tracker_events(events, start = 0):
+    '''Parse chat history - filtering in only `bot` and `user` events.
+
+    Every entry keeps the `offset` of its event in the tracker (`start` is the
+    offset of the first one), the stored chat is deduplicated by it (see `actions.es.logs`).
+    '''
     chat_history = []
 
-    for event in events:
+    for offset, event in enumerate(events, start):
         if event['event'] == 'user':
             '''
             structure:
@@ -315,7 +323,8 @@ def _parse_tracker_events(events):
                 'agent'     : 'user'    ,
                 'timestamp' : timestamp ,
                 'text'      : text      ,
-                'intent'    : intent
+                'intent'    : intent    ,
+                'offset'    : offset
             })
         elif event['event'] == 'bot':
             '''
@@ -334,6 +343,7 @@ def _parse_tracker_events(events):
                 'agent'     : 'bot'     ,
                 'timestamp' : timestamp ,
                 'text'      : text      ,
+                'offset'    : offset
             })
 
             if event['data']['custom'] is not None:
@@ -351,6 +361,68 @@ def _parse_tracker_events(events):
     return chat_history
 
 
+def _export_chat(tracker):
+    '''Compose the chat export of the events not exported yet.
+
+    The number of exported events and the timestamp of the last one are kept
+    per `sender_id` in `config.chat_log_offsets`. If the events continue the
+    exported ones, only the new ones are parsed and the export is marked to be
+    appended to the stored chat, otherwise (i.e. after a restart) the whole chat
+    is parsed (and merged into the stored one, see `actions.es.logs`).
+    The offsets are only moved forward by `_commit_export`, once the export is
+    accepted by the chat log writer, so the events of a rejected save are exported again.
+
+    Returns:
+        dict: Chat export, or None if there is nothing new to save.
+    '''
+    events  = tracker.events
+    state   = config.chat_log_offsets.get(tracker.sender_id)
+    start   = 0
+    if state is not None and 0 < state['events'] <= len(events) \
+            and events[state['events'] - 1].get('timestamp') == state['timestamp']:
+        start = state['events']
+
+    chat_history    = _parse_tracker_events(events[start:], start)
+    started         = state['started'] if start > 0 else None
+    if started is None and len(chat_history) > 0:
+        started = chat_history[0]['timestamp']
+
+    if len(chat_history) == 0:
+        # nothing to save in the new events, they do not need to be parsed again
+        _commit_export(tracker, started)
+        return None
+
+    return {
+        'chat_id'       : tracker.sender_id ,
+        'timestamp'     : started           ,
+        'chat_history'  : chat_history      ,
+        'append'        : start > 0         ,
+    }
+
+
+def _commit_export(tracker, started):
+    '''Mark all the events of the tracker as exported (see `_export_chat`).
+
+    Called as soon as the export is accepted by the chat log writer - queued, or
+    journaled if the queue is full - before it reaches ES. The writer guarantees
+    the durability from there: the saves failing in ES, or left in the queue on
+    exit, are journaled and replayed on the next flush or start (see
+    `actions.es.logs.ChatLogWriter`). A save dropped by the writer is reported as
+    not accepted, and the offsets stay where they were.
+
+    Args:
+        tracker         : Tracker of the conversation.
+        started (str)   : Timestamp of the start of the chat (`timestamp` of the export).
+    '''
+    events = tracker.events
+    if len(events) > 0:
+        config.chat_log_offsets.set(tracker.sender_id, {
+            'events'    : len(events)                   ,
+            'timestamp' : events[-1].get('timestamp')   ,
+            'started'   : started                       ,
+        })
+
+
 def _parse_date(aft_date = None, bfr_date = None):
     '''Parse date for the logging report.'''
     try:
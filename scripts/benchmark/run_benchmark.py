@@ -0,0 +1,313 @@
+from typing import Dict, List
+
+import asyncio
+import logging
+import json
+import time
+import sys
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import argparse
+
+parser = argparse.ArgumentParser(description = 'Script for benchmarking the latency and quality of the retrieval of the chatbot.')
+parser.add_argument('benchmark', choices = ['retrieval', 'embed', 'vectors'], help = 'Benchmark to run.')
+parser.add_argument('--repeat', type = int, default = 3, help = 'Number of times every question is queried.')
+parser.add_argument('--limit' , type = int, default = 0, help = 'Limit the number of questions (0 for all).')
+parser.add_argument('--retrievers', default = 'script,local', help = 'Comma separated retrieval modes to compare against script (knn needs ES 8.4+).')
+parser.add_argument('--backends', default = 'torch,torch-int8,onnx,onnx-int8', help = 'Comma separated embedding backends to compare against torch.')
+parser.add_argument('--settings', default = 'none:0:float16,none:0:int8,pca:384:float32,pca:256:float32,pca:128:float32,pca:128:int8,truncate:256:float32',
+                    help = 'Comma separated vector settings (projection:dims:dtype) to compare against the full float32 vectors.')
+
+args = parser.parse_args()
+
+# run from the root of the project, same as the scoring script
+sys.path.insert(1, os.path.realpath(os.path.curdir))
+
+from actions.es import config
+from actions.es import es
+from actions.es.vectors import VectorStore, write_vector_store
+from actions.es.retriever import Retriever, ESScriptRetriever, ESKnnRetriever, LocalRetriever
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_VALID  = os.getenv('DATA_VALID', 'scripts/scoring/data/transformed/valid_questions.pkl')
+TOP_N       = 10
+
+
+def _read_questions(limit: int = 0) -> List[str]:
+    '''Read the questions for benchmarking.
+
+    Args:
+        limit (int, optional): Limit the number of questions (0 for all). Defaults to 0.
+
+    Returns:
+        List[str]: List of questions.
+    '''
+    questions = pd.read_pickle(DATA_VALID)['Question'].values.tolist()
+    if limit > 0:
+        questions = questions[:limit]
+    
+    return questions
+
+
+def _read_answers(limit: int = 0) -> List[str]:
+    '''Read the correct URLs of the questions for benchmarking (same order as `_read_questions`).'''
+    answers = pd.read_pickle(DATA_VALID)['URL'].values.tolist()
+    if limit > 0:
+        answers = answers[:limit]
+
+    return answers
+
+
+def _percentiles(latencies: List[float]) -> str:
+    '''Format p50, p95 and p99 of latencies (in ms).'''
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return f'p50 {p50:8.2f} ms, p95 {p95:8.2f} ms, p99 {p99:8.2f} ms'
+
+
+def _get_retrievers(modes: List[str]) -> Dict[str, Retriever]:
+    '''Create the retrievers for the retrieval modes.
+
+    Args:
+        modes (List[str]): Retrieval modes (as `es_retrieval` in config).
+
+    Returns:
+        Dict[str, Retriever]: Retrievers by mode, `script` always included as the exact reference.
+    '''
+    retrievers = {'script': ESScriptRetriever(config.es_client, config.es_combined_index)}
+    if 'knn' in modes and not config.supports_knn():
+        logger.warning('Skipping the knn retrieval')
+    elif 'knn' in modes:
+        retrievers['knn'] = ESKnnRetriever(
+            client          = config.es_client              ,
+            index           = config.es_combined_index      ,
+            chunk_index     = config.es_chunk_index         ,
+            num_candidates  = config.es_knn_num_candidates  ,
+            chunks_per_doc  = config.es_knn_chunks_per_doc  )
+    if 'local' in modes:
+        retrievers['local'] = LocalRetriever(VectorStore.open(config.vector_store_path))
+
+    return retrievers
+
+
+async def _time_query(
+    retriever   : Retriever ,
+    vector      : np.ndarray,
+    repeat      : int
+    ) -> tuple:
+    '''Run the query `repeat` times and return the latencies and the last hits.'''
+    latencies = []
+    for _ in range(repeat):
+        start   = time.perf_counter()
+        hits    = await retriever.search(vector, size = config.es_search_size)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies, hits
+
+
+async def _benchmark_retrieval(
+    questions   : List[str],
+    repeat      : int      ,
+    modes       : List[str]
+    ) -> None:
+    '''Compare the retrieval modes against the exact script score retrieval.
+
+    Reports latency percentiles of every mode and the overlap of its top 10
+    documents with the ones of the exact script score query.
+
+    Args:
+        questions   (List[str]) : Questions to query.
+        repeat      (int)       : Number of times every question is queried.
+        modes       (List[str]) : Retrieval modes to compare.
+    '''
+    retrievers  = _get_retrievers(modes)
+    latencies   = {m: [] for m in retrievers}
+    overlaps    = {m: [] for m in retrievers}
+
+    logger.info(f'Querying {len(questions)} questions {repeat} times with retrieval modes - {", ".join(retrievers)}...')
+    for i, q in enumerate(questions):
+        _, text_search, _ = es._normalise_query(q)
+        vector            = config.embed_service.encode_sync([text_search])[0]
+
+        top_script = None
+        for m, retriever in retrievers.items():
+            l, hits = await _time_query(retriever, vector, repeat)
+            latencies[m].extend(l)
+
+            top = set([h['_id'] for h in hits[:TOP_N]])
+            if m == 'script':
+                top_script = top
+            if len(top_script) > 0:
+                overlaps[m].append(len(top_script & top) / len(top_script))
+
+        if (i+1)%10 == 0:
+            logger.info(f'Finished {i+1} questions...')
+
+    logger.info(f'---------------------------------------------------------------')
+    for m in retrievers:
+        logger.info(f'{m:<8}: {_percentiles(latencies[m])}, overlap of top {TOP_N} with script - {np.mean(overlaps[m]) * 100:.2f}%')
+    logger.info(f'knn num_candidates = {config.es_knn_num_candidates}')
+    logger.info(f'---------------------------------------------------------------')
+
+
+def _benchmark_embed(
+    questions   : List[str],
+    backends    : List[str]
+    ) -> None:
+    '''Compare the embedding backends against the fp32 torch model.
+
+    Every backend is measured in a fresh process, so the peak RSS is of the
+    backend alone. Reports load time, p50/p95 latency of single questions,
+    throughput of batches of 16, peak RSS, the cosine of the vectors with the
+    fp32 ones and the overlap of the top 10 documents of the exact script
+    score query with the fp32 ones.
+
+    Args:
+        questions   (List[str]) : Questions to encode.
+        backends    (List[str]) : Embedding backends to compare.
+    '''
+    texts   = [es._normalise_query(q)[1] for q in questions]
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'texts.json'), 'w') as f:
+            json.dump(texts, f)
+
+        for b in ['torch'] + [b for b in backends if b != 'torch']:
+            logger.info(f'Benchmarking embedding backend {b}...')
+            output = os.path.join(folder, f'{b}.npz')
+            subprocess.run(
+                [sys.executable, '-m', 'actions.es.embed', config.embed_url, config.embed_cache_dir, b, os.path.join(folder, 'texts.json'), output],
+                check = True)
+            with np.load(output) as r:
+                results[b] = (r['vectors'], json.loads(str(r['stats'])))
+
+    reference   = results['torch'][0]
+    retriever   = ESScriptRetriever(config.es_client, config.es_combined_index)
+    loop        = asyncio.get_event_loop()
+
+    def _top(vectors):
+        return [set(h['_id'] for h in loop.run_until_complete(retriever.search(v, size = TOP_N))) for v in vectors]
+
+    top_reference = _top(reference)
+
+    logger.info(f'---------------------------------------------------------------')
+    for b, (vectors, stats) in results.items():
+        cosine  = (vectors * reference).sum(axis = 1) / np.maximum(
+            np.linalg.norm(vectors, axis = 1) * np.linalg.norm(reference, axis = 1), 1e-12)
+        overlap = np.mean([len(t & r) / len(r) for t, r in zip(_top(vectors), top_reference) if len(r) > 0]) if b != 'torch' else 1.0
+        logger.info(
+            f'{b:<10}: load {stats["load_s"]:6.1f} s, p50 {stats["latency_ms"][0]:7.2f} ms, p95 {stats["latency_ms"][1]:7.2f} ms, '
+            f'{stats["throughput"]:7.1f} questions/s, peak RSS {stats["max_rss_mb"]:7.0f} MB, '
+            f'cosine mean {cosine.mean():.4f} min {cosine.min():.4f}, overlap of top {TOP_N} {overlap * 100:.2f}%')
+    logger.info(f'parity threshold = {config.embed_parity_threshold}')
+    logger.info(f'---------------------------------------------------------------')
+
+
+def _store_documents(store: VectorStore):
+    '''Read the documents of the vector store back with their (full) vectors.'''
+    chunk_doc = np.asarray(store.chunk_doc)
+    for i in range(len(store)):
+        doc     = store.document(i)
+        chunks  = range(np.searchsorted(chunk_doc, i), np.searchsorted(chunk_doc, i, side = 'right'))
+        doc['vectors'] = [{**store.chunk(c), 'vector': np.asarray(store.vectors[c], dtype = np.float32)} for c in chunks]
+        yield doc
+
+
+def _correct_ranks(
+    hits    : list,
+    answer  : str
+    ) -> List[bool]:
+    '''Check if the correct URL is in the top 1, 3, 5 and 10 hits (same as the scoring script).'''
+    topn = [False, False, False, False]
+    for i, h in enumerate(hits[:TOP_N]):
+        url = h['url'] if h['source'] == 'pestsVideos' else h['url'].split('?')[0]
+        if url in answer:
+            topn = [topn[0] or i == 0, topn[1] or i < 3, topn[2] or i < 5, True]
+
+    return topn
+
+
+def _benchmark_vectors(
+    questions   : List[str],
+    answers     : List[str],
+    settings    : List[str]
+    ) -> None:
+    '''Compare the reduced and quantised vectors against the full float32 ones.
+
+    For every setting (`projection:dims:dtype`, i.e. `pca:128:int8`) a vector
+    store is written from the full float32 vector store at `VECTOR_STORE_PATH`,
+    with the projection fitted on its vectors. Reports the size of the
+    vectors, p50/p95/p99 latency, the recall of the top 10 documents of the
+    full vectors, and the correct answers in the top 1/3/5/10 results (as the
+    scoring script, without the hardcoded queries).
+
+    Args:
+        questions   (List[str]) : Questions to query.
+        answers     (List[str]) : Correct URLs of the questions.
+        settings    (List[str]) : Vector settings to compare.
+    '''
+    store = VectorStore.open(config.vector_store_path)
+    if store.projection is not None or store.vectors.dtype != np.float32:
+        raise ValueError(f'Comparing the vector settings needs a full float32 vector store, {config.vector_store_path} is reduced')
+
+    vectors = [config.embed_service.encode_sync([es._normalise_query(q)[1]])[0] for q in questions]
+
+    def _search(retriever, v):
+        if retriever.projection is not None:
+            v = retriever.projection.apply(v)
+        start   = time.perf_counter()
+        hits    = retriever._view.search(v, config.es_search_size, None, None)
+        elapsed = time.perf_counter() - start
+        return es._handle_es_result(hits), elapsed
+
+    reference   = LocalRetriever(store)
+    top_full    = [[h['_id'] for h in _search(reference, v)[0][:TOP_N]] for v in vectors]
+
+    logger.info(f'---------------------------------------------------------------')
+    with tempfile.TemporaryDirectory() as folder:
+        for setting in ['none:0:float32'] + settings:
+            method, dims, dtype = setting.split(':')
+            path = os.path.join(folder, setting.replace(':', '_'))
+            os.makedirs(path)
+            write_vector_store(path, _store_documents(store), model = store.model, dtype = dtype, dims = int(dims), method = method)
+            retriever = LocalRetriever(VectorStore.open(path))
+
+            latencies, recalls, ranks = [], [], []
+            for v, top, answer in zip(vectors, top_full, answers):
+                hits, elapsed = _search(retriever, v)
+                latencies.append(elapsed)
+                if len(top) > 0:
+                    recalls.append(len(set(top) & set(h['_id'] for h in hits[:TOP_N])) / len(top))
+                ranks.append(_correct_ranks(hits, answer))
+
+            size    = retriever.store.vectors.nbytes / 1024 / 1024
+            ranks   = np.mean(ranks, axis = 0) * 100
+            logger.info(
+                f'{setting:<18}: {size:8.1f} MB, {_percentiles(latencies)}, recall of top {TOP_N} {np.mean(recalls) * 100:6.2f}%, '
+                f'correct top 1/3/5/10 - {ranks[0]:.2f}% / {ranks[1]:.2f}% / {ranks[2]:.2f}% / {ranks[3]:.2f}%')
+    logger.info(f'---------------------------------------------------------------')
+
+
+def main() -> None:
+    '''Runs the selected benchmark.'''
+
+    questions = _read_questions(limit = args.limit)
+
+    if args.benchmark == 'retrieval':
+        modes = args.retrievers.split(',')
+        asyncio.get_event_loop().run_until_complete(_benchmark_retrieval(questions, args.repeat, modes))
+    elif args.benchmark == 'embed':
+        _benchmark_embed(questions, args.backends.split(','))
+    elif args.benchmark == 'vectors':
+        answers = _read_answers(limit = args.limit)
+        _benchmark_vectors(questions, answers, args.settings.split(','))
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,8 @@ DATA_VALID  = os.getenv('DATA_VALID'    , 'scripts/scoring/data/transformed/vali
 DATA_NA     = os.getenv('DATA_NA'       , 'scripts/scoring/data/transformed/na_questions.pkl'   )
 RASA_URL    = os.getenv('RASA_URL'      , 'http://localhost:5005/webhooks/rest/webhook'         )
 DESCRIPTION = os.getenv('DESCRIPTION'   , 'Experiment running locally'                          )
+# Debug parameters to set on the chatbot before scoring, i.e. 'es_hardcoded_shared_vector 1;es_cut_off 0.4'
+PARAMETERS  = os.getenv('PARAMETERS'    , ''                                                    )
 
 def _read_data(
     path: str, 
@@ -46,6 +48,53 @@ def _read_data(
     return (questions, answers)
 
 
+def _parse_parameters(parameters: str) -> List[Tuple[str, str]]:
+    '''Parse the debug parameters to be set on the chatbot.
+
+    Args:
+        parameters (str): Semicolon separated pairs of parameter name and value.
+
+    Returns:
+        List[Tuple[str, str]]: List of parameter names and values.
+    '''
+    pairs = []
+    for p in parameters.split(';'):
+        if len(p.strip()) == 0:
+            continue
+        name, value = p.split()
+        pairs.append((name, value))
+    
+    return pairs
+
+
+def _set_parameters(parameters: List[Tuple[str, str]]) -> None:
+    '''Set the debug parameters on the chatbot (only available in DEV stage of the chatbot).
+
+    Args:
+        parameters (List[Tuple[str, str]]): List of parameter names and values.
+    '''
+    DATA = {
+        'message'   : '',
+        'sender'    : str(random.randint(0, 1000000))
+    }
+
+    for name, value in parameters:
+        DATA['message'] = f'parameter {name} {value}'
+        try:
+            response = requests.post(RASA_URL, json = DATA)
+            if response.status_code != 200:
+                logger.error(f'Error: Service at {RASA_URL} is unavailable, exit.')
+                sys.exit(1)
+            response = response.json()
+            if not response[0]['text'].startswith(f'Setting parameter {name}'):
+                raise Exception(response[0]['text'])
+        except Exception as e:
+            logger.error(f'Error: Failed setting parameter - "{name} {value}", exit. {type(e).__name__}: "{e}".')
+            sys.exit(1)
+        
+        logger.info(f'Set parameter {name} to {value}')
+
+
 def _get_results(questions: List) -> List:
     '''Query the list of questions against the chatbot in development environment.
 
@@ -245,6 +294,10 @@ def main(save = False) -> None:
     logger.info(f'---------------------------------------------------------------')
     logger.info(f'DESCRIPTION       : {DESCRIPTION}')
     logger.info(f'RASA CHATBOT URL  : {RASA_URL}'   )
+    logger.info(f'PARAMETERS        : {PARAMETERS}' )
+
+    parameters = _parse_parameters(PARAMETERS)
+    _set_parameters(parameters)
     
     logger.info(f'Reading data for valid queries and getting stats.')
     total_valid , topn          = _calc_stats_valid_queries ()
@@ -285,6 +338,8 @@ def main(save = False) -> None:
             mlflow.log_metric("na_recall", no_results/total_na * 100)
             
             mlflow.log_param("description", DESCRIPTION) # Short description of is being evaluated
+            for name, value in parameters:
+                mlflow.log_param(name, value)
 
 
 if __name__ == "__main__":
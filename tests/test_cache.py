@@ -0,0 +1,98 @@
+import time
+import asyncio
+
+from actions.es.cache import LRUCache, SqliteCache
+
+
+def _flush(cache: SqliteCache) -> None:
+    '''Wait for the writes queued in the background thread.'''
+    cache._background().submit(lambda: None).result()
+
+
+def test_lru_evicts_the_least_recently_used():
+    cache = LRUCache(maxsize = 2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1, 'hit_rate': 0.75}
+
+
+def test_lru_expires_after_the_ttl(monkeypatch):
+    now     = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache   = LRUCache(ttl = 10)
+    cache.set('a', 1)
+
+    now[0] += 10
+    assert cache.get('a') == 1
+    now[0] += 1
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_lru_copies_the_backend_hits_into_memory(tmp_path):
+    backend = SqliteCache(str(tmp_path / 'cache.sqlite'))
+    LRUCache(backend = backend).set('a', [1, 2])
+    _flush(backend)
+
+    cache = LRUCache(backend = backend)
+    assert asyncio.run(cache.get_async('a')) == [1, 2]
+    assert asyncio.run(cache.get_async('b')) is None
+    backend.clear()
+    assert cache.get('a') == [1, 2]
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 1
+
+
+def test_sqlite_expires_after_the_ttl(tmp_path, monkeypatch):
+    now     = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache   = SqliteCache(str(tmp_path / 'cache.sqlite'), ttl = 10)
+    cache.set('a', {'x': 1})
+
+    now[0] += 10
+    assert cache.get('a') == {'x': 1}
+    now[0] += 1
+    assert cache.get('a') is None
+
+
+def test_sqlite_prunes_the_oldest_beyond_maxsize(tmp_path, monkeypatch):
+    now     = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache   = SqliteCache(str(tmp_path / 'cache.sqlite'), maxsize = 2, prune_every = 4)
+    for i in range(4):
+        now[0] += 1
+        cache.set(str(i), i)
+
+    assert [cache.get(str(i)) for i in range(4)] == [None, None, 2, 3]
+
+
+def test_sqlite_background_writes_keep_the_value_at_the_time_of_set(tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache.sqlite'))
+    value = {'hits': [1]}
+    cache.set_background('a', value)
+    value['hits'].append(2)
+    _flush(cache)
+
+    assert cache.get('a') == {'hits': [1]}
+
+
+def test_lru_counters_are_rendered_summed_over_the_workers(monkeypatch):
+    from actions.es import config, metrics
+
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+    monkeypatch.setitem(vars(config), 'embed_cache', cache)
+    monkeypatch.setattr(config, 'chat_log_offsets', LRUCache())
+
+    text = metrics.render([metrics.snapshot(), metrics.snapshot()])
+    assert 'actions_cache_requests_total{cache="embed",result="hit"} 2' in text
+    assert 'actions_cache_requests_total{cache="embed",result="miss"} 2' in text
+    assert 'actions_cache_entries{cache="embed"} 2' in text
+    assert 'actions_cache_entries{cache="chat_log_offsets"} 0' in text
+    assert '# TYPE actions_cache_requests_total counter' in text
@@ -0,0 +1,80 @@
+import os
+import re
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from actions.es.chunks import ChunkStore, write_chunk_store, _model_folder
+from actions.es.ingest import doc_fields
+
+
+class Nlp:
+    '''Sentence splitter with the interface of a spaCy pipeline with sentence boundaries (`pipe` and `sents`).'''
+
+    def pipe(self, texts, batch_size = 64, n_process = 1):
+        for text in texts:
+            yield SimpleNamespace(sents = [
+                SimpleNamespace(text = m.group(), start_char = m.start(), end_char = m.end()) for m in re.finditer(r'[^.]+\.', text)])
+
+
+def _doc(i: int, sentences: int = 4) -> dict:
+    doc = {f: '' for f in doc_fields}
+    doc.update({
+        'source'        : 'pestsDiseases'                                               ,
+        'url'           : f'https://example.org/{i}'                                    ,
+        'title'         : f'Pest {i}'                                                   ,
+        'description'   : ''.join(f'Sentence {j} of {i}.' for j in range(sentences))    ,
+        'links'         : [{'title': 'Adult', 'src': f'https://example.org/{i}.jpg', 'type': 'image'}],
+    })
+    return doc
+
+
+def _embed(path: str, model: str) -> np.ndarray:
+    '''Write the vector set of the model the way the embed stage does (the row number in every dimension).'''
+    store   = ChunkStore(path)
+    folder  = _model_folder(path, model)
+    vectors = np.repeat(np.arange(len(store), dtype = np.float32)[:, None], 4, axis = 1)
+    os.makedirs(folder)
+    np.save(os.path.join(folder, 'vectors.npy'), vectors)
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump({'model': model, 'dims': 4, 'generation': store.generation, 'chunks': len(store)}, f)
+    return vectors
+
+
+def test_chunk_store_round_trip(tmp_path):
+    path        = str(tmp_path)
+    docs        = [_doc(0), _doc(1, sentences = 2), _doc(0)]
+    generation  = write_chunk_store(path, docs, Nlp())
+    _embed(path, 'org/model')
+
+    store = ChunkStore(path)
+    assert store.generation == generation
+    assert store.models() == ['org/model']
+    # 2 windows of 3 sentences and a link of the first one, only the link of the second one
+    assert len(store) == 4
+
+    stored = list(store.iter_documents('org/model'))
+    assert [d['title'] for d in stored] == ['Pest 0', 'Pest 1']
+    assert stored[0]['links'] == docs[0]['links']
+    assert [(v['name'], v['start'], v['vector'][0]) for v in stored[0]['vectors']] == [
+        ('description_0', 0, 0.0), ('description_1', len('Sentence 0 of 0.'), 1.0), ('links_0', 0, 2.0)]
+    assert [v['name'] for v in stored[1]['vectors']] == ['links_0']
+
+
+def test_vector_sets_survive_a_rebuild_of_unchanged_sources(tmp_path):
+    path = str(tmp_path)
+    write_chunk_store(path, [_doc(0)], Nlp())
+    _embed(path, 'model')
+
+    write_chunk_store(path, [_doc(0)], Nlp())
+    assert ChunkStore(path).models() == ['model']
+
+    write_chunk_store(path, [_doc(0, sentences = 5)], Nlp())
+    store = ChunkStore(path)
+    assert store.models() == []
+    with pytest.raises(ValueError, match = 'outdated'):
+        store.vectors('model')
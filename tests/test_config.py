@@ -0,0 +1,122 @@
+import time
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from actions.es import config
+
+
+class Model:
+    '''Model of the backend, loaded by `load_model`.'''
+
+    def __init__(self, backend: str) -> None:
+        self.backend = backend
+
+
+def _load_embed(monkeypatch, backend: str, parity: float, fail: bool = False) -> list:
+    '''Load the embedding module with the backend whose vectors have the parity, recording the loaded models.'''
+    loaded = []
+
+    def load_model(model_name, cache_folder, backend = 'torch'):
+        if fail and backend != 'torch':
+            raise ImportError(f'No {backend}')
+        loaded.append(backend)
+        return Model(backend)
+
+    namespace = vars(config)
+    for name in ['embed', 'embed_cache', 'es_result_cache', 'es_session_cache', 'embed_service']:
+        monkeypatch.setitem(namespace, name, None)
+    monkeypatch.setitem(namespace, 'hardcoded_queries'   , [{'question_stop_words': 'aphids'}]  )
+    monkeypatch.setitem(namespace, 'hardcoded_matrix'    , np.ones((1, 4), dtype = np.float32)  )
+    monkeypatch.setattr(config, 'embed_backend'          , backend                              )
+    monkeypatch.setattr(config, 'embed_parity_threshold' , 0.98                                 )
+    monkeypatch.setattr(config, 'embed_cache_path'       , ''                                   )
+    monkeypatch.setattr(config, 'es_result_cache_path'   , ''                                   )
+    monkeypatch.setattr(config, 'load_model'             , load_model                           )
+    monkeypatch.setattr(config, 'quantize_model'         , lambda model: Model('torch-int8')    )
+    monkeypatch.setattr(config, 'check_parity'           , lambda model, texts, reference: np.array([1.0, parity]))
+
+    config._load_embed()
+    return loaded
+
+
+@pytest.mark.parametrize('backend', ['torch-int8', 'onnx'])
+def test_backend_with_parity_is_kept(monkeypatch, backend):
+    loaded = _load_embed(monkeypatch, backend, parity = 0.99)
+    assert config.embed_backend == backend
+    assert config.embed.backend == backend
+    assert config.embed_service.model is config.embed
+    # the int8 model is quantised from the fp32 one
+    assert loaded == ['torch' if backend == 'torch-int8' else backend]
+
+
+def test_quantised_model_without_parity_falls_back_to_its_fp32_model(monkeypatch):
+    loaded = _load_embed(monkeypatch, 'torch-int8', parity = 0.9)
+    assert config.embed_backend == 'torch' and config.embed.backend == 'torch'
+    assert loaded == ['torch']
+
+
+def test_onnx_model_without_parity_falls_back_to_torch(monkeypatch):
+    loaded = _load_embed(monkeypatch, 'onnx', parity = 0.9)
+    assert config.embed_backend == 'torch' and config.embed.backend == 'torch'
+    assert loaded == ['onnx', 'torch']
+
+
+def test_missing_backend_falls_back_to_torch(monkeypatch):
+    loaded = _load_embed(monkeypatch, 'onnx-int8', parity = 0.9, fail = True)
+    assert config.embed_backend == 'torch'
+    assert loaded == ['torch']
+
+
+def test_lazy_attributes_are_loaded_once_on_first_access(monkeypatch):
+    calls   = []
+    started = threading.Event()
+
+    def loader():
+        calls.append(threading.current_thread().name)
+        started.set()
+        time.sleep(0.05)
+        config.lazy_value = len(calls)
+
+    monkeypatch.setitem(config._loaders, 'lazy_value', loader)
+    monkeypatch.setitem(config._locks, loader, threading.RLock())
+    monkeypatch.delitem(vars(config), 'lazy_value', raising = False)
+    assert 'lazy_value' not in vars(config)
+
+    # the access racing the loading waits for it instead of loading again
+    thread = threading.Thread(target = lambda: config.lazy_value)
+    thread.start()
+    started.wait()
+    assert config.lazy_value == 1
+    thread.join()
+    assert len(calls) == 1
+
+    with pytest.raises(AttributeError):
+        config.missing_value
+
+
+def test_wait_ready_waits_for_the_warm_up(monkeypatch):
+    monkeypatch.setattr(config, 'ready', threading.Event())
+    started = []
+
+    def start_warm_up():
+        started.append(True)
+        threading.Timer(0.05, config.ready.set).start()
+
+    monkeypatch.setattr(config, 'start_warm_up', start_warm_up)
+
+    async def main():
+        assert await config.wait_ready(5)
+        # once warmed up the readiness is not waited for again
+        assert await config.wait_ready(0)
+
+    asyncio.run(main())
+    assert started == [True]
+
+
+def test_wait_ready_times_out_while_warming_up(monkeypatch):
+    monkeypatch.setattr(config, 'ready'         , threading.Event())
+    monkeypatch.setattr(config, 'start_warm_up' , lambda: None)
+    assert not asyncio.run(config.wait_ready(0.05))
@@ -0,0 +1,91 @@
+import time
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from actions.es.embed import EmbedService, EmbedServiceBusy
+
+
+class Model:
+    '''Model encoding every text into its length, blocking while `gate` is clear.'''
+
+    def __init__(self) -> None:
+        self.gate   = threading.Event()
+        self.calls  = []
+        self.gate.set()
+
+    def encode(self, texts, show_progress_bar = False, batch_size = 32):
+        self.calls.append(list(texts))
+        self.gate.wait()
+        return np.array([[len(t), 1.0] for t in texts], dtype = np.float32)
+
+
+def _service(model: Model, **kwargs) -> EmbedService:
+    return EmbedService(model, 'model', '/tmp', **kwargs)
+
+
+def test_timed_out_request_holds_its_slot_until_the_pool_is_done():
+    model   = Model()
+    service = _service(model, workers = 1, queue_size = 0, batch_size = 1, timeout = 0.05)
+
+    async def main():
+        model.gate.clear()
+        try:
+            with pytest.raises(EmbedServiceBusy):
+                await service.encode(['slow'])
+            # the job still runs in the pool, so no other one is queued behind it
+            with pytest.raises(EmbedServiceBusy, match = 'queue is full'):
+                await service.encode(['next'])
+        finally:
+            model.gate.set()
+        await asyncio.sleep(0.05)
+        assert (await service.encode(['next']))[0, 0] == 4
+        assert model.calls == [['slow'], ['next']]
+
+    asyncio.run(main())
+    service.shutdown()
+
+
+def test_concurrent_requests_are_fused_into_one_batch():
+    model   = Model()
+    service = _service(model, workers = 1, queue_size = 8, batch_size = 4, batch_window = 50, timeout = 5)
+
+    async def main():
+        vectors = await asyncio.gather(*[service.encode([t]) for t in ['a', 'bb', 'ccc']])
+        assert [v[0, 0] for v in vectors] == [1, 2, 3]
+        assert model.calls == [['a', 'bb', 'ccc']]
+
+        # five texts overflow the batch of four, the last one goes in the next batch
+        vectors = await asyncio.gather(service.encode(['dddd', 'eeeee']), *[service.encode([t]) for t in ['f', 'gg', 'hhh']])
+        assert vectors[0][:, 0].tolist() == [4, 5]
+        assert sorted(len(c) for c in model.calls[1:]) == [1, 4]
+
+    asyncio.run(main())
+    service.shutdown()
+
+    stats = service.batch_stats()
+    assert stats['batches'] == 3 and stats['texts'] == 8
+    assert stats['histogram'] == [0, 1, 0, 1, 1]
+    assert stats['mean_fill'] == 8 / 12
+
+
+def test_batch_sizes_are_rendered(monkeypatch):
+    from actions.es import config, metrics
+
+    model   = Model()
+    service = _service(model, workers = 1, queue_size = 8, batch_size = config.embed_batch_size, batch_window = 50, timeout = 5)
+    monkeypatch.setitem(vars(config), 'embed_service', service)
+
+    async def main():
+        await asyncio.gather(*[service.encode([t]) for t in ['a', 'bb', 'ccc']])
+
+    asyncio.run(main())
+    service.shutdown()
+
+    text = metrics.render([metrics.snapshot(), metrics.snapshot()])
+    assert 'actions_embed_batch_size_bucket{le="2"} 0' in text
+    assert 'actions_embed_batch_size_bucket{le="3"} 2' in text
+    assert 'actions_embed_batch_size_sum 6.0' in text
+    assert 'actions_embed_batch_size_count 2' in text
@@ -0,0 +1,269 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from actions.es import config, es
+from actions.es.cache import LRUCache
+
+
+class EmbedService:
+    '''Embedding service encoding every text into the same vector.'''
+
+    def __init__(self, vector: np.ndarray) -> None:
+        self.vector = vector
+
+    async def encode(self, texts):
+        return np.stack([self.vector] * len(texts))
+
+
+class Retriever:
+    '''Retriever returning the hits as fetched.'''
+
+    projection = None
+
+    async def fetch(self, hits):
+        return hits
+
+
+def _unit(i: int, dims: int = 4) -> np.ndarray:
+    vector = np.zeros(dims, dtype = np.float32)
+    vector[i] = 1.0
+    return vector
+
+
+def _followup(monkeypatch, state: dict = None) -> dict:
+    '''Patch the search of the follow-up, recording the calls.'''
+    calls   = {}
+    cache   = LRUCache()
+    if state is not None:
+        cache.set('session', state)
+
+    async def submit(question, slots = None, session = None):
+        calls['submit'] = {'question': question, 'slots': slots, 'session': session}
+        return {'data': []}, question
+
+    async def rescore(vector, ids):
+        return []
+
+    async def search(query_vectors, hardcoded_vector):
+        calls['search'] = (query_vectors, hardcoded_vector)
+        return []
+
+    # set in the namespace of config, so the lazy attributes are not loaded
+    namespace = vars(config)
+    monkeypatch.setitem(namespace, 'es_session_cache'    , cache                     )
+    monkeypatch.setitem(namespace, 'es_slots_parallel'   , False                     )
+    monkeypatch.setitem(namespace, 'es_followup_weight'  , 0.5                       )
+    monkeypatch.setitem(namespace, 'embed_service'       , EmbedService(_unit(2))    )
+    monkeypatch.setitem(namespace, 'retriever'           , Retriever()               )
+    monkeypatch.setattr(es, 'submit'             , submit                    )
+    monkeypatch.setattr(es, '_rescore_candidates', rescore                   )
+    monkeypatch.setattr(es, '_search_vectors'    , search                    )
+    monkeypatch.setattr(es, '_normalise_query'   , lambda q, slots = None: (q, q, slots or []))
+    return calls
+
+
+def test_followup_without_state_keeps_the_session(monkeypatch):
+    calls = _followup(monkeypatch)
+    asyncio.run(es.submit_followup('aphids on roses', 'leaves curl', slots = ['roses'], session = 'session'))
+    assert calls['submit'] == {'question': 'aphids on roses. leaves curl', 'slots': ['roses'], 'session': 'session'}
+
+
+def test_followup_blends_the_hardcoded_vector_for_the_full_search(monkeypatch):
+    calls = _followup(monkeypatch, {'query': 'aphids', 'vector': _unit(0), 'hardcoded': _unit(1), 'ids': ['a']})
+    asyncio.run(es.submit_followup('aphids', 'leaves curl', session = 'session'))
+
+    query_vectors, hardcoded_vector = calls['search']
+    np.testing.assert_allclose(query_vectors[0] , (_unit(0) + _unit(2)) / np.sqrt(2), rtol = 1e-6)
+    np.testing.assert_allclose(hardcoded_vector , (_unit(1) + _unit(2)) / np.sqrt(2), rtol = 1e-6)
+
+
+def _hardcoded(monkeypatch, vectors: list) -> list:
+    '''Set the hardcoded queries of the vectors (their hits are two results each).'''
+    queries = [{'question': f'q{i}', 'hits': [{'url': f'u{i}', '_score': 1.0}, {'url': 'shared', '_score': 1.0}]} for i in range(len(vectors))]
+    matrix  = np.asarray(vectors, dtype = np.float32)
+    matrix /= np.linalg.norm(matrix, axis = 1, keepdims = True)
+    monkeypatch.setitem(vars(config), 'hardcoded_queries', queries)
+    monkeypatch.setitem(vars(config), 'hardcoded_matrix' , matrix )
+    return queries
+
+
+def test_match_hardcoded_queries_by_cosine(monkeypatch):
+    queries = _hardcoded(monkeypatch, [[1, 0, 0], [1, 1, 0], [0, 0, 1]])
+
+    (score, query), = es._match_hardcoded_queries(np.array([2, 0, 0]))
+    assert query is queries[0] and score == pytest.approx(1.0)
+
+    matches = es._match_hardcoded_queries(np.array([1, 0.1, 0]), top_k = 5)
+    assert [q['question'] for _, q in matches] == ['q0', 'q1', 'q2']
+    assert [s for s, _ in matches] == sorted([s for s, _ in matches], reverse = True)
+
+
+def test_match_hardcoded_queries_without_queries(monkeypatch):
+    monkeypatch.setitem(vars(config), 'hardcoded_queries', [])
+    monkeypatch.setitem(vars(config), 'hardcoded_matrix' , np.zeros((0, 0), dtype = np.float32))
+    assert es._match_hardcoded_queries(np.ones(3)) == []
+
+
+def test_check_for_hardcoded_queries_above_the_threshold(monkeypatch):
+    queries = _hardcoded(monkeypatch, [[1, 0, 0], [1, 0.1, 0], [0, 0, 1]])
+    monkeypatch.setattr(config, 'es_hardcoded_threshold', 0.9)
+    monkeypatch.setattr(config, 'es_hardcoded_top_k'    , 3  )
+
+    hits = es._check_for_hardcoded_queries(np.array([1, 0, 0]))
+    # the hits of both matching queries, deduplicated by url and copied
+    assert [h['url'] for h in hits] == ['u0', 'shared', 'u1']
+    hits[0]['_score'] = 0.5
+    assert queries[0]['hits'][0]['_score'] == 1.0
+
+
+def _hit(_id: str, score: float, source: str = 'ipm') -> dict:
+    return {'_id': _id, '_score': score, 'source': source, 'url': f'https://example.org/{_id}'}
+
+
+def test_fuse_hits_weights_the_slot_queries(monkeypatch):
+    monkeypatch.setattr(config, 'es_slots_weight', 0.4)
+    query   = [_hit('a', 0.9), _hit('b', 0.8), _hit('c', 0.5)]
+    slot_1  = [_hit('b', 0.9), _hit('d', 0.7)]
+    slot_2  = [_hit('b', 0.6), _hit('a', 0.4)]
+
+    fused = es._fuse_hits([query, slot_1, slot_2], size = 3)
+    assert [h['_id'] for h in fused][:2] == ['b', 'a'] and len(fused) == 3
+
+    fused = es._fuse_hits([query, slot_1, slot_2], size = 10)
+    scores = {h['_id']: h['_score'] for h in fused}
+    # missing documents are scored with the lowest score of the query
+    assert scores['b'] == pytest.approx(0.6 * 0.8 + 0.2 * 0.9 + 0.2 * 0.6)
+    assert scores['a'] == pytest.approx(0.6 * 0.9 + 0.2 * 0.7 + 0.2 * 0.4)
+    assert scores['c'] == pytest.approx(0.6 * 0.5 + 0.2 * 0.7 + 0.2 * 0.4)
+    assert scores['d'] == pytest.approx(0.6 * 0.5 + 0.2 * 0.7 + 0.2 * 0.4)
+    assert query[0]['_score'] == 0.9
+
+
+def test_fuse_hits_with_empty_slot_hits(monkeypatch):
+    monkeypatch.setattr(config, 'es_slots_weight', 0.5)
+    fused = es._fuse_hits([[_hit('a', 0.8)], []], size = 10)
+    assert [(h['_id'], h['_score']) for h in fused] == [('a', pytest.approx(0.4))]
+
+
+def test_merge_partitions_weights_every_partition(monkeypatch):
+    monkeypatch.setattr(config, 'es_partitioned', True)
+    monkeypatch.setattr(config, 'es_ask_weight' , 0.5 )
+    ask     = [_hit('a', 0.9, 'askExtension'), _hit('b', 0.7, 'askExtension')]
+    ipm     = [_hit('c', 0.6), _hit('d', 0.4)]
+
+    hits = es._merge_partitions([ask, ipm])
+    assert [(h['_id'], h['_score']) for h in hits] == [
+        ('c', 0.6), ('a', pytest.approx(0.45)), ('d', 0.4), ('b', pytest.approx(0.35))]
+    assert es._source_weight('askExtension') == 0.5 and es._source_weight('ipm') == 1.0
+
+
+def test_merge_partitions_without_partitioning(monkeypatch):
+    monkeypatch.setattr(config, 'es_partitioned', False)
+    hits = [_hit('a', 0.9, 'askExtension')]
+    assert es._merge_partitions([hits]) is hits
+    assert [r.size for r in es._search_requests(np.ones(3))] == [config.es_search_size]
+
+
+def test_search_requests_per_partition(monkeypatch):
+    monkeypatch.setattr(config, 'es_partitioned', True)
+    monkeypatch.setattr(config, 'es_search_size', 100 )
+    requests = es._search_requests(np.ones(3))
+    assert [(r.size, r.sources, r.exclude) for r in requests] == [(30, ['askExtension'], None), (70, None, ['askExtension'])]
+
+
+class RecordingEmbedService:
+    '''Embedding service encoding the i-th text of every call into the i-th unit vector, recording the calls.'''
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    async def encode(self, texts):
+        self.calls.append(list(texts))
+        return np.stack([_unit(i) for i in range(len(texts))])
+
+
+def _encode_once(monkeypatch, shared: bool) -> tuple:
+    service = RecordingEmbedService()
+    calls   = {}
+
+    async def search(query_vectors, hardcoded_vector):
+        calls['search'] = (query_vectors, hardcoded_vector)
+        return []
+
+    monkeypatch.setitem(vars(config), 'embed_service'           , service   )
+    monkeypatch.setattr(config, 'es_hardcoded_shared_vector'    , shared    )
+    monkeypatch.setattr(es, '_search_vectors'                   , search    )
+    hits, vector, hardcoded_vector = asyncio.run(es._handle_es_query('aphid', ['aphids', 'roses']))
+    return service.calls, calls['search'], vector, hardcoded_vector
+
+
+def test_query_variants_are_encoded_in_one_call(monkeypatch):
+    calls, (query_vectors, _), vector, hardcoded_vector = _encode_once(monkeypatch, shared = False)
+    assert calls == [['aphid', 'aphids', 'roses']]
+    np.testing.assert_array_equal(hardcoded_vector  , _unit(0))
+    np.testing.assert_array_equal(query_vectors     , [_unit(1), _unit(2)])
+    np.testing.assert_array_equal(vector            , _unit(1))
+
+
+def test_shared_vector_skips_the_hardcoded_variant(monkeypatch):
+    calls, (query_vectors, _), vector, hardcoded_vector = _encode_once(monkeypatch, shared = True)
+    assert calls == [['aphids', 'roses']]
+    np.testing.assert_array_equal(hardcoded_vector  , _unit(0))
+    np.testing.assert_array_equal(vector            , _unit(0))
+
+
+class GenerationRetriever(Retriever):
+    '''Retriever of the given generation.'''
+
+    def __init__(self, generation: str) -> None:
+        self.current = generation
+
+    async def generation(self):
+        return self.current
+
+
+def test_result_cache_key_changes_with_the_generation_and_the_ranking(monkeypatch):
+    key = es._result_cache_key('aphid', ['aphids', 'roses'], 'gen-1')
+    assert key == es._result_cache_key('aphid', ['aphids', 'roses'], 'gen-1')
+    assert key != es._result_cache_key('aphid', ['aphids', 'roses'], 'gen-2')
+    assert key != es._result_cache_key('aphid', ['aphids'], 'gen-1')
+
+    monkeypatch.setattr(config, 'es_top_n', config.es_top_n + 1)
+    assert key != es._result_cache_key('aphid', ['aphids', 'roses'], 'gen-1')
+
+
+def test_results_are_cached_until_the_generation_changes(monkeypatch):
+    retriever   = GenerationRetriever('gen-1')
+    searches    = []
+
+    async def wait_ready(timeout):
+        return True
+
+    async def handle_es_query(text_hardcoded, texts_search):
+        searches.append(text_hardcoded)
+        return [_hit(f'doc-{len(searches)}', 0.9)], _unit(0), _unit(1)
+
+    namespace = vars(config)
+    monkeypatch.setitem(namespace, 'es_result_cache'     , LRUCache() )
+    monkeypatch.setitem(namespace, 'es_session_cache'    , None       )
+    monkeypatch.setitem(namespace, 'retriever'           , retriever  )
+    monkeypatch.setattr(config, 'wait_ready'         , wait_ready                                   )
+    monkeypatch.setattr(es, '_normalise_query'       , lambda q, slots = None: (q, q, slots or [])  )
+    monkeypatch.setattr(es, '_handle_es_query'       , handle_es_query                              )
+    monkeypatch.setattr(es, '_handle_es_result'      , lambda hits: hits                            )
+    monkeypatch.setattr(es, '_get_text'              , lambda hits: {'data': [h['_id'] for h in hits]})
+
+    async def main():
+        first, _ = await es.submit('aphids')
+        # a copy is cached, so changing the returned results does not change the cached ones
+        first['data'].append('changed')
+        assert (await es.submit('aphids'))[0] == {'data': ['doc-1']}
+        assert len(searches) == 1
+
+        retriever.current = 'gen-2'
+        assert (await es.submit('aphids'))[0] == {'data': ['doc-2']}
+        assert len(searches) == 2
+
+    asyncio.run(main())
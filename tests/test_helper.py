@@ -0,0 +1,86 @@
+import pytest
+
+pytest.importorskip('rasa_sdk')
+
+from actions import helper
+from actions.es import config
+
+
+class Tracker:
+
+    def __init__(self, sender_id: str) -> None:
+        self.sender_id  = sender_id
+        self.events     = []
+
+    def say(self, text: str) -> None:
+        self.events.append({
+            'event'     : 'user',
+            'timestamp' : 1651399200.0 + len(self.events),
+            'text'      : text,
+            'parse_data': {'intent': {'name': 'intent_problem_description'}},
+        })
+
+    def answer(self, text: str) -> None:
+        self.events.append({
+            'event'     : 'bot',
+            'timestamp' : 1651399200.0 + len(self.events),
+            'text'      : text,
+            'data'      : {'custom': None},
+        })
+
+
+@pytest.fixture(autouse = True)
+def offsets():
+    config.chat_log_offsets.clear()
+    yield config.chat_log_offsets
+
+
+def test_first_export_is_the_whole_chat():
+    tracker = Tracker('s1')
+    tracker.say('aphids on roses')
+    tracker.answer('here are my results')
+
+    export = helper._export_chat(tracker)
+    assert export['append'] is False
+    assert [h['text'] for h in export['chat_history']] == ['aphids on roses', 'here are my results']
+    assert export['timestamp'] == export['chat_history'][0]['timestamp']
+
+
+def test_committed_export_is_appended_to():
+    tracker = Tracker('s1')
+    tracker.say('aphids on roses')
+    export = helper._export_chat(tracker)
+    helper._commit_export(tracker, export['timestamp'])
+
+    tracker.answer('here are my results')
+    export2 = helper._export_chat(tracker)
+    assert export2['append'] is True
+    assert [h['text'] for h in export2['chat_history']] == ['here are my results']
+    # the entries keep the offsets of their events in the tracker
+    assert [h['offset'] for h in export2['chat_history']] == [1]
+    assert export2['timestamp'] == export['timestamp']
+
+
+def test_offsets_do_not_move_before_the_commit():
+    # the events of a save that was not accepted are exported again
+    tracker = Tracker('s1')
+    tracker.say('aphids on roses')
+    helper._export_chat(tracker)
+
+    tracker.answer('here are my results')
+    export = helper._export_chat(tracker)
+    assert export['append'] is False
+    assert len(export['chat_history']) == 2
+
+
+def test_diverged_tracker_is_exported_whole():
+    tracker = Tracker('s1')
+    tracker.say('aphids on roses')
+    helper._commit_export(tracker, helper._export_chat(tracker)['timestamp'])
+
+    # i.e. a restored tracker whose events do not continue the exported ones
+    tracker.events[0]['timestamp'] += 100
+    tracker.answer('here are my results')
+    export = helper._export_chat(tracker)
+    assert export['append'] is False
+    assert len(export['chat_history']) == 2
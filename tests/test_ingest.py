@@ -0,0 +1,139 @@
+import pytest
+
+from actions.es.ingest import Checkpoint, content_hash, doc_fields, document_id, prune_versions, swap_aliases
+
+
+def _doc(i: int, text: str = 'Aphids suck the sap.') -> dict:
+    doc = {f: '' for f in doc_fields}
+    doc.update({'source': 'pestsDiseases', 'url': f'https://example.org/{i}', 'title': f'Pest {i}', 'description': text, 'links': []})
+    return doc
+
+
+def _hashed(doc: dict, model: str = 'model') -> dict:
+    return dict(doc, _id = document_id(doc), content_hash = content_hash(doc, model))
+
+
+def test_checkpoint_resumes_the_written_documents(tmp_path):
+    path        = str(tmp_path / 'checkpoint')
+    checkpoint  = Checkpoint(path, 'combined-1')
+    docs        = [_hashed(_doc(i)) for i in range(3)]
+    checkpoint.add(docs[:2])
+    checkpoint.add(docs[2:])
+    # torn last line of an interrupted run
+    with open(path, 'a') as f:
+        f.write('{"_id": "torn", "ha')
+
+    resumed = Checkpoint(path, 'combined-1')
+    assert resumed.hashes == {d['_id']: d['content_hash'] for d in docs}
+    assert Checkpoint(path).index == 'combined-1'
+
+    resumed.remove()
+    assert Checkpoint(path, 'combined-1').hashes == {}
+
+
+def test_checkpoint_of_another_index_is_discarded(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    Checkpoint(path, 'combined-1').add([_hashed(_doc(0))])
+
+    assert Checkpoint(path, 'combined-2').hashes == {}
+    assert not (tmp_path / 'checkpoint').exists()
+
+
+def test_content_hash_changes_with_the_fields_and_the_model():
+    doc = _doc(0)
+    assert content_hash(doc, 'model') == content_hash(dict(doc), 'model')
+    assert content_hash(doc, 'model') != content_hash(doc, 'other')
+    assert content_hash(doc, 'model') != content_hash(_doc(0, 'Aphids curl the leaves.'), 'model')
+    # the id is kept when the body changes, so the document is updated in place
+    assert document_id(doc) == document_id(dict(doc, management = 'Spray water.'))
+
+
+class Indices:
+
+    def refresh(self, index):
+        pass
+
+
+class Client:
+    indices = Indices()
+
+
+def test_run_skips_the_documents_with_known_hashes(tmp_path, monkeypatch):
+    pytest.importorskip('spacy')
+    from actions.es.ingest import Ingest
+
+    docs    = [_doc(i) for i in range(4)]
+    indexed = _hashed(docs[0])
+    changed = _hashed(dict(docs[1], management = 'Old management.'))
+    # the interrupted run wrote the third one
+    Checkpoint(str(tmp_path / 'checkpoint'), 'combined-1').add([_hashed(docs[2])])
+    ingest  = Ingest(Client(), model = None, model_name = 'model', index = 'combined-1', checkpoint = str(tmp_path / 'checkpoint'), batch_size = 2)
+
+    written, deleted = [], []
+    monkeypatch.setattr(ingest, '_indexed_hashes'   , lambda: {indexed['_id']: indexed['content_hash'], changed['_id']: changed['content_hash'], 'stale': 'hash'})
+    monkeypatch.setattr(ingest, '_embed'            , lambda batch: None)
+    monkeypatch.setattr(ingest, '_write'            , lambda batch: written.extend(d['title'] for d in batch))
+    monkeypatch.setattr(ingest, '_delete'           , deleted.extend)
+
+    stats = ingest.run(docs + [_doc(0)])
+    assert written == ['Pest 1', 'Pest 3']
+    assert deleted == ['stale']
+    assert stats['read'] == 4 and stats['skipped'] == 2
+    assert not (tmp_path / 'checkpoint').exists()
+
+
+class AliasIndices:
+    '''Indices API of a sync ES client over the index names and the aliases, recording the alias updates.'''
+
+    def __init__(self, indices: list, aliases: dict) -> None:
+        self.indices    = set(indices)
+        self.aliases    = aliases
+        self.updates    = []
+
+    def get(self, index, **kwargs):
+        prefix = index.rstrip('*')
+        return {i: {} for i in self.indices if i.startswith(prefix)}
+
+    def exists(self, index):
+        return index in self.indices or index in self.aliases
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {i: {'aliases': {name: {}}} for i in self.aliases[name]}
+
+    def update_aliases(self, body):
+        self.updates.append(body['actions'])
+
+    def delete(self, index, ignore = None):
+        self.indices.discard(index)
+
+
+class AliasClient:
+
+    def __init__(self, indices: list, aliases: dict = None) -> None:
+        self.indices = AliasIndices(indices, aliases or {})
+
+
+def test_swap_aliases_switches_all_the_aliases_in_one_update():
+    # the chunk index predates the versioning - a concrete index with the name of the alias
+    client = AliasClient(['combined-1', 'combined-2', 'chunks', 'chunks-2'], {'combined': ['combined-1']})
+    swap_aliases(client, {'combined': 'combined-2', 'chunks': 'chunks-2'})
+
+    assert client.indices.updates == [[
+        {'remove'       : {'index': 'combined-1', 'alias': 'combined'}},
+        {'add'          : {'index': 'combined-2', 'alias': 'combined'}},
+        {'remove_index' : {'index': 'chunks'}},
+        {'add'          : {'index': 'chunks-2', 'alias': 'chunks'}},
+    ]]
+
+
+def test_prune_versions_keeps_the_latest_and_the_aliased():
+    versions    = [f'combined-2022050{i}' for i in range(1, 6)]
+    client      = AliasClient(versions, {'combined': [versions[0]]})
+    prune_versions(client, 'combined', keep = 2)
+    assert sorted(client.indices.indices) == [versions[0], versions[3], versions[4]]
+
+    prune_versions(client, 'combined', keep = 0)
+    assert sorted(client.indices.indices) == [versions[0]]
@@ -0,0 +1,178 @@
+import os
+import json
+import asyncio
+
+from elasticsearch import TransportError
+
+from actions.es.logs import ChatLogWriter
+
+
+class Client:
+    '''ES client recording the `_bulk` requests, failing while `down` is set.'''
+
+    def __init__(self, down: bool = False, hang: bool = False) -> None:
+        self.down   = down
+        self.hang   = hang
+        self.docs   = []
+
+    async def bulk(self, body, **kwargs):
+        if self.hang:
+            await asyncio.Event().wait()
+        if self.down:
+            raise TransportError(503, 'unavailable')
+        self.docs.extend(body[1::2])
+        return {'errors': False, 'items': [{'update': {'status': 200}} for _ in body[::2]]}
+
+
+def _chat(chat_id: str, text: str = 'hi', append: bool = False, offset: int = 0) -> dict:
+    return {
+        'chat_id'       : chat_id,
+        'timestamp'     : '2022-05-01T10:00:00',
+        'chat_history'  : [{'agent': 'user', 'timestamp': '2022-05-01T10:00:00', 'text': text, 'offset': offset}],
+        'append'        : append,
+    }
+
+
+def _saved(doc: dict) -> dict:
+    '''Chat of the `_bulk` source - of the upsert of a scripted update, or the indexed one.'''
+    return doc.get('upsert', doc)
+
+
+def _history(doc: dict) -> list:
+    '''Chat history of the `_bulk` source - the one added by the script, or the indexed one.'''
+    return doc['script']['params']['history'] if 'script' in doc else doc['chat_history']
+
+
+def _journaled(path) -> list:
+    docs = []
+    for f in path.parent.glob(path.name + '.*'):
+        docs.extend(json.loads(line) for line in f.read_text().splitlines() if line.strip())
+    return docs
+
+
+def _writer(client, path, **kwargs) -> ChatLogWriter:
+    return ChatLogWriter(client, 'logs', journal_path = str(path), max_retries = 0, backoff = 0.0, **kwargs)
+
+
+def test_stop_saves_the_queue(tmp_path):
+    client = Client()
+    writer = _writer(client, tmp_path / 'journal')
+
+    async def main():
+        writer.write(_chat('a'))
+        writer.write(_chat('b'))
+        await writer.stop()
+
+    asyncio.run(main())
+    assert sorted(_saved(d)['chat_id'] for d in client.docs) == ['a', 'b']
+    assert _journaled(tmp_path / 'journal') == []
+    assert writer.stats()['queued'] == 0
+
+
+def test_whole_chats_are_saved_as_scripted_upserts(tmp_path):
+    # a whole chat replayed after a newer append must not overwrite the appended entries
+    client = Client()
+    writer = _writer(client, tmp_path / 'journal')
+
+    async def main():
+        writer.write(_chat('a'))
+        await writer.stop()
+
+    asyncio.run(main())
+    assert 'script' in client.docs[0]
+    assert client.docs[0]['upsert']['chat_id'] == 'a'
+    assert 'append' not in client.docs[0]['upsert']
+
+
+def test_saves_carry_the_event_offsets(tmp_path):
+    # the script skips the entries up to the `last_offset` of the stored chat
+    client = Client()
+    writer = _writer(client, tmp_path / 'journal')
+
+    async def main():
+        writer.write(_chat('a', 'first', offset = 0))
+        writer.write(_chat('a', 'again', append = True, offset = 2))
+        await writer.stop()
+
+    asyncio.run(main())
+    assert [h['offset'] for h in _history(client.docs[0])] == [0, 2]
+    assert client.docs[0]['upsert']['last_offset'] == 2
+    assert 'HashSet' not in client.docs[0]['script']['source']
+
+
+def test_write_without_journal_reports_the_dropped_conversation(tmp_path):
+    writer = ChatLogWriter(Client(), 'logs', queue_size = 1, journal_path = '')
+
+    async def main():
+        assert writer.write(_chat('a'))
+        assert not writer.write(_chat('b'))
+        writer.close()
+
+    asyncio.run(main())
+
+
+def test_queue_is_merged_per_conversation(tmp_path):
+    client = Client()
+    writer = _writer(client, tmp_path / 'journal')
+
+    async def main():
+        writer.write(_chat('a', 'first'))
+        writer.write(_chat('a', 'second', append = True, offset = 1))
+        await writer.stop()
+
+    asyncio.run(main())
+    assert len(client.docs) == 1
+    assert [h['text'] for h in _history(client.docs[0])] == ['first', 'second']
+
+
+def test_failed_saves_are_journaled_and_replayed(tmp_path):
+    path    = tmp_path / 'journal'
+    writer  = _writer(Client(down = True), path)
+
+    async def main():
+        writer.write(_chat('a'))
+        await writer.stop()
+
+    asyncio.run(main())
+    assert [d['chat_id'] for d in _journaled(path)] == ['a']
+
+    client  = Client()
+    writer  = _writer(client, path, flush_interval = 0.01)
+
+    async def replay():
+        writer._start()
+        await asyncio.sleep(0.05)
+        await writer.stop()
+
+    asyncio.run(replay())
+    assert [_saved(d)['chat_id'] for d in client.docs] == ['a']
+    assert _journaled(path) == []
+
+
+def test_full_queue_is_journaled(tmp_path):
+    path    = tmp_path / 'journal'
+    writer  = _writer(Client(), path, queue_size = 1)
+
+    async def main():
+        writer.write(_chat('a'))
+        writer.write(_chat('b'))
+        assert [d['chat_id'] for d in _journaled(path)] == ['b']
+        writer.close()
+
+    asyncio.run(main())
+
+
+def test_close_after_the_loop_is_closed_spills_the_batch_in_flight(tmp_path):
+    path    = tmp_path / 'journal'
+    writer  = _writer(Client(hang = True), path, batch_size = 1, flush_interval = 0.01)
+
+    async def main():
+        writer.write(_chat('a'))
+        writer.write(_chat('b'))
+        # the flusher takes `a` and hangs in `_bulk`, the loop is closed with it in flight
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    writer.close()
+    assert sorted(d['chat_id'] for d in _journaled(path)) == ['a', 'b']
+    assert os.path.isfile(f'{path}.{os.getpid()}')
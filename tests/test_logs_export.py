@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import pytest
+
+from actions.es.logs_export import flatten_chat
+
+
+def _chat() -> dict:
+    return {
+        'chat_id'       : 'chat',
+        'timestamp'     : '2022-05-01T10:00:00',
+        'chat_history'  : [
+            {'agent': 'user', 'timestamp': '2022-05-01T10:00:00', 'text': 'aphids on roses', 'intent': 'ask_pest'},
+            {'agent': 'bot' , 'timestamp': '2022-05-01T10:00:01.500000', 'text': 'Here are my top results:', 'results': [
+                {'url': 'https://example.org/a', 'score': '0.73'},
+                {'url': 'https://example.org/b', 'score': 'n/a' },
+            ]},
+            {'agent': 'bot' , 'timestamp': 'not a date', 'text': 'Anything else?'},
+        ],
+    }
+
+
+def test_flatten_chat_turns():
+    turns, _ = flatten_chat(_chat())
+
+    assert [t['turn'] for t in turns] == [0, 1, 2]
+    assert [t['agent'] for t in turns] == ['user', 'bot', 'bot']
+    assert all(t['chat_id'] == 'chat' and t['chat_start'] == datetime(2022, 5, 1, 10) for t in turns)
+    assert turns[0]['intent'] == 'ask_pest' and turns[0]['latency_ms'] is None
+    assert turns[1]['latency_ms'] == pytest.approx(1500.0)
+    assert turns[1]['n_results'] == 2 and turns[1]['top_score'] == pytest.approx(0.73)
+    # unparseable timestamps are kept as nulls
+    assert turns[2]['timestamp'] is None and turns[2]['latency_ms'] is None
+    assert turns[2]['n_results'] == 0 and turns[2]['top_score'] is None
+
+
+def test_flatten_chat_results():
+    _, results = flatten_chat(_chat())
+
+    assert [(r['turn'], r['rank'], r['url']) for r in results] == [(1, 1, 'https://example.org/a'), (1, 2, 'https://example.org/b')]
+    assert results[0]['score'] == pytest.approx(0.73) and results[1]['score'] is None
+    assert results[0]['timestamp'] == datetime(2022, 5, 1, 10, 0, 1, 500000)
+
+
+def test_flatten_chat_without_history():
+    assert flatten_chat({'chat_id': 'chat', 'timestamp': '2022-05-01T10:00:00'}) == ([], [])
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from actions.es import config, metrics
+from actions.es.metrics import Histogram
+
+
+def _histogram(monkeypatch) -> Histogram:
+    '''Histogram of the stages rendered alone.'''
+    histogram = Histogram('test_seconds', 'Latency.', ['stage'], [0.1, 0.5, 1.0])
+    monkeypatch.setattr(metrics, 'stage_seconds', histogram  )
+    monkeypatch.setattr(metrics, 'histograms'   , [histogram])
+    monkeypatch.setattr(metrics, 'sampled'      , []         )
+    return histogram
+
+
+def test_values_are_counted_in_their_buckets(monkeypatch):
+    histogram = _histogram(monkeypatch)
+    for value in [0.05, 0.1, 0.3, 2.0]:
+        histogram.observe(value, 'search')
+
+    # the buckets are inclusive of their upper bound
+    assert histogram.snapshot() == [[['search'], [2, 1, 0, 1], pytest.approx(2.45)]]
+
+
+def test_render_sums_the_snapshots_of_the_workers(monkeypatch):
+    histogram = _histogram(monkeypatch)
+    histogram.observe(0.05, 'search')
+    histogram.observe(0.7 , 'encode')
+    # the snapshots go through JSON from the workers to the router
+    worker = json.loads(json.dumps(metrics.snapshot()))
+    histogram.observe(0.3 , 'search')
+
+    lines = metrics.render([metrics.snapshot(), worker]).splitlines()
+    assert lines[:2] == ['# HELP test_seconds Latency.', '# TYPE test_seconds histogram']
+    assert 'test_seconds_bucket{stage="search",le="0.1"} 2'    in lines
+    assert 'test_seconds_bucket{stage="search",le="0.5"} 3'    in lines
+    assert 'test_seconds_bucket{stage="search",le="+Inf"} 3'   in lines
+    assert 'test_seconds_count{stage="search"} 3'              in lines
+    assert 'test_seconds_bucket{stage="encode",le="0.5"} 0'    in lines
+    assert 'test_seconds_bucket{stage="encode",le="1.0"} 2'    in lines
+    assert 'test_seconds_sum{stage="encode"} 1.4'              in lines
+    assert metrics.render() == metrics.render([metrics.snapshot()])
+
+
+def test_labels_are_escaped(monkeypatch):
+    _histogram(monkeypatch).observe(0.05, 'say "hi"\n')
+    assert 'test_seconds_count{stage="say \\"hi\\"\\n"} 1' in metrics.render().splitlines()
+
+
+def test_span_times_the_stage(monkeypatch):
+    histogram = _histogram(monkeypatch)
+    monkeypatch.setattr(config, 'metrics_enabled', True)
+
+    with pytest.raises(ValueError):
+        with metrics.span('search'):
+            raise ValueError()
+    assert histogram.snapshot()[0][0] == ['search'] and sum(histogram.snapshot()[0][1]) == 1
+
+    monkeypatch.setattr(config, 'metrics_enabled', False)
+    with metrics.span('search'):
+        pass
+    assert sum(histogram.snapshot()[0][1]) == 1
+
+
+def test_action_is_timed_with_its_outcome(monkeypatch):
+    histogram = Histogram('test_action_seconds', 'Latency.', ['action', 'outcome'], [0.1])
+    monkeypatch.setattr(metrics, 'action_seconds'   , histogram)
+    monkeypatch.setattr(config, 'metrics_enabled'   , True     )
+
+    with metrics.action('action_submit', 'sender'):
+        assert metrics._sender_id.get() == 'sender'
+    with pytest.raises(ValueError):
+        with metrics.action('action_submit'):
+            raise ValueError()
+
+    assert sorted(labels for labels, _, _ in histogram.snapshot()) == [['action_submit', 'error'], ['action_submit', 'ok']]
+    assert metrics._sender_id.get() is None
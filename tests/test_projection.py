@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from actions.es.projection import Projection
+
+
+def _vectors(n: int = 200, dims: int = 16, rank: int = 4, seed: int = 0) -> np.ndarray:
+    '''Vectors spanning `rank` dimensions (with a little noise).'''
+    rng = np.random.default_rng(seed)
+    return rng.normal(size = (n, rank)) @ rng.normal(size = (rank, dims)) + rng.normal(scale = 1e-3, size = (n, dims))
+
+
+def test_pca_keeps_the_principal_components():
+    vectors     = _vectors()
+    projection  = Projection.fit(vectors, dims = 4)
+    projected   = projection.apply(vectors)
+
+    assert projection.dims == 4 and projected.shape == (200, 4) and projected.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(projected, axis = 1), 1.0, rtol = 1e-5)
+    assert projection.apply(vectors[0]).shape == (4, )
+
+    # the vectors span 4 dimensions, so the components reconstruct them
+    full            = vectors / np.linalg.norm(vectors, axis = 1, keepdims = True)
+    reconstructed   = (full - projection.mean) @ projection.components @ projection.components.T + projection.mean
+    np.testing.assert_allclose(reconstructed, full, atol = 1e-2)
+
+
+def test_truncate_keeps_the_leading_dimensions():
+    vectors     = _vectors()
+    projected   = Projection.fit(vectors, dims = 3, method = 'truncate').apply(vectors)
+    leading     = vectors[:, :3] / np.linalg.norm(vectors[:, :3], axis = 1, keepdims = True)
+    np.testing.assert_allclose(projected, leading, rtol = 1e-5, atol = 1e-6)
+
+
+def test_save_and_load(tmp_path):
+    projection  = Projection.fit(_vectors(), dims = 4)
+    path        = str(tmp_path / 'projection.npz')
+    projection.save(path)
+    loaded      = Projection.load(path)
+
+    assert loaded.method == 'pca' and loaded.id == projection.id
+    np.testing.assert_array_equal(loaded.apply(_vectors(n = 3, seed = 1)), projection.apply(_vectors(n = 3, seed = 1)))
+
+
+def test_fit_rejects_invalid_dimensions():
+    with pytest.raises(ValueError):
+        Projection.fit(_vectors(), dims = 16)
+    with pytest.raises(ValueError):
+        Projection.fit(_vectors(n = 3), dims = 4)
+    with pytest.raises(ValueError):
+        Projection('random', np.zeros(2), np.eye(2))
+
+
+def test_cut_off_keeps_the_same_top_hits_after_projection():
+    # sentence embeddings share a common direction - 8 topics around it in 64 dimensions, the query is close to one topic
+    rng     = np.random.default_rng(0)
+    common  = rng.normal(size = 64)
+    topics  = rng.normal(size = (8, 64))
+    corpus  = common + np.repeat(topics, 25, axis = 0) + rng.normal(scale = 0.1, size = (200, 64))
+    query   = common + topics[3] + rng.normal(scale = 0.1, size = 64)
+    full    = corpus / np.linalg.norm(corpus, axis = 1, keepdims = True)
+
+    def _above(scores, cut_off):
+        return set(np.flatnonzero(scores > cut_off))
+
+    full_scores = full @ (query / np.linalg.norm(query))
+    projection  = Projection.fit(corpus, dims = 12)
+    scores      = projection.apply(corpus) @ projection.apply(query)
+
+    assert not projection.centred
+    assert np.abs(scores - full_scores).max() < 0.02
+    for cut_off in [0.4, 0.5, 0.6]:
+        assert _above(scores, cut_off) == _above(full_scores, cut_off)
+    # the documents of the topic of the query stay on top
+    assert set(np.argsort(-scores)[:25]) == set(np.argsort(-full_scores)[:25]) == set(range(75, 100))
+
+    # centring on the corpus mean (as fitted before) shifts the scores below the cut-off
+    mean        = full.mean(axis = 0)
+    centred     = Projection('pca', mean, np.linalg.svd(full - mean, full_matrices = False)[2][:12].T)
+    assert centred.centred
+    assert len(_above(centred.apply(corpus) @ centred.apply(query), 0.4)) < len(_above(full_scores, 0.4))
@@ -0,0 +1,109 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from elasticsearch import TransportError
+
+from actions.es.retriever import server_version, knn_min_version, source_fields, light_fields, SearchRequest, ESScriptRetriever
+
+
+class Client:
+    '''ES client answering `info` with the version.'''
+
+    def __init__(self, number: str) -> None:
+        self.number = number
+
+    def info(self):
+        return {'version': {'number': self.number}}
+
+
+def test_server_version_supports_knn_from_8_4():
+    assert server_version(Client('7.17.4')) < knn_min_version
+    assert server_version(Client('8.3.3' )) < knn_min_version
+    assert server_version(Client('8.4.0' )) >= knn_min_version
+    assert server_version(Client('8.10.2')) >= knn_min_version
+
+
+class AsyncClient:
+    '''Async ES client recording the calls, answering from the stored documents.'''
+
+    def __init__(self, docs: dict = None) -> None:
+        self.docs   = docs or {}
+        self.calls  = []
+        self.error  = None
+
+    def _response(self, body: dict) -> dict:
+        # a hit per document with the score of the size of the search, so the responses can be told apart
+        return {'hits': {'hits': [{
+            '_id'       : i                                                         ,
+            '_score'    : 1.0 + body['size'] / 10                                   ,
+            '_source'   : {'source': self.docs[i]['source'], 'url': self.docs[i]['url']},
+            'inner_hits': {'nested': {'hits': {'hits': [{'_score': 1.5, '_source': {'name': 'title_0'}}]}}},
+        } for i in self.docs]}}
+
+    async def search(self, index, body, **kwargs):
+        self.calls.append(('search', index))
+        return self._response(body)
+
+    async def msearch(self, body, **kwargs):
+        self.calls.append(('msearch', body[::2]))
+        return {'responses': [self.error or self._response(b) for b in body[1::2]]}
+
+    async def mget(self, index, body, _source_includes = None, **kwargs):
+        self.calls.append(('mget', index, body, _source_includes))
+        return {'docs': [
+            {'_id': i, 'found': True, '_source': {f: self.docs[i][f] for f in _source_includes if f in self.docs[i]}}
+            if i in self.docs else {'_id': i, 'found': False} for i in body['ids']]}
+
+
+def _document(i: str) -> dict:
+    return {f: f'{f} of {i}' for f in source_fields}
+
+
+def test_fetch_fills_in_the_bodies_of_the_final_hits_only():
+    client      = AsyncClient({'a': _document('a'), 'b': _document('b')})
+    retriever   = ESScriptRetriever(client, 'combined')
+    fetched     = dict(_document('c'), _id = 'c', _score = 0.5)
+    hits        = [{'_id': 'a', '_score': 0.9, 'url': 'url of a'}, {'_id': 'gone', '_score': 0.8}, fetched, {'_id': 'b', '_score': 0.4}]
+
+    hits = asyncio.run(retriever.fetch(hits))
+    assert [h['_id'] for h in hits] == ['a', 'c', 'b']
+    assert hits[0]['title'] == 'title of a' and hits[0]['_score'] == 0.9
+    assert hits[1] is fetched
+    # one `mget` of the hits without the bodies
+    assert client.calls == [('mget', 'combined', {'ids': ['a', 'gone', 'b']}, source_fields)]
+
+    client.calls.clear()
+    assert asyncio.run(retriever.fetch([fetched])) == [fetched]
+    assert client.calls == []
+
+
+def test_search_returns_the_light_fields_only():
+    body = ESScriptRetriever(AsyncClient(), 'combined')._body(SearchRequest(np.ones(3), 10))
+    assert body['_source'] == {'includes': light_fields} and body['size'] == 10
+
+
+def test_searches_are_sent_in_one_msearch():
+    client      = AsyncClient({'a': _document('a')})
+    retriever   = ESScriptRetriever(client, 'combined')
+
+    results = asyncio.run(retriever.search_many([SearchRequest(np.ones(3), 2), SearchRequest(np.ones(3), 5)]))
+    assert client.calls == [('msearch', [{'index': 'combined'}, {'index': 'combined'}])]
+    assert [r[0]['_score'] for r in results] == [pytest.approx(0.2), pytest.approx(0.5)]
+    assert results[0][0]['_id'] == 'a' and results[0][0]['top_scores'] == [{'score': 0.5, 'source': {'name': 'title_0'}}]
+
+    # a single search needs no msearch
+    client.calls.clear()
+    assert len(asyncio.run(retriever.search(np.ones(3), 2))) == 1
+    assert client.calls == [('search', 'combined')]
+
+
+def test_failed_msearch_raises_a_transport_error():
+    client          = AsyncClient({'a': _document('a')})
+    client.error    = {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}
+    retriever       = ESScriptRetriever(client, 'combined')
+
+    with pytest.raises(TransportError) as e:
+        asyncio.run(retriever.search_many([SearchRequest(np.ones(3), 2), SearchRequest(np.ones(3), 5)]))
+    assert e.value.status_code == 429
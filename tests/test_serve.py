@@ -0,0 +1,40 @@
+import json
+import zlib
+
+from actions.es.serve import route, is_broadcast, _sender_id_re
+
+
+def test_route_is_stable_and_in_range():
+    senders = [f'sender-{i}' for i in range(1000)]
+    workers = [route(s, 4) for s in senders]
+
+    assert workers == [route(s, 4) for s in senders]
+    assert set(workers) == {0, 1, 2, 3}
+    # crc32 is the same in every process (unlike `hash` of str)
+    assert route('sender-0', 4) == zlib.crc32(b'sender-0') % 4
+    assert route('sender-0', 1) == 0
+
+
+def test_route_spreads_the_conversations():
+    counts = [0] * 4
+    for i in range(4000):
+        counts[route(f'{i:08x}-conversation', 4)] += 1
+    assert min(counts) > 800
+
+
+def test_sender_id_of_the_action_request():
+    body    = json.dumps({'next_action': 'action_ask', 'sender_id': 'a"b\\c', 'tracker': {'sender_id': 'a"b\\c'}}).encode('utf-8')
+    match   = _sender_id_re.search(body)
+    assert json.loads(b'"' + match.group(1) + b'"') == 'a"b\\c'
+    assert _sender_id_re.search(b'{"next_action": "action_ask"}') is None
+
+
+def test_parameter_messages_are_broadcast():
+    def _request(action: str, text: str) -> bytes:
+        return json.dumps({'next_action': action, 'sender_id': '1', 'tracker': {'latest_message': {'text': text}}}).encode('utf-8')
+
+    assert is_broadcast(_request('action_set_parameter', 'parameter es_cut_off 0.5'))
+    assert not is_broadcast(_request('action_ask', 'parameter es_cut_off 0.5'))
+    # the name of the action quoted in a message is escaped, so it is not taken for the next action
+    assert not is_broadcast(_request('action_ask', '"next_action": "action_set_parameter"'))
+    assert not is_broadcast(b'')
@@ -0,0 +1,112 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from actions.es.vectors import VectorStore, write_vector_store
+from actions.es.retriever import LocalRetriever
+
+
+def _docs(n: int = 3, dims: int = 8, seed: int = 0) -> list:
+    rng     = np.random.default_rng(seed)
+    docs    = []
+    for i in range(n):
+        docs.append({
+            '_id'       : f'doc-{i}'                        ,
+            'source'    : 'ipm' if i % 2 else 'askExtension',
+            'url'       : f'https://example.org/{i}'        ,
+            'title'     : f'Pest {i}'                       ,
+            'vectors'   : [
+                {'vector': rng.normal(size = dims).tolist(), 'name': f'title_{j}', 'start': 0, 'end': 5} for j in range(2)],
+        })
+    return docs
+
+
+@pytest.mark.parametrize('dtype, tolerance', [('float32', 1e-6), ('float16', 1e-3), ('int8', 2e-2)])
+def test_vector_store_round_trip(tmp_path, dtype, tolerance):
+    docs        = _docs()
+    generation  = write_vector_store(str(tmp_path), docs, model = 'model', dtype = dtype)
+    store       = VectorStore.open(str(tmp_path))
+
+    assert store.generation == generation
+    assert store.model == 'model'
+    assert len(store) == len(docs)
+    assert store.document(1)['_id'] == 'doc-1' and store.document(1)['title'] == 'Pest 1'
+    assert store.chunk(3) == {'name': 'title_1', 'start': 0, 'end': 5}
+    assert list(store.chunk_doc) == [0, 0, 1, 1, 2, 2]
+
+    query   = np.asarray(docs[2]['vectors'][0]['vector'], dtype = np.float32)
+    vectors = np.asarray([v['vector'] for d in docs for v in d['vectors']], dtype = np.float32)
+    exact   = vectors @ query / np.linalg.norm(vectors, axis = 1) / np.linalg.norm(query)
+    np.testing.assert_allclose(store.scores(query), exact, atol = tolerance)
+    np.testing.assert_allclose(store.scores(query, rows = np.array([4, 1])), exact[[4, 1]], atol = tolerance)
+
+
+def test_local_retriever_serves_the_new_generation(tmp_path):
+    path = str(tmp_path)
+    write_vector_store(path, _docs(n = 2), model = 'model')
+    retriever = LocalRetriever(VectorStore.open(path), path = path, generation_ttl = 0)
+
+    async def main():
+        first = await retriever.generation()
+        assert len(await retriever.search(np.ones(8), size = 10)) == 2
+
+        second = write_vector_store(path, _docs(n = 3, seed = 1), model = 'model')
+        assert await retriever.generation() == second != first
+        assert len(await retriever.search(np.ones(8), size = 10)) == 3
+
+    asyncio.run(main())
+
+
+def test_local_retriever_searches_the_new_generation_without_the_result_cache(tmp_path):
+    # with the result cache disabled `generation` is never called, the searches open the new store themselves
+    path = str(tmp_path)
+    write_vector_store(path, _docs(n = 2), model = 'model')
+    retriever = LocalRetriever(VectorStore.open(path), path = path, generation_ttl = 0)
+
+    async def main():
+        assert len(await retriever.search(np.ones(8), size = 10)) == 2
+        second = write_vector_store(path, _docs(n = 3, seed = 1), model = 'model')
+        assert len(await retriever.search(np.ones(8), size = 10)) == 3
+        assert len(await retriever.search(np.ones(8), size = 10, ids = ['doc-2'])) == 1
+        assert retriever.store.generation == second
+
+    asyncio.run(main())
+
+
+def _unit_docs() -> list:
+    '''Documents whose chunks are unit vectors - doc-i has the chunks of the axes i and i + 4.'''
+    docs = []
+    for i in range(4):
+        docs.append({
+            '_id'       : f'doc-{i}'                        ,
+            'source'    : 'ipm' if i % 2 else 'askExtension',
+            'url'       : f'https://example.org/{i}'        ,
+            'vectors'   : [{'vector': np.eye(8)[j].tolist(), 'name': f'title_{j}', 'start': 0, 'end': 1} for j in (i, i + 4)],
+        })
+    return docs
+
+
+def test_local_retriever_scores_documents_by_their_best_chunk(tmp_path):
+    write_vector_store(str(tmp_path), _unit_docs(), model = 'model')
+    retriever   = LocalRetriever(VectorStore.open(str(tmp_path)))
+    query       = np.array([0.1, 0.2, 0.3, 0, 0, 0, 0.9, 0], dtype = np.float32)
+
+    async def main():
+        hits = await retriever.search(query, size = 2)
+        assert [h['_id'] for h in hits] == ['doc-2', 'doc-1']
+        assert hits[0]['url'] == 'https://example.org/2'
+        assert hits[0]['_score'] == pytest.approx(0.9 / np.linalg.norm(query), abs = 1e-6)
+        assert [s['source']['name'] for s in hits[0]['top_scores']] == ['title_6', 'title_2']
+
+        hits = await retriever.search(query, size = 10, sources = ['askExtension'])
+        assert [h['_id'] for h in hits] == ['doc-2', 'doc-0']
+        hits = await retriever.search(query, size = 10, exclude = ['askExtension'])
+        assert [h['_id'] for h in hits] == ['doc-1', 'doc-3']
+        hits = await retriever.search(query, size = 10, ids = ['doc-3', 'doc-0', 'missing'])
+        assert [h['_id'] for h in hits] == ['doc-0', 'doc-3']
+
+        # the documents are read along with the hits, there is nothing to fetch
+        assert await retriever.fetch(hits) == hits
+
+    asyncio.run(main())